@@ -1,36 +1,249 @@
-import bluetooth
+import time
+import logging
+import socket
+from metrics import REGISTRY
+import tracing
 
+log = logging.getLogger("drinksync.bt")
 
-def send_message(message):
+TARGET_ADDRESS = "08:8B:C8:32:4F:5F"
+SERVICE_UUID = "c7506ec6-09d3-4979-9db3-3b85acad20fd"  # same as the Android side
+# Separate RFCOMM service for history_sync.py, so the message server keeps
+# receiving plain text.
+HISTORY_SYNC_UUID = "92665475-e17b-4658-bd19-31afbb49d617"
+
+# Where messages go: rfcomm://<address>[/<uuid>], tcp://<host>:<port> or
+# unix://<path>. Point it at `python3 phone_emulator.py serve` to run the
+# send path without a phone.
+TRANSPORT_URL = "rfcomm://%s" % TARGET_ADDRESS
+HISTORY_SYNC_URL = "rfcomm://%s/%s" % (TARGET_ADDRESS, HISTORY_SYNC_UUID)
+CONNECT_TIMEOUT_S = 10.0  # TCP and Unix sockets only; RFCOMM uses the stack's timeout
+REPLY_TIMEOUT_S = 2.0  # The app does not always answer; stop waiting after this long
+
+BT_DISCOVERY_SECONDS = REGISTRY.histogram(
+    "bt_service_discovery_seconds", "Time spent in bluetooth.find_service()")
+BT_CONNECT_SECONDS = REGISTRY.histogram(
+    "bt_connect_seconds", "Time to open the RFCOMM connection")
+BT_SEND_SECONDS = REGISTRY.histogram(
+    "bt_send_seconds", "Time to send a message and receive the reply")
+BT_MESSAGES = REGISTRY.counter(
+    "bt_messages_total", "Messages handed to send_message() by outcome", ("outcome",))
+
+
+class ServiceNotFoundError(ConnectionError):
+    """The phone is reachable but does not offer the DrinkSync service."""
+
+
+# --- Transports ---
+
+class Transport:
     """
-    Sends a message via Bluetooth to the target device.
+    Opens connections to the phone's message server.
 
-    Args:
-        message (str): The message to send.
+    connect() returns a connected socket-like object (sendall, recv,
+    settimeout, close) and raises an OSError subclass on failure.
     """
-    target_address = "08:8B:C8:32:4F:5F"
-    service_uuid = "c7506ec6-09d3-4979-9db3-3b85acad20fd"  # same as the Android side
 
-    service_matches = bluetooth.find_service(uuid=service_uuid, address=target_address)
+    url = None
 
-    if len(service_matches) == 0:
-        print("Could not find the DrinkSync service.")
-        return False
-    else:
-        first_match = service_matches[0]
-        port = first_match["port"]
-        host = first_match["host"]
+    def connect(self):
+        raise NotImplementedError
+
+    def is_timeout(self, error):
+        """True if 'error', raised by a socket from connect(), is a timeout."""
+        return isinstance(error, socket.timeout)
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, self.url)
+
+
+class RfcommTransport(Transport):
+    """Bluetooth RFCOMM via PyBluez; the service's channel is looked up on every connect."""
+
+    def __init__(self, address=TARGET_ADDRESS, service_uuid=SERVICE_UUID):
+        self.address = address
+        self.service_uuid = service_uuid
+        self.url = "rfcomm://%s/%s" % (address, service_uuid)
 
+    def connect(self):
+        import bluetooth  # Only needed for real hardware
+
+        with BT_DISCOVERY_SECONDS.time(), tracing.span("bt.find_service"):
+            service_matches = bluetooth.find_service(uuid=self.service_uuid, address=self.address)
+        if len(service_matches) == 0:
+            raise ServiceNotFoundError("DrinkSync service not found on %s" % self.address)
+        sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
         try:
-            sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-            sock.connect((host, port))
+            with BT_CONNECT_SECONDS.time(), tracing.span("bt.connect"):
+                sock.connect((service_matches[0]["host"], service_matches[0]["port"]))
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def is_timeout(self, error):
+        # PyBluez reports timeouts as BluetoothError("timed out").
+        return isinstance(error, socket.timeout) or str(error) == "timed out"
+
+
+class TcpTransport(Transport):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.url = "tcp://%s:%d" % (host, port)
+
+    def connect(self):
+        with BT_CONNECT_SECONDS.time(), tracing.span("bt.connect"):
+            sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT_S)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)
+        return sock
+
+
+class UnixTransport(Transport):
+    def __init__(self, path):
+        self.path = path
+        self.url = "unix://%s" % path
 
-            # Send the message
-            sock.send(message)
-            data = sock.recv(1024)
-            print("Received:", data.decode())
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(CONNECT_TIMEOUT_S)
+            with BT_CONNECT_SECONDS.time(), tracing.span("bt.connect"):
+                sock.connect(self.path)
+        except Exception:
             sock.close()
-            return True
-        except Exception as e:
-            print(f"Error sending message: {e}")
-            return False
+            raise
+        sock.settimeout(None)
+        return sock
+
+
+def transport_from_url(url):
+    """
+    Creates a Transport from a URL.
+
+    Args:
+        url (str): rfcomm://<address>[/<uuid>], tcp://<host>:<port> or unix://<path>.
+
+    Returns:
+        Transport
+    """
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        raise ValueError("Transport URL '%s' has no scheme" % url)
+    if scheme == "rfcomm":
+        address, _, service_uuid = rest.partition("/")
+        return RfcommTransport(address, service_uuid or SERVICE_UUID)
+    if scheme == "tcp":
+        host, _, port = rest.rpartition(":")
+        return TcpTransport(host or "127.0.0.1", int(port))
+    if scheme == "unix":
+        return UnixTransport(rest)
+    raise ValueError("Unknown transport '%s'" % scheme)
+
+
+_transport = None
+
+
+def get_transport():
+    """The transport send_message() uses by default (from TRANSPORT_URL)."""
+    global _transport
+    if _transport is None:
+        _transport = transport_from_url(TRANSPORT_URL)
+    return _transport
+
+
+def set_transport(transport):
+    """Replaces the default transport; accepts a Transport or a URL."""
+    global _transport
+    _transport = transport_from_url(transport) if isinstance(transport, str) else transport
+
+
+# --- Messages ---
+
+def send_message(message, transport=None):
+    """
+    Sends a message to the target device.
+
+    Args:
+        message (str): The message to send.
+        transport (Transport): Where to send it; get_transport() by default.
+
+    Returns:
+        bool: True if the message was written to the connection.
+    """
+    transport = transport or get_transport()
+    data = message.encode() if isinstance(message, str) else message
+    try:
+        sock = transport.connect()
+    except ServiceNotFoundError:
+        log.warning("Could not find the DrinkSync service.")
+        BT_MESSAGES.labels("service_not_found").inc()
+        return False
+    except Exception as e:
+        log.warning("Error sending message: %s", e)
+        BT_MESSAGES.labels("error").inc()
+        return False
+
+    try:
+        # Send the message
+        start = time.perf_counter()
+        with tracing.span("bt.send", size=len(data)):
+            sock.sendall(data)
+            sock.settimeout(REPLY_TIMEOUT_S)
+            try:
+                reply = sock.recv(1024)
+            except Exception as e:
+                if not transport.is_timeout(e):
+                    raise
+                reply = None
+        BT_SEND_SECONDS.observe(time.perf_counter() - start)
+        if not reply:
+            log.debug("No reply within %.1f s", REPLY_TIMEOUT_S)
+            BT_MESSAGES.labels("unacknowledged").inc()
+        else:
+            log.debug("Received: %s", reply.decode(errors="replace"))
+            BT_MESSAGES.labels("sent").inc()
+        return True
+    except Exception as e:
+        log.warning("Error sending message: %s", e)
+        BT_MESSAGES.labels("error").inc()
+        return False
+    finally:
+        # Also on a failed send; a leaked RFCOMM socket holds the channel
+        sock.close()
+
+
+def sync_history(store, transport=None):
+    """
+    Sends the readings the phone has not acknowledged yet (see history_sync.py).
+
+    Args:
+        store (HistoryStore): The on-device reading history.
+        transport (Transport): Defaults to HISTORY_SYNC_URL.
+
+    Returns:
+        int: Readings sent, or None if the phone could not be reached.
+    """
+    import history_sync
+
+    transport = transport or transport_from_url(HISTORY_SYNC_URL)
+    try:
+        sock = transport.connect()
+    except ServiceNotFoundError:
+        log.info("Phone does not offer history sync.")
+        return None
+    except OSError as e:
+        log.warning("History sync could not connect: %s", e)
+        return None
+
+    try:
+        with tracing.span("bt.sync_history"):
+            sent, _ = history_sync.sync_history(sock, store)
+        return sent
+    except (OSError, history_sync.SyncError) as e:
+        # Whatever was acknowledged is kept; the next sync resumes from there.
+        log.warning("History sync interrupted: %s", e)
+        return None
+    finally:
+        sock.close()
@@ -0,0 +1,451 @@
+# File: delivery.py
+#
+# Fan-out delivery of reading messages to several paired phones.
+#
+# bt.send_message() discovers, connects to and closes one hard-coded phone
+# per message. The DeliveryManager instead keeps one PeerSession per
+# registered phone. Each session owns a persistent connection, a bounded
+# queue and its own retry state, and runs on its own thread, so a slow or
+# absent phone delays only its own queue and adding phones does not add
+# latency to the others.
+#
+# The app's RFCOMM server serves a single connection, reads up to 1024 bytes
+# at a time as one message and does not answer (its "OK" replies are
+# commented out). Writes that reach it back to back arrive in one read and
+# all but the first are lost, so for such peers the session leaves
+# UNACKED_GAP_S between writes, and a written message counts as
+# "unconfirmed", never as delivered. Peers with "ack": true wait for a reply
+# line per message instead, and only those count as delivered.
+#
+# DeliveryManager.call_after_delivery() queues a function behind a peer's
+# messages, to run on that peer's thread once they have been written, e.g. a
+# history sync that should only be tried when the phone is reachable.
+#
+# Peers are registered in PEERS_FILE, by Bluetooth address or by any
+# bt.transport_from_url() URL:
+#
+#   {"peers": [{"name": "kitchen", "address": "08:8B:C8:32:4F:5F"},
+#              {"name": "nurse", "url": "tcp://192.168.1.20:9000", "ack": true}]}
+#
+# Usage:
+#   python3 delivery.py selftest    # four emulated phones (fast, slow, flaky, late); no hardware
+
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+from metrics import REGISTRY
+
+log = logging.getLogger("drinksync.delivery")
+
+# --- Configuration ---
+PEERS_FILE = "delivery_peers.json"
+QUEUE_LIMIT = 256  # Messages kept per peer while it is unreachable; the oldest are dropped first
+SEND_TIMEOUT_S = 5.0  # Socket timeout for send and ack
+RETRY_BACKOFF_S = 0.5  # First retry delay after a failure, doubled per consecutive failure
+MAX_RETRY_BACKOFF_S = 60.0
+LATENCY_WINDOW = 256  # Deliveries kept per peer for latency percentiles
+UNACKED_GAP_S = 0.5  # Pause between writes to a peer without acks, so each write is read on its own
+
+# --- Metrics ---
+DELIVERY_MESSAGES = REGISTRY.counter(
+    "delivery_messages_total", "Messages per peer by outcome", ("peer", "outcome"))
+DELIVERY_SECONDS = REGISTRY.histogram(
+    "delivery_seconds", "Time from DeliveryManager.send() to delivery, all peers")
+DELIVERY_BACKLOG = REGISTRY.gauge(
+    "delivery_backlog", "Messages queued for delivery, all peers")
+
+
+class RejectedError(Exception):
+    """The peer answered the message with an error; sending it again would not help."""
+
+
+# --- Sessions ---
+
+class PeerSession:
+    """
+    Delivery to one peer: a persistent connection, a bounded queue of
+    (enqueue_time, message) and exponential backoff after failures.
+
+    'connect' returns a connected socket-like object, e.g. the connect
+    method of a bt.Transport.
+    """
+
+    def __init__(self, name, connect, ack=False, queue_limit=QUEUE_LIMIT):
+        self.name = name
+        self.connect = connect
+        self.ack = ack
+        self._queue = deque()
+        self._queue_limit = queue_limit
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self._sock = None
+        self._in_flight = False
+        self._last_write = None  # time.monotonic() of the last write to a peer without acks
+
+        # Retry state
+        self.failures = 0  # Consecutive failures, reset by a delivery
+        self.retry_at = 0.0  # time.monotonic() before which no attempt is made
+        self.last_error = None
+
+        # Statistics
+        self.delivered = 0  # Acknowledged by the peer
+        self.unconfirmed = 0  # Written to a peer without acks
+        self.dropped = 0
+        self.rejected = 0
+        self.attempts_failed = 0
+        self.connects = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._thread = threading.Thread(target=self._run, name="delivery-%s" % name, daemon=True)
+        self._thread.start()
+
+    # --- Producer side ---
+
+    def enqueue(self, message, now=None):
+        """Queues one message. Never blocks; drops the oldest message if the queue is full."""
+        with self._cond:
+            if len(self._queue) >= self._queue_limit:
+                self._queue.popleft()
+                self.dropped += 1
+                DELIVERY_MESSAGES.labels(self.name, "dropped").inc()
+            self._queue.append((time.monotonic() if now is None else now, message))
+            self._cond.notify()
+
+    def enqueue_call(self, fn, now=None):
+        """
+        Queues fn() to run on this session's thread after the messages queued
+        before it have been written; while the peer is unreachable it waits
+        with them. Returns False if fn is already waiting in the queue.
+        """
+        with self._cond:
+            if any(item is fn for _, item in self._queue):
+                return False
+            self._queue.append((time.monotonic() if now is None else now, fn))
+            self._cond.notify()
+        return True
+
+    @property
+    def backlog(self):
+        return len(self._queue) + self._in_flight
+
+    def wait_idle(self, timeout=None):
+        """Waits until everything queued so far has been delivered (or written, without acks). Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queue or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(SEND_TIMEOUT_S)
+        self._disconnect()
+
+    # --- Delivery thread ---
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and (not self._queue or time.monotonic() < self.retry_at):
+                    self._cond.wait(None if not self._queue else self.retry_at - time.monotonic())
+                if self._closed:
+                    return
+                enqueued, message = self._queue[0]
+                self._in_flight = True
+                self._queue.popleft()
+            if callable(message):
+                self._call(message)
+                continue
+            try:
+                start = time.monotonic()
+                self._deliver(message)
+                done = time.monotonic()
+            except RejectedError as e:
+                self._rejected(message, e)
+                continue
+            except Exception as e:
+                self._failed(enqueued, message, e)
+                continue
+            with self._cond:
+                self._in_flight = False
+                self.failures = 0
+                if self.ack:
+                    self.delivered += 1
+                    self._latencies.append((done - enqueued, done - start))
+                else:
+                    self.unconfirmed += 1
+                self._cond.notify_all()
+            if self.ack:
+                DELIVERY_MESSAGES.labels(self.name, "delivered").inc()
+                DELIVERY_SECONDS.observe(done - enqueued)
+            else:
+                DELIVERY_MESSAGES.labels(self.name, "unconfirmed").inc()
+
+    def _deliver(self, message):
+        if self._sock is None:
+            self._sock = self.connect()
+            self._sock.settimeout(SEND_TIMEOUT_S)
+            self.connects += 1
+            log.info("Connected to %s", self.name)
+        data = message.encode() if isinstance(message, str) else message
+        if not self.ack and self._last_write is not None:
+            # Nothing tells us the previous write has been read; give the
+            # peer time to, or both land in one read and merge.
+            gap = self._last_write + UNACKED_GAP_S - time.monotonic()
+            if gap > 0:
+                time.sleep(gap)
+        self._sock.sendall(data)
+        if not self.ack:
+            self._last_write = time.monotonic()
+            return
+        reply = self._sock.recv(1024)
+        if not reply:
+            raise ConnectionError("Peer closed the connection")
+        if not reply.startswith(b"OK"):
+            raise RejectedError("Peer rejected the message: %r" % reply.strip())
+
+    def _call(self, fn):
+        try:
+            fn()
+        except Exception as e:
+            log.warning("Call queued for %s failed: %s", self.name, e)
+        with self._cond:
+            self._in_flight = False
+            self._cond.notify_all()
+
+    def _rejected(self, message, error):
+        with self._cond:
+            self._in_flight = False
+            self.rejected += 1
+            self.last_error = str(error)
+            self._cond.notify_all()
+        DELIVERY_MESSAGES.labels(self.name, "rejected").inc()
+        log.warning("%s: %r", error, message)
+
+    def _failed(self, enqueued, message, error):
+        self._disconnect()
+        with self._cond:
+            # Put the message back at the front unless newer ones pushed it out meanwhile.
+            if len(self._queue) < self._queue_limit:
+                self._queue.appendleft((enqueued, message))
+            else:
+                self.dropped += 1
+                DELIVERY_MESSAGES.labels(self.name, "dropped").inc()
+            self._in_flight = False
+            self.failures += 1
+            self.attempts_failed += 1
+            self.last_error = str(error)
+            backoff = min(RETRY_BACKOFF_S * 2 ** (self.failures - 1), MAX_RETRY_BACKOFF_S)
+            self.retry_at = time.monotonic() + backoff
+            self._cond.notify_all()
+        DELIVERY_MESSAGES.labels(self.name, "retried").inc()
+        if self.failures == 1:
+            log.warning("Delivery to %s failed: %s", self.name, error)
+        else:
+            log.debug("Delivery to %s failed (%d in a row): %s", self.name, self.failures, error)
+
+    def _disconnect(self):
+        sock, self._sock = self._sock, None
+        self._last_write = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    # --- Reporting ---
+
+    def stats(self):
+        with self._cond:
+            latencies = sorted(total for total, _ in self._latencies)
+            round_trips = sorted(rtt for _, rtt in self._latencies)
+            oldest = self._queue[0][0] if self._queue else None
+            return {
+                "backlog": len(self._queue) + self._in_flight,
+                "oldestQueuedS": None if oldest is None else time.monotonic() - oldest,
+                "delivered": self.delivered,
+                "unconfirmed": self.unconfirmed,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "failedAttempts": self.attempts_failed,
+                "consecutiveFailures": self.failures,
+                "connects": self.connects,
+                "connected": self._sock is not None,
+                "lastError": self.last_error,
+                "latencyP50Ms": _percentile(latencies, 0.5),
+                "latencyP95Ms": _percentile(latencies, 0.95),
+                "sendP50Ms": _percentile(round_trips, 0.5),
+            }
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)] * 1e3
+
+
+class DeliveryManager:
+    """
+    Sends every message to all registered peers in parallel.
+
+    Example:
+        manager = DeliveryManager()
+        manager.add_peer("kitchen", bt.RfcommTransport("08:8B:C8:32:4F:5F").connect)
+        manager.send("Weight Differnce: 12.50 grams")
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sessions = {}
+
+    def add_peer(self, name, connect, ack=False, queue_limit=QUEUE_LIMIT):
+        with self._lock:
+            if name in self.sessions:
+                raise ValueError("Peer '%s' is already registered" % name)
+            session = PeerSession(name, connect, ack, queue_limit)
+            self.sessions[name] = session
+        return session
+
+    def remove_peer(self, name):
+        with self._lock:
+            session = self.sessions.pop(name, None)
+        if session is not None:
+            session.close()
+
+    def send(self, message):
+        """Queues 'message' for every peer and returns immediately. Returns the number of peers."""
+        now = time.monotonic()
+        sessions = list(self.sessions.values())
+        for session in sessions:
+            session.enqueue(message, now)
+        DELIVERY_BACKLOG.set(self.backlog())
+        return len(sessions)
+
+    def call_after_delivery(self, fn, peer=None):
+        """
+        Runs fn() on the thread of 'peer' (the first registered peer if None)
+        once the messages already queued for it have been written; see
+        PeerSession.enqueue_call(). Returns False if there is no such peer or
+        fn is still waiting from an earlier call.
+        """
+        sessions = list(self.sessions.values()) if peer is None else [self.sessions.get(peer)]
+        if not sessions or sessions[0] is None:
+            return False
+        return sessions[0].enqueue_call(fn)
+
+    def backlog(self):
+        return sum(session.backlog for session in list(self.sessions.values()))
+
+    def flush(self, timeout=None):
+        """Waits until all peers have delivered what was queued. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        idle = True
+        for session in list(self.sessions.values()):
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            idle = session.wait_idle(remaining) and idle
+        DELIVERY_BACKLOG.set(self.backlog())
+        return idle
+
+    def stats(self):
+        return {name: session.stats() for name, session in list(self.sessions.items())}
+
+    def close(self):
+        with self._lock:
+            sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            session.close()
+
+
+def load_peers(path=PEERS_FILE):
+    """Returns the peer entries from 'path' ([] if the file does not exist)."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f).get("peers", [])
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError, AttributeError) as e:
+        log.warning("Could not load delivery peers from %s: %s", path, e)
+        return []
+
+
+def manager_from_file(path=PEERS_FILE):
+    """Builds a DeliveryManager for the peers in 'path', or None if there are none."""
+    import bt
+
+    peers = load_peers(path)
+    if not peers:
+        return None
+    manager = DeliveryManager()
+    for peer in peers:
+        url = peer.get("url") or "rfcomm://%s/%s" % (peer["address"], peer.get("uuid", bt.SERVICE_UUID))
+        manager.add_peer(peer["name"], bt.transport_from_url(url).connect, ack=peer.get("ack", False))
+    return manager
+
+
+# --- Self-test ---
+
+def _selftest(messages=40):
+    import bt
+    import metrics
+    from phone_emulator import PhoneEmulator
+
+    global RETRY_BACKOFF_S
+    RETRY_BACKOFF_S = 0.05
+    delays = {"fast": 0.002, "slow": 0.030, "flaky": 0.005, "late": 0.002}
+    phones = {"fast": PhoneEmulator("tcp://127.0.0.1:0", delay_s=delays["fast"]).start(),
+              "slow": PhoneEmulator("tcp://127.0.0.1:0", delay_s=delays["slow"]).start(),
+              "flaky": PhoneEmulator("tcp://127.0.0.1:0", delay_s=delays["flaky"], drop_every=7).start()}
+    # Not listening until half the messages are queued.
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    late_url = "tcp://127.0.0.1:%d" % probe.getsockname()[1]
+    probe.close()
+
+    manager = DeliveryManager()
+    for name in delays:
+        url = late_url if name == "late" else phones[name].url
+        manager.add_peer(name, bt.transport_from_url(url).connect, ack=True)
+
+    start = time.monotonic()
+    for i in range(messages):
+        if i == messages // 2:
+            phones["late"] = PhoneEmulator(late_url, delay_s=delays["late"]).start()
+        manager.send("Average weight: %.2f grams" % (10 + i))
+        time.sleep(0.01)
+    sent = time.monotonic() - start
+    manager.flush(timeout=30)
+    elapsed = time.monotonic() - start
+
+    expected = ["Average weight: %.2f grams" % (10 + i) for i in range(messages)]
+    for name, phone in phones.items():
+        stats = manager.stats()[name]
+        ok = phone.messages == expected
+        print(f"{name: <6} delivered {stats['delivered']:3d}  in order: {'yes' if ok else 'NO'}  "
+              f"retries {stats['failedAttempts']:2d}  connects {stats['connects']:2d}  "
+              f"latency p50 {stats['latencyP50Ms']:6.1f} ms  p95 {stats['latencyP95Ms']:7.1f} ms  "
+              f"send p50 {stats['sendP50Ms']:5.1f} ms")
+    total_rtt = sum(delays.values())
+    print(f"{messages} messages queued in {sent * 1e3:.0f} ms, all delivered after {elapsed * 1e3:.0f} ms; "
+          f"one peer after another would wait >= {total_rtt * 1e3:.0f} ms per message, "
+          f"{messages * total_rtt * 1e3:.0f} ms in total")
+    print("\n".join(line for line in metrics.REGISTRY.render().splitlines() if line.startswith("delivery_messages")))
+    manager.close()
+    for phone in phones.values():
+        phone.stop()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "selftest":
+        logging.basicConfig(level=logging.WARNING)
+        _selftest()
+    else:
+        print("Usage: python3 delivery.py selftest")
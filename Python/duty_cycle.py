@@ -0,0 +1,473 @@
+# File: duty_cycle.py
+#
+# Predictive duty cycling: learns from the history when the scale gets used
+# and slows the sensors down in the hours that have been quiet.
+#
+# ActivityProfile turns the recorded activity (readings with intake and
+# detected events, see HistoryStore.activity_times()) into expected events
+# per local hour of day, weighting recent days more so a changed routine
+# takes over within a couple of weeks. Hours expecting fewer than
+# QUIET_ACTIVITY_PER_HOUR events are quiet.
+#
+# DutyCycleScheduler answers, at any moment, how often to poll the gyroscope
+# and to sample the HX711. In quiet hours the gyroscope is polled every
+# QUIET_GYRO_INTERVAL_S instead of every 0.1 s, a continuously sampled HX711
+# is powered down between conversions taken QUIET_HX711_INTERVAL_S apart,
+# and triggered readings without motion since the last one are limited to
+# one per QUIET_READING_INTERVAL_S. Any motion restores full rate at once and
+# keeps it for WAKE_HOLD_S after the last motion, so a mispredicted hour
+# costs at most one slow gyro poll of detection latency.
+#
+# Usage:
+#   python3 duty_cycle.py profile [history.db]    # learned hourly profile, quiet hours marked
+#   python3 duty_cycle.py bench [history.db]      # CPU, energy and detection latency on a replayed trace
+
+import logging
+import math
+import sys
+import threading
+import time
+
+from metrics import REGISTRY
+
+log = logging.getLogger("drinksync.duty_cycle")
+
+# --- Configuration ---
+LEARN_DAYS = 28  # History the profile is learned from
+HALF_LIFE_DAYS = 7.0  # A day's activity counts half as much after this many days
+MIN_LEARN_DAYS = 3.0  # With less history than this, no hour is quiet
+QUIET_ACTIVITY_PER_HOUR = 0.25  # Hours expecting fewer events than this (on average) are quiet
+ACTIVITY_MIN_INTAKE_G = 5.0  # Readings count as activity from this intake on (not repeats of an untouched bottle)
+RELEARN_INTERVAL_S = 3600  # Re-read the history this often
+PROFILE_CHECK_S = 60  # Re-evaluate the hour this often (motion wakes at once regardless)
+
+QUIET_GYRO_INTERVAL_S = 1.0  # Gyro poll interval in quiet hours; a pickup lasts several seconds
+QUIET_HX711_INTERVAL_S = 30.0  # Continuous HX711 sampling in quiet hours: one conversion per this
+QUIET_READING_INTERVAL_S = 300.0  # Triggered readings without preceding motion in quiet hours
+WAKE_HOLD_S = 300.0  # Full rate for this long after the last motion
+
+DAY_S = 86400
+
+# --- Metrics ---
+DUTY_CYCLE_QUIET = REGISTRY.gauge(
+    "duty_cycle_quiet", "1 while the sensors run at the reduced quiet-hour rate")
+DUTY_CYCLE_WAKEUPS = REGISTRY.counter(
+    "duty_cycle_wakeups_total", "Quiet periods ended early by motion")
+DUTY_CYCLE_SKIPPED = REGISTRY.counter(
+    "duty_cycle_skipped_readings_total", "Triggered readings skipped in quiet hours")
+
+
+class ActivityProfile:
+    """
+    Expected activity per local hour of day.
+
+    Attributes:
+        rates (list): Expected events in each hour 0-23.
+        days (float): Days of history behind the rates; below MIN_LEARN_DAYS
+            every hour counts as active.
+    """
+
+    def __init__(self, rates=None, days=0.0):
+        self.rates = list(rates) if rates is not None else [0.0] * 24
+        self.days = days
+
+    @classmethod
+    def learn(cls, times, now, days=LEARN_DAYS):
+        """
+        Learns the profile from activity timestamps.
+
+        Args:
+            times: time.time() values of readings and events, oldest first.
+            now (float): End of the learning window.
+            days (float): Length of the learning window.
+
+        Returns:
+            ActivityProfile
+        """
+        times = [ts for ts in times if now - days * DAY_S <= ts < now]
+        if not times:
+            return cls()
+        counts = [0.0] * 24
+        for ts in times:
+            counts[time.localtime(ts).tm_hour] += 0.5 ** ((now - ts) / DAY_S / HALF_LIFE_DAYS)
+        # The history is taken to start with its first activity. Dividing by
+        # the decayed number of days it covers turns counts into per-day rates.
+        covered = (now - times[0]) / DAY_S
+        weighted_days = HALF_LIFE_DAYS / math.log(2) * (1 - 0.5 ** (covered / HALF_LIFE_DAYS))
+        return cls([count / weighted_days for count in counts], covered)
+
+    @classmethod
+    def from_history(cls, store, now=None, days=LEARN_DAYS):
+        """Learns the profile from a HistoryStore's last 'days' days."""
+        now = time.time() if now is None else now
+        return cls.learn(store.activity_times(now - days * DAY_S, now, ACTIVITY_MIN_INTAKE_G), now, days)
+
+    @property
+    def trained(self):
+        return self.days >= MIN_LEARN_DAYS
+
+    def is_quiet(self, ts):
+        """True if the hour containing 'ts' has historically been quiet."""
+        return self.trained and self.rates[time.localtime(ts).tm_hour] < QUIET_ACTIVITY_PER_HOUR
+
+    def quiet_hours(self):
+        return [hour for hour in range(24) if self.trained and self.rates[hour] < QUIET_ACTIVITY_PER_HOUR]
+
+    def format(self):
+        lines = ["Learned from %.1f days%s" % (self.days, "" if self.trained else
+                                                 " (too few; every hour runs at full rate)")]
+        scale = max(max(self.rates), QUIET_ACTIVITY_PER_HOUR)
+        for hour, rate in enumerate(self.rates):
+            lines.append("  %02d:00 %5.2f/h %-40s %s" % (hour, rate, "#" * round(40 * rate / scale),
+                                                         "quiet" if hour in self.quiet_hours() else ""))
+        return "\n".join(lines)
+
+
+def format_hours(hours):
+    """'00-05, 22-23' style ranges for a sorted list of hours."""
+    ranges = []
+    for hour in hours:
+        if ranges and ranges[-1][1] == hour - 1:
+            ranges[-1][1] = hour
+        else:
+            ranges.append([hour, hour])
+    return ", ".join("%02d" % a if a == b else "%02d-%02d" % (a, b) for a, b in ranges) or "none"
+
+
+class DutyCycleScheduler:
+    """
+    Sensor rates from the learned profile and recent motion.
+
+    Safe to share between threads: the gyroscope loop reports motion, the
+    HX711 producer waits in wait_for_wake().
+
+    Args:
+        profile (ActivityProfile): Fixed profile; learned from 'store' if omitted.
+        store (HistoryStore): History to (re)learn the profile from every RELEARN_INTERVAL_S.
+        full_gyro_interval_s (float): Gyro poll interval outside quiet hours.
+    """
+
+    def __init__(self, profile=None, store=None, full_gyro_interval_s=0.1):
+        self.profile = profile or ActivityProfile()
+        self.store = store
+        self.full_gyro_interval_s = full_gyro_interval_s
+        self.quiet = False
+        self.wakeups = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._awake_until = 0.0
+        self._next_check = 0.0
+        self._learned_at = None
+        self._last_reading = None
+        self._motion_since_reading = True
+
+    def relearn(self):
+        """Re-learns the profile from the store (keeps the old one on errors)."""
+        self._learned_at = time.monotonic()
+        try:
+            self.profile = ActivityProfile.from_history(self.store)
+        except Exception as e:
+            log.warning("Could not learn the activity profile: %s", e)
+            return
+        log.info("Activity profile from %.1f days; quiet hours: %s",
+                 self.profile.days, format_hours(self.profile.quiet_hours()))
+
+    def is_quiet(self):
+        """True while the sensors should run at the quiet-hour rate."""
+        now = time.monotonic()
+        if now < self._next_check:
+            return self.quiet
+        with self._lock:
+            if self.store is not None and (self._learned_at is None
+                                           or now - self._learned_at >= RELEARN_INTERVAL_S):
+                self.relearn()
+            quiet = now >= self._awake_until and self.profile.is_quiet(time.time())
+            if quiet != self.quiet:
+                self.quiet = quiet
+                DUTY_CYCLE_QUIET.set(int(quiet))
+                if quiet:
+                    self._wake.clear()
+                    log.info("Quiet hour: gyro every %.1f s, HX711 every %.0f s", QUIET_GYRO_INTERVAL_S,
+                             QUIET_HX711_INTERVAL_S)
+                else:
+                    log.info("Active hour: sensors at full rate")
+            self._next_check = self._awake_until if now < self._awake_until else now + PROFILE_CHECK_S
+        return self.quiet
+
+    def gyro_interval(self):
+        """Seconds until the next gyroscope poll (for pipeline.gyro_source)."""
+        return QUIET_GYRO_INTERVAL_S if self.is_quiet() else self.full_gyro_interval_s
+
+    def hx711_interval(self):
+        """Seconds between HX711 conversions, or None to take every one."""
+        return QUIET_HX711_INTERVAL_S if self.is_quiet() else None
+
+    def note_motion(self, item=None):
+        """Reports motion: full rate at once, for WAKE_HOLD_S."""
+        now = time.monotonic()
+        with self._lock:
+            self._awake_until = now + WAKE_HOLD_S
+            self._motion_since_reading = True
+            if self.quiet:
+                self.quiet = False
+                self._next_check = self._awake_until
+                self.wakeups += 1
+                DUTY_CYCLE_QUIET.set(0)
+                DUTY_CYCLE_WAKEUPS.inc()
+                self._wake.set()
+                log.info("Motion: sensors back at full rate")
+
+    def wait_for_wake(self, timeout):
+        """Sleeps for up to 'timeout' seconds; returns True early if motion ended the quiet period."""
+        return self._wake.wait(timeout)
+
+    def reading_due(self):
+        """
+        Whether a triggered reading should go ahead: always outside quiet
+        hours, otherwise after motion or every QUIET_READING_INTERVAL_S.
+        """
+        if not self.is_quiet() or self._motion_since_reading or self._last_reading is None:
+            return True
+        if time.monotonic() - self._last_reading >= QUIET_READING_INTERVAL_S:
+            return True
+        DUTY_CYCLE_SKIPPED.inc()
+        return False
+
+    def note_reading(self):
+        self._last_reading = time.monotonic()
+        self._motion_since_reading = False
+
+
+def duty_cycled_reader(hx, scheduler):
+    """
+    hx.read_sample for SampleHub.start_producer(), slowed down in quiet
+    hours: the HX711 is powered down between conversions taken
+    hx711_interval() apart, and powered up at once when motion ends the wait.
+    The first conversion after power-up waits for the chip to settle.
+    """
+
+    def read_sample():
+        interval = scheduler.hx711_interval()
+        if interval is not None:
+            hx.power_down()
+            scheduler.wait_for_wake(interval)
+            hx.power_up()
+        return hx.read_sample()
+
+    return read_sample
+
+
+# --- Benchmark ---
+#
+# Replays a usage trace through stability_scale_trigger's monitor pipeline
+# (the real MotionGate and gyro_source, a simulated gyroscope and a stand-in
+# reading that keeps the HX711 on for the reading's duration) on soak.py's
+# AcceleratedClock, once with an untrained profile (always full rate) and
+# once with the learned one.
+
+BENCH_REPLAY_DAYS = 1.0
+BENCH_SEED = 5
+# Expected pickups per hour on a synthetic day: meals, work hours, evening.
+BENCH_HOURLY_PICKUPS = (0.02, 0.02, 0.02, 0.02, 0.02, 0.05, 0.3, 1.5, 1.2, 0.8, 1.0, 0.8,
+                        1.5, 1.0, 0.8, 1.0, 0.8, 0.6, 1.2, 1.0, 0.6, 0.5, 0.2, 0.05)
+BENCH_PICKUP_S = (4.0, 15.0)  # Range of pickup durations
+BENCH_READING_S = 3.4  # HX711 on per triggered reading: settling plus TAKE_READING_DURATION_S
+BENCH_RECORD_LAG_S = 6.0  # Pickup end to the recorded reading (stability period plus reading)
+# Energy model, 5 V supply (the gyroscope draws the same either way and is left out).
+HX711_ACTIVE_MW = 25.0  # HX711 (~1.5 mA) plus a 1 kOhm bridge excited at ~4.3 V; ~0 powered down
+CPU_BUSY_MW = 600.0  # Pi Zero W with its core busy rather than idle
+PI_CPU_FACTOR = 10.0  # Assumed Pi Zero CPU seconds per CPU second measured here
+
+
+def _synthetic_pickups(rng, start_ts, end_ts):
+    pickups = []
+    hour_start = start_ts - start_ts % 3600
+    while hour_start < end_ts:
+        rate = BENCH_HOURLY_PICKUPS[time.localtime(hour_start).tm_hour]
+        t = hour_start + rng.expovariate(rate) * 3600
+        while t < hour_start + 3600:
+            if start_ts <= t < end_ts:
+                pickups.append((t, t + rng.uniform(*BENCH_PICKUP_S)))
+            t += rng.expovariate(rate) * 3600
+        hour_start += 3600
+    return pickups
+
+
+class _TraceGyro:
+    """mpu6050 stand-in: rotation while a pickup of the trace is in progress."""
+
+    def __init__(self, clock, pickups, rng, on_sample):
+        self.clock = clock
+        self.pickups = pickups
+        self.rng = rng
+        self.on_sample = on_sample
+        self.polls = 0
+        self._next = 0
+
+    def get_gyro_data(self):
+        self.polls += 1
+        self.on_sample()
+        now = self.clock.time()
+        while self._next < len(self.pickups) and self.pickups[self._next][1] <= now:
+            self._next += 1
+        if self._next < len(self.pickups) and self.pickups[self._next][0] <= now:
+            return {axis: self.rng.uniform(-80, 80) for axis in "xyz"}
+        return {axis: self.rng.gauss(0, 0.8) for axis in "xyz"}
+
+
+class _RecordingScheduler(DutyCycleScheduler):
+    """Remembers when motion was reported. With an untrained profile it never goes quiet."""
+
+    def __init__(self, profile):
+        super().__init__(profile)
+        self.motion = []
+
+    def note_motion(self, item=None):
+        self.motion.append(time.time())
+        super().note_motion(item)
+
+
+def _replay(pickups, duration_s, profile):
+    import random
+
+    import soak
+    import stability_scale_trigger as trigger
+
+    clock = soak.AcceleratedClock()
+    clock.install()
+    try:
+        start = clock.time()
+        trace = [(start + a, start + b) for a, b in pickups]
+        scheduler = _RecordingScheduler(profile)
+        result = {"motion": scheduler.motion, "readings": []}
+        monitor = None
+
+        def on_sample():
+            if clock.elapsed() >= duration_s:
+                monitor.stop()
+
+        def reading():
+            result["readings"].append(clock.time())
+            time.sleep(BENCH_READING_S)
+            return 100.0
+
+        gyro = _TraceGyro(clock, trace, random.Random(BENCH_SEED), on_sample)
+        saved = trigger.take_reading, trigger.scheduler
+        trigger.take_reading, trigger.scheduler = reading, scheduler
+        try:
+            monitor = trigger.monitor_pipeline(gyro, scheduler)
+            cpu = time.process_time()
+            monitor.run_inline()
+            result["cpu_s"] = time.process_time() - cpu
+        finally:
+            trigger.take_reading, trigger.scheduler = saved
+        result["polls"] = gyro.polls
+        result["hx711_s"] = len(result["readings"]) * BENCH_READING_S
+        result["energy_wh"] = (HX711_ACTIVE_MW * result["hx711_s"]
+                               + CPU_BUSY_MW * PI_CPU_FACTOR * result["cpu_s"]) / 3600 / 1000
+        # Per pickup: first motion poll after it started, first reading after it ended.
+        result["detect"], result["after"], result["missed"] = [], [], 0
+        for begin, end in trace:
+            seen = [t for t in result["motion"] if begin <= t <= end]
+            if seen:
+                result["detect"].append(seen[0] - begin)
+            else:
+                result["missed"] += 1
+            later = [t for t in result["readings"] if t >= end]
+            if later:
+                result["after"].append(later[0] - end)
+        return result
+    finally:
+        clock.uninstall()
+
+
+def _latency(values):
+    if not values:
+        return "-"
+    ordered = sorted(values)
+    return "%.2f / %.2f / %.2f" % (ordered[len(ordered) // 2], ordered[min(int(0.95 * len(ordered)),
+                                                                            len(ordered) - 1)], ordered[-1])
+
+
+def _bench(db_path=None, days=BENCH_REPLAY_DAYS):
+    import os
+    import random
+    import tempfile
+
+    from history_store import HistoryStore
+
+    logging.getLogger("drinksync").setLevel(logging.WARNING)
+    now = time.time()
+    if db_path is None:
+        # Synthetic history: LEARN_DAYS recorded, the next 'days' replayed.
+        rng = random.Random(BENCH_SEED)
+        store = HistoryStore(os.path.join(tempfile.mkdtemp(), "bench_history.db"))
+        history = _synthetic_pickups(rng, now - LEARN_DAYS * DAY_S, now)
+        store.record_readings([(end + BENCH_RECORD_LAG_S, 200.0, 20.0, None) for _, end in history])
+        profile = ActivityProfile.from_history(store, now=now + BENCH_RECORD_LAG_S)
+        pickups = [(a - now, b - now) for a, b in _synthetic_pickups(rng, now, now + days * DAY_S)]
+        source = "%d days of synthetic history" % LEARN_DAYS
+    else:
+        # Recorded history: learn from all but the last 'days' days, replay
+        # those shifted by whole days so the hours line up with the clock.
+        store = HistoryStore(db_path)
+        times = store.activity_times(0, now, ACTIVITY_MIN_INTAKE_G)
+        if not times:
+            print("No activity recorded in %s" % db_path)
+            return
+        replay_start = times[-1] - days * DAY_S
+        profile = ActivityProfile.from_history(store, now=replay_start)
+        shift = math.ceil((now - replay_start) / DAY_S) * DAY_S
+        pickups = [(ts + shift - BENCH_RECORD_LAG_S - BENCH_PICKUP_S[0] - now, ts + shift - BENCH_RECORD_LAG_S - now)
+                   for ts in times if ts >= replay_start]
+        pickups = [(a, b) for a, b in pickups if a >= 0]
+        days = (max(b for _, b in pickups) + 60) / DAY_S if pickups else days
+        source = "%s (%.1f days)" % (db_path, profile.days)
+    store.close()
+
+    print("Learned from %s; quiet hours %s (%d h)" % (source, format_hours(profile.quiet_hours()),
+                                                      len(profile.quiet_hours())))
+    print("Replaying %.1f day(s), %d pickups...\n" % (days, len(pickups)))
+    full = _replay(pickups, days * DAY_S, ActivityProfile())
+    cycled = _replay(pickups, days * DAY_S, profile)
+
+    def change(a, b):
+        return "%+.0f%%" % ((b - a) / a * 100) if a else "-"
+
+    print("%-42s %16s %16s %8s" % ("", "always full", "duty-cycled", "change"))
+    for label, key, fmt in (("gyro polls", "polls", "%d"), ("readings", "readings", None),
+                            ("CPU time here (s)", "cpu_s", "%.1f"), ("HX711 on (h)", "hx711_s", None),
+                            ("energy, model (Wh)", "energy_wh", "%.3f")):
+        a, b = full[key], cycled[key]
+        if key == "readings":
+            a, b, fmt = len(a), len(b), "%d"
+        elif key == "hx711_s":
+            a, b, fmt = a / 3600, b / 3600, "%.2f"
+        print("%-42s %16s %16s %8s" % (label, fmt % a, fmt % b, change(a, b)))
+    print("%-42s %16s %16s" % ("pickup to motion seen (s) p50/p95/max", _latency(full["detect"]),
+                               _latency(cycled["detect"])))
+    print("%-42s %16s %16s" % ("put-back to reading (s) p50/p95/max", _latency(full["after"]),
+                               _latency(cycled["after"])))
+    print("%-42s %16d %16d" % ("pickups not seen by the gyro", full["missed"], cycled["missed"]))
+    print("\nEnergy model: HX711 and bridge %.0f mW while on, CPU %.0f mW busy x %.0f (assumed Pi Zero "
+          "slowdown)." % (HX711_ACTIVE_MW, CPU_BUSY_MW, PI_CPU_FACTOR))
+
+
+def _show_profile(db_path):
+    from history_store import HISTORY_DB, HistoryStore
+
+    store = HistoryStore(db_path or HISTORY_DB)
+    try:
+        print(ActivityProfile.from_history(store).format())
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "profile":
+        _show_profile(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif command == "bench":
+        _bench(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        print("Usage: python3 duty_cycle.py profile [history.db] | bench [history.db]")
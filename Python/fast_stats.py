@@ -0,0 +1,93 @@
+# File: fast_stats.py
+#
+# Median and mean for the short sample windows the scale works with (5
+# conversions per get_weight(), a few dozen per reading), without NumPy.
+#
+# For a handful of floats, sorted() is ~40x faster than np.median(), which
+# spends ~20 us converting the list and dispatching, and importing NumPy adds
+# ~0.1 s to start-up here (about a second on a Pi Zero). Lists longer than
+# SMALL_WINDOW, and anything that already is a NumPy array, go to NumPy
+# (imported on first use), whose partition beats a full sort there.
+#
+# Usage:
+#   python3 fast_stats.py bench    # pure Python vs NumPy by window size
+
+import sys
+
+# --- Configuration ---
+SMALL_WINDOW = 256  # Largest list handled without NumPy (see bench; crossover is ~300-500)
+
+
+def median(values):
+    """
+    Median of a sequence or iterable of numbers.
+
+    Args:
+        values: Numbers; an even count gives the mean of the middle two.
+
+    Returns:
+        float
+    """
+    if hasattr(values, "dtype") or (hasattr(values, "__len__") and len(values) > SMALL_WINDOW):
+        import numpy as np
+
+        if len(values) == 0:
+            raise ValueError("median() of an empty sequence")
+        return float(np.median(values))
+    ordered = sorted(values)
+    n = len(ordered)
+    if n == 0:
+        raise ValueError("median() of an empty sequence")
+    mid = n // 2
+    if n % 2:
+        return float(ordered[mid])
+    return (ordered[mid - 1] + ordered[mid]) / 2.0
+
+
+def mean(values):
+    """
+    Arithmetic mean of a sequence or iterable of numbers.
+
+    Args:
+        values: Numbers.
+
+    Returns:
+        float
+    """
+    if hasattr(values, "dtype"):
+        if len(values) == 0:
+            raise ValueError("mean() of an empty sequence")
+        return float(values.mean())
+    if not hasattr(values, "__len__"):
+        values = list(values)
+    if not values:
+        raise ValueError("mean() of an empty sequence")
+    # sum() beats np.mean() on lists of any size; the conversion dominates
+    return sum(values) / len(values)
+
+
+# --- Benchmark ---
+
+def _bench():
+    import random
+    import timeit
+
+    import numpy as np
+
+    rng = random.Random(3)
+    print(f"{'window': >8} {'median()': >10} {'np.median': >10} {'mean()': >10} {'np.mean': >10}   (us per call, lists)")
+    for n in (5, 15, 40, 200, SMALL_WINDOW, 2000, 10000):
+        values = [rng.gauss(480.0, 0.5) for _ in range(n)]
+        assert abs(median(values) - float(np.median(values))) < 1e-9
+        assert abs(mean(values) - float(np.mean(values))) < 1e-6
+        number = max(20, 20000 // n)
+        row = [timeit.timeit(lambda: fn(values), number=number) / number * 1e6
+               for fn in (median, np.median, mean, np.mean)]
+        print(f"{n: >8} {row[0]: >10.1f} {row[1]: >10.1f} {row[2]: >10.1f} {row[3]: >10.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        _bench()
+    else:
+        print("Usage: python3 fast_stats.py bench")
@@ -0,0 +1,417 @@
+# File: gpio_backend.py
+#
+# GPIO access for the HX711 driver.
+#
+# HX711 talks to its two pins through a backend instead of calling RPi.GPIO
+# directly, so the bit-bang loop can run on faster register access and the
+# driver can be exercised without a Pi:
+#
+#   RPiGpioBackend - RPi.GPIO, as before (default).
+#   GpioMemBackend - BCM2835/BCM2711 GPIO registers memory-mapped from
+#                    /dev/gpiomem (Pi Zero to Pi 4; no root needed, user in
+#                    group gpio). A clock pulse is two 32-bit stores and a
+#                    bit read is one load, with no library call in between.
+#
+# Every backend implements shift_in(), which clocks a whole conversion out in
+# one call with the loop state in local variables. On a Pi Zero the per-bit
+# method calls of the old loop made the PD_SCK high time depend on Python
+# overhead; the HX711 powers down if PD_SCK stays high for 60 us.
+#
+# Register access is fast enough to break the HX711's lower bound instead:
+# PD_SCK must stay high (T3) and low (T4) for at least 0.2 us, and on a Pi 3
+# or 4 two Python stores can land closer together than that. GpioMemBackend
+# therefore holds each level with reads of the level register: a load from
+# the GPIO block does not return until the bus has answered, and the next
+# store cannot issue before it does. The number of reads is calibrated when
+# the backend is created, to PULSE_MARGIN times the minimum at the measured
+# cost of one read (including its interpreter overhead). Expected margins
+# (estimates from interpreter speed, not measured on every model):
+#   Pi Zero / 1 (ARM11)      a read costs well over 0.2 us, so the minimum
+#                            of one read per level already clears T3/T4
+#   Pi 3 / 4 (Cortex-A53/A72) a read costs about 0.1 us; calibration picks
+#                            several, for about PULSE_MARGIN x 0.2 us per level
+# Calibration runs at whatever clock the CPU governor has set; the margin
+# covers a later speed-up of up to PULSE_MARGIN times. `bench` prints the
+# read count and the resulting pulse width on the machine it runs on.
+#
+# GpioMemBackend accepts any sequence of 32-bit registers as its region, e.g.
+# an anonymous mmap or FakeGpioRegion, which simulates an HX711 on the pins.
+#
+# Usage:
+#   python3 gpio_backend.py bench    # clocks per second and conversion cost, no hardware
+
+import math
+import mmap
+import os
+import sys
+import time
+
+# --- Configuration ---
+DEFAULT_BACKEND = "rpi"  # "rpi" or "gpiomem" (see BACKENDS)
+GPIOMEM_PATH = "/dev/gpiomem"
+PD_SCK_MIN_PULSE_NS = 200  # HX711 T3/T4: shortest PD_SCK high and low time
+PULSE_MARGIN = 3.0  # Calibrated pulse width, as a multiple of PD_SCK_MIN_PULSE_NS
+
+
+class GpioBackend:
+    """
+    The pin operations HX711 needs. Pins are BCM numbers.
+    """
+
+    def setup_output(self, pin):
+        raise NotImplementedError
+
+    def setup_input(self, pin):
+        raise NotImplementedError
+
+    def write(self, pin, value):
+        raise NotImplementedError
+
+    def read(self, pin):
+        raise NotImplementedError
+
+    def shift_in(self, clock_pin, data_pin, bits):
+        """
+        Clocks 'bits' pulses on clock_pin, sampling data_pin after each
+        falling edge, and returns the bits MSB first as one integer.
+        """
+        value = 0
+        for _ in range(bits):
+            self.write(clock_pin, 1)
+            self.write(clock_pin, 0)
+            value = (value << 1) | self.read(data_pin)
+        return value
+
+    def cleanup(self):
+        pass
+
+
+class RPiGpioBackend(GpioBackend):
+    def __init__(self):
+        import RPi.GPIO as GPIO  # Only importable on a Pi
+
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+
+    def setup_output(self, pin):
+        self.GPIO.setup(pin, self.GPIO.OUT)
+
+    def setup_input(self, pin):
+        self.GPIO.setup(pin, self.GPIO.IN)
+
+    def write(self, pin, value):
+        self.GPIO.output(pin, value)
+
+    def read(self, pin):
+        return self.GPIO.input(pin)
+
+    def shift_in(self, clock_pin, data_pin, bits):
+        output, read = self.GPIO.output, self.GPIO.input
+        value = 0
+        for _ in range(bits):
+            output(clock_pin, 1)
+            output(clock_pin, 0)
+            value = (value << 1) | read(data_pin)
+        return value
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class GpioMemBackend(GpioBackend):
+    """
+    Direct register access to GPIO bank 0 (pins 0-31).
+
+    Args:
+        region: Sequence of 32-bit registers; by default /dev/gpiomem mapped
+            and cast to unsigned ints.
+    """
+
+    BLOCK_SIZE = 4096
+    # Register indices (byte offset / 4) in the BCM2835 GPIO block.
+    GPFSEL0 = 0x00 // 4  # Function select, 3 bits per pin, 10 pins per register
+    GPSET0 = 0x1C // 4  # Write 1 bits to drive pins high
+    GPCLR0 = 0x28 // 4  # Write 1 bits to drive pins low
+    GPLEV0 = 0x34 // 4  # Pin levels
+    FSEL_INPUT = 0
+    FSEL_OUTPUT = 1
+
+    def __init__(self, region=None, path=GPIOMEM_PATH):
+        self._mmap = None
+        self._view = None
+        if region is None:
+            fd = os.open(path, os.O_RDWR | os.O_SYNC)
+            try:
+                self._mmap = mmap.mmap(fd, self.BLOCK_SIZE, mmap.MAP_SHARED,
+                                       mmap.PROT_READ | mmap.PROT_WRITE)
+            finally:
+                os.close(fd)
+            self._view = memoryview(self._mmap)
+            region = self._view.cast("I")
+        self.regs = region
+        self._outputs = set()
+        self.hold_reads = 1
+        self.calibrate_pulse()
+
+    @staticmethod
+    def _check_pin(pin):
+        if not 0 <= pin <= 31:
+            raise ValueError("GpioMemBackend supports BCM pins 0-31, not %d" % pin)
+
+    def _select(self, pin, function):
+        self._check_pin(pin)
+        index, shift = self.GPFSEL0 + pin // 10, (pin % 10) * 3
+        self.regs[index] = (self.regs[index] & ~(7 << shift) & 0xFFFFFFFF) | (function << shift)
+
+    def setup_output(self, pin):
+        self._select(pin, self.FSEL_OUTPUT)
+        self._outputs.add(pin)
+
+    def setup_input(self, pin):
+        self._select(pin, self.FSEL_INPUT)
+
+    def write(self, pin, value):
+        self.regs[self.GPSET0 if value else self.GPCLR0] = 1 << pin
+
+    def read(self, pin):
+        return (self.regs[self.GPLEV0] >> pin) & 1
+
+    def calibrate_pulse(self, samples=2000, rounds=5):
+        """
+        Sets hold_reads, the level-register reads that hold each PD_SCK level
+        for PULSE_MARGIN * PD_SCK_MIN_PULSE_NS.
+
+        A read is timed as one iteration of the hold loop, loop overhead
+        included, since that is what holds the level; the fastest of
+        'rounds' rounds counts. An interruption can only slow a round down,
+        so it cannot inflate the hold towards the 60 us power-down.
+
+        Returns:
+            float: Measured cost of one read in nanoseconds.
+        """
+        regs, lev_reg = self.regs, self.GPLEV0
+        loops = range(samples)
+        fastest_ns = None
+        for _ in range(rounds):
+            start = time.perf_counter_ns()
+            for _ in loops:
+                regs[lev_reg]
+            elapsed_ns = time.perf_counter_ns() - start
+            fastest_ns = elapsed_ns if fastest_ns is None else min(fastest_ns, elapsed_ns)
+        read_ns = max(1.0, fastest_ns / samples)
+        self.hold_reads = max(1, math.ceil(PD_SCK_MIN_PULSE_NS * PULSE_MARGIN / read_ns))
+        return read_ns
+
+    def shift_in(self, clock_pin, data_pin, bits):
+        regs, mask = self.regs, 1 << clock_pin
+        set_reg, clr_reg, lev_reg = self.GPSET0, self.GPCLR0, self.GPLEV0
+        hold = range(self.hold_reads)
+        value = 0
+        for _ in range(bits):
+            regs[set_reg] = mask
+            for _ in hold:  # T3: each read completes before the clear can issue
+                regs[lev_reg]
+            regs[clr_reg] = mask
+            for _ in hold:  # T4, ending with the sample of DOUT
+                level = regs[lev_reg]
+            value = (value << 1) | ((level >> data_pin) & 1)
+        return value
+
+    def cleanup(self):
+        # Like RPi.GPIO.cleanup(): return the pins we drove to inputs.
+        for pin in self._outputs:
+            self._select(pin, self.FSEL_INPUT)
+        self._outputs.clear()
+        if self._mmap is not None:
+            self.regs.release()
+            self._view.release()
+            self._mmap.close()
+            self._mmap = None
+
+
+# Backends by name, for create_backend(). Simulations (soak.py) add their own.
+BACKENDS = {
+    "rpi": RPiGpioBackend,
+    "gpiomem": GpioMemBackend,
+}
+
+
+def create_backend(name=None):
+    """Returns a backend by name (a key of BACKENDS; DEFAULT_BACKEND if None)."""
+    name = name or DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError("Unknown GPIO backend '%s'" % name)
+    return BACKENDS[name]()
+
+
+# --- Fakes ---
+
+class FakeGpioRegion:
+    """
+    Register block for GpioMemBackend with an HX711 on (clock_pin, data_pin).
+
+    Like the real chip, DOUT goes low when a conversion is ready, each
+    rising PD_SCK edge shifts out the next bit (MSB first), and the pulses
+    after the 24th select the gain and pull DOUT high. The next conversion
+    is ready once DOUT has been polled READY_POLLS times without another
+    pulse (more than shift_in() reads between two pulses).
+
+    Attributes:
+        value (int): Signed 24-bit reading returned by every conversion.
+        pulses (int): PD_SCK pulses in the current conversion.
+        conversions (int): Conversions clocked out completely.
+    """
+
+    READY_POLLS = 64
+
+    def __init__(self, clock_pin, data_pin, value=0):
+        self.words = [0] * (GpioMemBackend.BLOCK_SIZE // 4)
+        self.clock_mask = 1 << clock_pin
+        self.data_mask = 1 << data_pin
+        self.value = value
+        self.pulses = 0
+        self.conversions = 0
+        self._clock_high = False
+        self._idle_polls = 0
+        self._shift = 0
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, index):
+        if index == GpioMemBackend.GPLEV0 and self._poll():
+            self.words[index] &= ~self.data_mask  # Next conversion ready
+        return self.words[index]
+
+    def _poll(self):
+        # Counts a DOUT poll; True when it ends the conversion clocked out.
+        self._idle_polls += 1
+        if self.pulses >= 25 and self._idle_polls > self.READY_POLLS:
+            self.conversions += 1
+            self.pulses = 0
+            return True
+        return False
+
+    def __setitem__(self, index, word):
+        if index == GpioMemBackend.GPSET0:
+            if word & self.clock_mask and not self._clock_high:
+                self._clock_high = True
+                self._rising_edge()
+            return
+        if index == GpioMemBackend.GPCLR0:
+            if word & self.clock_mask:
+                self._clock_high = False
+            return
+        self.words[index] = word
+
+    def _rising_edge(self):
+        if self.pulses == 0:
+            self._shift = self.value & 0xFFFFFF
+        self.pulses += 1
+        self._idle_polls = 0
+        if self.pulses <= 24:
+            bit = (self._shift >> (24 - self.pulses)) & 1
+        else:
+            bit = 1
+        lev = GpioMemBackend.GPLEV0
+        self.words[lev] = (self.words[lev] | self.data_mask) if bit else (self.words[lev] & ~self.data_mask)
+
+
+# --- Benchmark ---
+
+def _bench():
+    from hx711 import HX711
+
+    clock_pin, data_pin = 6, 5
+    iterations = 20000
+
+    # Raw register cost: an anonymous mapping stands in for /dev/gpiomem.
+    anonymous = mmap.mmap(-1, GpioMemBackend.BLOCK_SIZE)
+    view = memoryview(anonymous)
+    backend = GpioMemBackend(view.cast("I"))
+    backend.setup_output(clock_pin)
+    backend.setup_input(data_pin)
+
+    start = time.perf_counter()
+    for _ in range(iterations // 27):
+        GpioBackend.shift_in(backend, clock_pin, data_pin, 27)
+    per_bit = (time.perf_counter() - start) / (iterations // 27 * 27)
+    start = time.perf_counter()
+    for _ in range(iterations // 27):
+        backend.shift_in(clock_pin, data_pin, 27)
+    fast = (time.perf_counter() - start) / (iterations // 27 * 27)
+    print(f"mmap registers, write/write/read calls: {1 / per_bit:10.0f} clocks/s ({per_bit * 1e9:6.0f} ns per bit)")
+    print(f"mmap registers, shift_in():             {1 / fast:10.0f} clocks/s ({fast * 1e9:6.0f} ns per bit)")
+
+    # Store-to-store time is the PD_SCK high time: at least 0.2 us, and far
+    # below the 60 us that powers the chip down.
+    read_ns = backend.calibrate_pulse()
+    regs, mask, hold = backend.regs, 1 << clock_pin, range(backend.hold_reads)
+    lev_reg, best, worst = GpioMemBackend.GPLEV0, None, 0
+    for _ in range(iterations):
+        t0 = time.perf_counter_ns()
+        regs[GpioMemBackend.GPSET0] = mask
+        for _ in hold:
+            regs[lev_reg]
+        regs[GpioMemBackend.GPCLR0] = mask
+        high = time.perf_counter_ns() - t0
+        worst = max(worst, high)
+        best = high if best is None else min(best, high)
+    print(f"hold: {backend.hold_reads} level reads per PD_SCK level at {read_ns:.0f} ns per read "
+          f"(target {PULSE_MARGIN:g} x {PD_SCK_MIN_PULSE_NS} ns)")
+    print(f"PD_SCK high time (set, hold, clear; {iterations} pulses): best {best / 1e3:.2f} us, "
+          f"worst {worst / 1e3:.2f} us")
+    backend.cleanup()
+    regs.release()
+    view.release()
+    anonymous.close()
+
+    # Whole conversions through HX711 against the simulated chip: the old
+    # per-bit/per-byte path and the new one must agree for every format.
+    region = FakeGpioRegion(clock_pin, data_pin)
+    hx = HX711(data_pin, clock_pin, gpio=GpioMemBackend(region))
+    hx.MAX_DROP_PERIODS = None
+    checked = 0
+    for gain in (128, 64, 32):
+        for byte_format in ("MSB", "LSB"):
+            for bit_format in ("MSB", "LSB"):
+                hx.set_gain(gain)
+                hx.set_reading_format(byte_format, bit_format)
+                for value in (0, 1, -1, 123456, -123456, 0x7FFFFF, -0x800000):
+                    region.value = value
+                    legacy = _legacy_read(hx)
+                    region.value = value
+                    assert hx.read_long() == legacy, (gain, byte_format, bit_format, value)
+                    checked += 1
+    print(f"HX711 decoding matches the per-bit path for {checked} gain/format/value combinations")
+
+    hx.set_gain(128)
+    hx.set_reading_format("MSB", "MSB")
+    region.value = 54321
+    conversions = 2000
+    for label, read in (("per-bit path (readNextByte)", lambda: _legacy_read(hx)),
+                        ("shift_in path (read_long)", hx.read_long)):
+        start = time.perf_counter()
+        for _ in range(conversions):
+            read()
+        elapsed = (time.perf_counter() - start) / conversions
+        print(f"{label: <30} {elapsed * 1e6:8.1f} us per conversion (simulated chip)")
+
+
+def _legacy_read(hx):
+    # The driver's original read: per-bit method calls and format checks.
+    hx.waitForReady(None)
+    hx.recordConversion(True)
+    dataBytes = [hx.readNextByte() for _ in range(3)]
+    for _ in range(hx.GAIN):
+        hx.readNextBit()
+    if hx.byte_format == "LSB":
+        dataBytes.reverse()
+    return hx.convertFromTwosComplement24bit((dataBytes[0] << 16) | (dataBytes[1] << 8) | dataBytes[2])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        _bench()
+    else:
+        print("Usage: python3 gpio_backend.py bench")
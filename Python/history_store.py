@@ -0,0 +1,347 @@
+# File: history_store.py
+#
+# On-device history of readings and detected events, kept in SQLite.
+#
+# Every reading carries the intake it represents (grams drunk since the
+# previous reading). Hourly and daily rollup rows are updated in the same
+# transaction as the insert, and each rollup row also stores running totals
+# (prefix sums) up to and including its bucket. A total over any range of
+# whole buckets is then the difference of two running totals: two index
+# lookups, however many years of rows the database holds. Only the partial
+# hours at the edges of a range touch raw rows.
+#
+# Readings normally arrive in time order, so the running total of a new
+# bucket is the previous one plus the new intake. A late reading (e.g. synced
+# from elsewhere) also shifts the running totals of every later bucket.
+#
+# Usage:
+#   python3 history_store.py today           # intake so far today
+#   python3 history_store.py bench [years]   # insert/query benchmark on a temporary database
+
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+log = logging.getLogger("drinksync.history")
+
+# --- Configuration ---
+HISTORY_DB = "drinksync_history.db"
+HOUR_S = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS readings (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    weight REAL NOT NULL,
+    intake REAL NOT NULL DEFAULT 0,
+    profile TEXT
+);
+CREATE INDEX IF NOT EXISTS readings_ts ON readings (ts);
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+CREATE TABLE IF NOT EXISTS rollup_hourly (
+    bucket INTEGER PRIMARY KEY,  -- hours since the epoch
+    intake REAL NOT NULL,
+    readings INTEGER NOT NULL,
+    cum_intake REAL NOT NULL,    -- sum of intake over all buckets <= this one
+    cum_readings INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rollup_daily (
+    bucket INTEGER PRIMARY KEY,  -- local date as date.toordinal()
+    intake REAL NOT NULL,
+    readings INTEGER NOT NULL,
+    cum_intake REAL NOT NULL,
+    cum_readings INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def hour_bucket(ts):
+    return int(ts // HOUR_S)
+
+
+def day_bucket(ts):
+    # Local calendar day, matching the app's daily reset.
+    return datetime.date.fromtimestamp(ts).toordinal()
+
+
+class HistoryStore:
+    """
+    Readings, events and their rollups in one SQLite file.
+
+    Safe to share between threads; every call takes the store's lock.
+    """
+
+    def __init__(self, path=HISTORY_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets readers (sync, queries) run alongside the writer; NORMAL
+        # sync keeps the database consistent across a power cut on the Pi.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        # Random identity of this database, so a peer that tracks sequence
+        # numbers (history_sync.py) notices when it is replaced and the
+        # numbering starts over.
+        self._db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('store_id', ?)",
+                         (uuid.uuid4().hex,))
+        self.store_id = self._db.execute("SELECT value FROM meta WHERE key = 'store_id'").fetchone()[0]
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # --- Writing ---
+
+    def record_reading(self, weight, intake=0.0, ts=None, profile=None):
+        """
+        Stores one reading and updates the rollups.
+
+        Args:
+            weight (float): The reading in grams.
+            intake (float): Grams drunk since the previous reading.
+            ts (float): Wall-clock time (time.time()); now if omitted.
+            profile (str): Container profile in use, if any.
+
+        Returns:
+            int: The reading's sequence number.
+        """
+        return self.record_readings([(time.time() if ts is None else ts, weight, intake, profile)])
+
+    def record_readings(self, rows):
+        """Stores (ts, weight, intake, profile) rows in one transaction. Returns the last seq."""
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO readings (ts, weight, intake, profile) VALUES (?, ?, ?, ?)", rows)
+            # Aggregate per bucket first: one rollup update per touched bucket.
+            hours, days = {}, {}
+            for ts, _, intake, _ in rows:
+                for buckets, bucket in ((hours, hour_bucket(ts)), (days, day_bucket(ts))):
+                    total = buckets.get(bucket)
+                    buckets[bucket] = (intake, 1) if total is None else (total[0] + intake, total[1] + 1)
+            for table, buckets in (("rollup_hourly", hours), ("rollup_daily", days)):
+                for bucket in sorted(buckets):
+                    self._add_to_rollup(table, bucket, *buckets[bucket])
+            return self._db.execute("SELECT max(seq) FROM readings").fetchone()[0]
+
+    def _add_to_rollup(self, table, bucket, intake, count):
+        db = self._db
+        row = db.execute("SELECT bucket, cum_intake, cum_readings FROM %s "
+                         "ORDER BY bucket DESC LIMIT 1" % table).fetchone()
+        if row is None or bucket > row[0]:
+            # Common case: a new, latest bucket.
+            cum_intake, cum_readings = (row[1], row[2]) if row else (0.0, 0)
+            db.execute("INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % table,
+                       (bucket, intake, count, cum_intake + intake, cum_readings + count))
+            return
+        if bucket < row[0]:
+            # Late reading: every later running total grows too.
+            db.execute("UPDATE %s SET cum_intake = cum_intake + ?, cum_readings = cum_readings + ? "
+                       "WHERE bucket > ?" % table, (intake, count, bucket))
+        updated = db.execute("UPDATE %s SET intake = intake + ?, readings = readings + ?, "
+                             "cum_intake = cum_intake + ?, cum_readings = cum_readings + ? "
+                             "WHERE bucket = ?" % table, (intake, count, intake, count, bucket))
+        if updated.rowcount == 0:
+            before = db.execute("SELECT cum_intake, cum_readings FROM %s WHERE bucket < ? "
+                                "ORDER BY bucket DESC LIMIT 1" % table, (bucket,)).fetchone()
+            cum_intake, cum_readings = before if before else (0.0, 0)
+            db.execute("INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % table,
+                       (bucket, intake, count, cum_intake + intake, cum_readings + count))
+
+    def record_event(self, event_type, ts=None, **fields):
+        """Stores a detected event (e.g. "stable_period") with JSON-serialisable fields."""
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO events (ts, type, data) VALUES (?, ?, ?)",
+                (time.time() if ts is None else ts, event_type,
+                 json.dumps(fields, separators=(",", ":")) if fields else None))
+            return cursor.lastrowid
+
+    # --- Queries ---
+
+    def _cum(self, table, bucket):
+        """(cum_intake, cum_readings) over all buckets <= 'bucket'."""
+        row = self._db.execute("SELECT cum_intake, cum_readings FROM %s WHERE bucket <= ? "
+                               "ORDER BY bucket DESC LIMIT 1" % table, (bucket,)).fetchone()
+        return row if row else (0.0, 0)
+
+    def _raw_total(self, start_ts, end_ts):
+        row = self._db.execute("SELECT coalesce(sum(intake), 0), count(*) FROM readings "
+                               "WHERE ts >= ? AND ts < ?", (start_ts, end_ts)).fetchone()
+        return row[0], row[1]
+
+    def total(self, start_ts, end_ts):
+        """
+        Intake and reading count in [start_ts, end_ts).
+
+        Whole hours come from the hourly running totals; only the partial
+        hours at either end are summed from raw readings.
+
+        Returns:
+            tuple: (intake_grams, readings)
+        """
+        with self._lock:
+            first_hour = math.ceil(start_ts / HOUR_S)  # First hour starting at or after start_ts
+            end_hour = int(end_ts // HOUR_S)  # Hour containing end_ts (excluded)
+            if first_hour >= end_hour:
+                return self._raw_total(start_ts, end_ts)
+            hi = self._cum("rollup_hourly", end_hour - 1)
+            lo = self._cum("rollup_hourly", first_hour - 1)
+            head = self._raw_total(start_ts, first_hour * HOUR_S)
+            tail = self._raw_total(end_hour * HOUR_S, end_ts)
+            return (hi[0] - lo[0] + head[0] + tail[0], hi[1] - lo[1] + head[1] + tail[1])
+
+    def day_total(self, day=None):
+        """(intake_grams, readings) for a local date (datetime.date; today if omitted)."""
+        bucket = (day or datetime.date.today()).toordinal()
+        with self._lock:
+            row = self._db.execute("SELECT intake, readings FROM rollup_daily WHERE bucket = ?",
+                                   (bucket,)).fetchone()
+        return row if row else (0.0, 0)
+
+    def days_total(self, first_day, last_day):
+        """(intake_grams, readings) over local dates first_day..last_day inclusive."""
+        with self._lock:
+            hi = self._cum("rollup_daily", last_day.toordinal())
+            lo = self._cum("rollup_daily", first_day.toordinal() - 1)
+        return hi[0] - lo[0], hi[1] - lo[1]
+
+    def hourly(self, start_ts, end_ts):
+        """[(hour_start_ts, intake, readings), ...] for hours overlapping [start_ts, end_ts)."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT bucket, intake, readings FROM rollup_hourly WHERE bucket >= ? AND bucket < ? "
+                "ORDER BY bucket", (hour_bucket(start_ts), math.ceil(end_ts / HOUR_S))).fetchall()
+        return [(bucket * HOUR_S, intake, count) for bucket, intake, count in rows]
+
+    def daily(self, first_day, last_day):
+        """[(date, intake, readings), ...] for local dates first_day..last_day inclusive."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT bucket, intake, readings FROM rollup_daily WHERE bucket BETWEEN ? AND ? "
+                "ORDER BY bucket", (first_day.toordinal(), last_day.toordinal())).fetchall()
+        return [(datetime.date.fromordinal(bucket), intake, count) for bucket, intake, count in rows]
+
+    def activity_times(self, start_ts, end_ts, min_intake=0.0):
+        """
+        When the scale was used in [start_ts, end_ts): the times of readings
+        with at least 'min_intake' grams of intake and of events, oldest first.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT ts FROM readings WHERE ts >= ? AND ts < ? AND intake >= ? "
+                "UNION ALL SELECT ts FROM events WHERE ts >= ? AND ts < ? ORDER BY ts",
+                (start_ts, end_ts, min_intake, start_ts, end_ts)).fetchall()
+        return [ts for ts, in rows]
+
+    def last_reading(self):
+        """The newest reading as a dict, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT seq, ts, weight, intake, profile FROM readings "
+                                   "ORDER BY seq DESC LIMIT 1").fetchone()
+        if row is None:
+            return None
+        return dict(zip(("seq", "ts", "weight", "intake", "profile"), row))
+
+    def readings_since(self, seq, limit=1000):
+        """Readings with a sequence number above 'seq', oldest first: [(seq, ts, weight, intake, profile)]."""
+        with self._lock:
+            return self._db.execute("SELECT seq, ts, weight, intake, profile FROM readings "
+                                    "WHERE seq > ? ORDER BY seq LIMIT ?", (seq, limit)).fetchall()
+
+    def events_since(self, seq, limit=1000):
+        """Events with a sequence number above 'seq', oldest first: [(seq, ts, type, fields)]."""
+        with self._lock:
+            rows = self._db.execute("SELECT seq, ts, type, data FROM events "
+                                    "WHERE seq > ? ORDER BY seq LIMIT ?", (seq, limit)).fetchall()
+        return [(s, ts, t, json.loads(d) if d else {}) for s, ts, t, d in rows]
+
+
+# --- Benchmark ---
+
+def _bench(years=3.0):
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), "bench_history.db")
+    store = HistoryStore(path)
+    # A reading every 5 minutes while awake (16 h/day), 10-40 g each.
+    end = time.time()
+    start = end - years * 365 * 86400
+    rows = []
+    ts = start
+    rng = random.Random(1)
+    while ts < end:
+        if (ts % 86400) < 16 * HOUR_S:
+            rows.append((ts, 500.0, rng.uniform(10, 40), None))
+        ts += 300
+    print(f"{len(rows):,} readings over {years:g} years")
+
+    t0 = time.perf_counter()
+    batch = 1000
+    for i in range(0, len(rows), batch):
+        store.record_readings(rows[i:i + batch])
+    elapsed = time.perf_counter() - t0
+    print(f"batched insert ({batch}/txn):  {len(rows) / elapsed:10,.0f} readings/s")
+
+    t0 = time.perf_counter()
+    single = 500
+    for i in range(single):
+        store.record_reading(500.0, 25.0, ts=end + i * 60)
+    print(f"single insert (1/txn):      {(time.perf_counter() - t0) / single * 1e3:10.3f} ms/reading")
+
+    t0 = time.perf_counter()
+    store.record_reading(500.0, 25.0, ts=start + 3600.5)
+    print(f"late insert (3 years back): {(time.perf_counter() - t0) * 1e3:10.3f} ms")
+
+    queries = 200
+    ranges = []
+    for _ in range(queries):
+        a = rng.uniform(start, end)
+        ranges.append((a, rng.uniform(a, end)))
+    t0 = time.perf_counter()
+    totals = [store.total(a, b) for a, b in ranges]
+    rollup_ms = (time.perf_counter() - t0) / queries * 1e3
+    t0 = time.perf_counter()
+    with store._lock:
+        scans = [store._raw_total(a, b) for a, b in ranges[:20]]
+    scan_ms = (time.perf_counter() - t0) / 20 * 1e3
+    mismatch = max(abs(t[0] - s[0]) for t, s in zip(totals, scans))
+    print(f"range total from rollups:   {rollup_ms:10.3f} ms/query")
+    print(f"range total by raw scan:    {scan_ms:10.3f} ms/query  (max difference {mismatch:.6f} g)")
+
+    t0 = time.perf_counter()
+    for _ in range(queries):
+        store.day_total()
+    print(f"today's total:              {(time.perf_counter() - t0) / queries * 1e3:10.3f} ms/query")
+    store.close()
+    print(f"database size: {os.path.getsize(path) / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "today"
+    if command == "bench":
+        _bench(float(sys.argv[2]) if len(sys.argv) > 2 else 3.0)
+    elif command == "today":
+        intake, count = HistoryStore().day_total()
+        print(f"Today: {intake:.0f} g over {count} readings")
+    else:
+        print("Usage: python3 history_store.py today | bench [years]")
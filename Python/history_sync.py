@@ -0,0 +1,413 @@
+# File: history_sync.py
+#
+# Resumable sync of the reading history (history_store.py) from the Pi to the
+# phone, replacing one "Weight Differnce" string per reading.
+#
+# The phone remembers the highest reading sequence number it has stored and
+# acknowledges it; the Pi only sends readings above it. A dropped connection
+# loses at most the unacknowledged batch, which is simply sent again on the
+# next connection (the receiver ignores sequence numbers it already has).
+#
+# Sequence numbers only mean something within one database, so HELLO names
+# the store (HistoryStore.store_id, random per database). A phone that was
+# tracking another store starts again from 0. If the phone acknowledges a
+# seq beyond the store's newest reading (the same database restored from an
+# older copy), the Pi sends RESET and starts again from 0 too.
+#
+# Wire format, over any byte stream (RFCOMM in production, a socketpair in
+# the self-test). Every frame is:
+#
+#   length u32 | type u8 | payload        (length counts type + payload)
+#
+#   HELLO  'H'  Pi -> phone   JSON {"version": 2, "device": "...", "store": "<store id>"}
+#   ACK    'A'  phone -> Pi   last_seq u64, after HELLO, RESET and every batch
+#   RESET  'R'  Pi -> phone   empty; forget last_seq for this store (ACK 0)
+#   BATCH  'B'  Pi -> phone   zlib(delta-encoded readings, see encode_batch)
+#   DONE   'D'  Pi -> phone   empty; the Pi is caught up and closes
+#
+# Usage:
+#   python3 history_sync.py selftest    # both ends over a socketpair, with an interrupted session
+
+import json
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+log = logging.getLogger("drinksync.sync")
+
+# --- Configuration ---
+PROTOCOL_VERSION = 2  # 2: store id in HELLO, RESET
+BATCH_SIZE = 500  # Readings per batch (one round trip each)
+MAX_FRAME = 1 << 20  # Refuse larger frames instead of allocating for them
+COMPRESSION_LEVEL = 6
+
+HELLO, ACK, RESET, BATCH, DONE = b"H", b"A", b"R", b"B", b"D"
+_FRAME_HEADER = struct.Struct("<Ic")
+_BATCH_HEADER = struct.Struct("<QqI")  # first seq, first ts in ms, record count
+_ACK = struct.Struct("<Q")
+
+
+class SyncError(Exception):
+    """The peer sent something that does not follow the protocol."""
+
+
+# --- Framing ---
+
+def send_frame(sock, frame_type, payload=b""):
+    sock.sendall(_FRAME_HEADER.pack(len(payload) + 1, frame_type) + payload)
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError("Peer closed the connection")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_frame(sock):
+    """Returns (frame_type, payload)."""
+    length, frame_type = _FRAME_HEADER.unpack(_recv_exact(sock, _FRAME_HEADER.size))
+    if length < 1 or length > MAX_FRAME:
+        raise SyncError("Bad frame length %d" % length)
+    return frame_type, _recv_exact(sock, length - 1)
+
+
+# --- Batch Encoding ---
+#
+# Readings are quantised to milliseconds and centigrams, then each field is
+# stored as the zigzag varint of its difference from the previous record.
+# Consecutive readings usually have consecutive sequence numbers and similar
+# weights, so most fields take one or two bytes before zlib sees them.
+
+def _put_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def encode_batch(records):
+    """
+    Encodes readings from HistoryStore.readings_since().
+
+    Args:
+        records (list): (seq, ts, weight, intake, profile) tuples in seq order.
+
+    Returns:
+        bytes: The compressed BATCH payload.
+    """
+    first_seq = records[0][0]
+    first_ts = int(round(records[0][1] * 1000))
+    out = bytearray(_BATCH_HEADER.pack(first_seq, first_ts, len(records)))
+
+    profiles = []
+    profile_index = {}
+    for record in records:
+        name = record[4]
+        if name is not None and name not in profile_index:
+            profile_index[name] = len(profiles) + 1  # 0 means no profile
+            profiles.append(name)
+    _put_varint(out, len(profiles))
+    for name in profiles:
+        encoded = name.encode()
+        _put_varint(out, len(encoded))
+        out += encoded
+
+    prev_seq, prev_ts, prev_weight = first_seq, first_ts, 0
+    for seq, ts, weight, intake, profile in records:
+        ts_ms = int(round(ts * 1000))
+        weight_cg = int(round(weight * 100))
+        _put_varint(out, seq - prev_seq)
+        _put_varint(out, _zigzag(ts_ms - prev_ts))
+        _put_varint(out, _zigzag(weight_cg - prev_weight))
+        _put_varint(out, _zigzag(int(round(intake * 100))))
+        _put_varint(out, profile_index.get(profile, 0))
+        prev_seq, prev_ts, prev_weight = seq, ts_ms, weight_cg
+    return zlib.compress(bytes(out), COMPRESSION_LEVEL)
+
+
+def decode_batch(payload):
+    """Inverse of encode_batch(): returns [(seq, ts, weight, intake, profile), ...]."""
+    try:
+        data = zlib.decompress(payload)
+        seq, ts_ms, count = _BATCH_HEADER.unpack_from(data, 0)
+        pos = _BATCH_HEADER.size
+        n_profiles, pos = _get_varint(data, pos)
+        profiles = [None]
+        for _ in range(n_profiles):
+            size, pos = _get_varint(data, pos)
+            profiles.append(data[pos:pos + size].decode())
+            pos += size
+
+        records = []
+        weight_cg = 0
+        for _ in range(count):
+            delta, pos = _get_varint(data, pos)
+            seq += delta
+            delta, pos = _get_varint(data, pos)
+            ts_ms += _unzigzag(delta)
+            delta, pos = _get_varint(data, pos)
+            weight_cg += _unzigzag(delta)
+            intake, pos = _get_varint(data, pos)
+            index, pos = _get_varint(data, pos)
+            records.append((seq, ts_ms / 1000.0, weight_cg / 100.0,
+                            _unzigzag(intake) / 100.0, profiles[index]))
+        return records
+    except (zlib.error, struct.error, IndexError, UnicodeDecodeError) as e:
+        raise SyncError("Malformed batch: %s" % e)
+
+
+# --- Pi Side (sender) ---
+
+def sync_history(sock, store, device="drinksync-pi", batch_size=BATCH_SIZE):
+    """
+    Sends every reading the peer has not acknowledged yet.
+
+    Args:
+        sock: Connected stream socket (RFCOMM or any stand-in).
+        store (HistoryStore): Source of readings.
+
+    Returns:
+        tuple: (records_sent, last_acked_seq)
+    """
+    send_frame(sock, HELLO, json.dumps({"version": PROTOCOL_VERSION, "device": device,
+                                        "store": store.store_id}).encode())
+    last_ack = _expect_ack(sock)
+    newest = store.last_reading()
+    newest_seq = newest["seq"] if newest is not None else 0
+    if last_ack > newest_seq:
+        # Nothing above last_ack would ever be sent, and new readings would
+        # reuse numbers the peer already holds.
+        log.warning("Peer is at seq %d but the history ends at %d; resending it all", last_ack, newest_seq)
+        send_frame(sock, RESET)
+        last_ack = _expect_ack(sock)
+        if last_ack != 0:
+            raise SyncError("Peer acknowledged %d after RESET, expected 0" % last_ack)
+    log.info("Peer has history up to seq %d", last_ack)
+    sent = 0
+    while True:
+        records = store.readings_since(last_ack, batch_size)
+        if not records:
+            break
+        send_frame(sock, BATCH, encode_batch(records))
+        ack = _expect_ack(sock)
+        if ack < records[-1][0]:
+            raise SyncError("Peer acknowledged %d, expected %d" % (ack, records[-1][0]))
+        sent += len(records)
+        last_ack = ack
+    send_frame(sock, DONE)
+    log.info("History sync complete: %d readings sent, peer at seq %d", sent, last_ack)
+    return sent, last_ack
+
+
+def _expect_ack(sock):
+    frame_type, payload = recv_frame(sock)
+    if frame_type != ACK or len(payload) != _ACK.size:
+        raise SyncError("Expected ACK, got %r" % frame_type)
+    return _ACK.unpack(payload)[0]
+
+
+# --- Phone Side (reference receiver) ---
+
+class MemorySink:
+    """
+    Reference receiver storage, standing in for the app's database: keeps
+    the readings, the id of the store they come from and the highest
+    sequence number stored from it.
+    """
+
+    def __init__(self, last_seq=0, store_id=None):
+        self.last_seq = last_seq
+        self.store_id = store_id
+        self.records = []
+
+    def begin(self, store_id):
+        """Starts a session with 'store_id'; returns the last_seq to acknowledge."""
+        if store_id != self.store_id:
+            if self.store_id is not None:
+                log.info("History store changed (%s -> %s); starting from seq 0", self.store_id, store_id)
+                self.last_seq = 0
+            self.store_id = store_id
+        return self.last_seq
+
+    def reset(self):
+        """Forgets the sequence position (RESET); the readings already stored stay."""
+        self.last_seq = 0
+        return self.last_seq
+
+    def store(self, records):
+        """Stores new records (duplicates from a resumed session are skipped); returns last_seq."""
+        for record in records:
+            if record[0] > self.last_seq:
+                self.records.append(record)
+                self.last_seq = record[0]
+        return self.last_seq
+
+
+def serve_sync(sock, sink):
+    """
+    Runs the phone side of one session: acknowledges sink.last_seq for the
+    store named in HELLO, stores batches until DONE. Returns the number of
+    records received.
+    """
+    frame_type, payload = recv_frame(sock)
+    if frame_type != HELLO:
+        raise SyncError("Expected HELLO, got %r" % frame_type)
+    hello = json.loads(payload)
+    if hello.get("version") != PROTOCOL_VERSION:
+        raise SyncError("Unsupported protocol version %r" % hello.get("version"))
+    send_frame(sock, ACK, _ACK.pack(sink.begin(hello.get("store"))))
+    received = 0
+    while True:
+        frame_type, payload = recv_frame(sock)
+        if frame_type == DONE:
+            return received
+        if frame_type == RESET:
+            send_frame(sock, ACK, _ACK.pack(sink.reset()))
+            continue
+        if frame_type != BATCH:
+            raise SyncError("Unexpected frame %r" % frame_type)
+        records = decode_batch(payload)
+        received += len(records)
+        # Acknowledge only after storing, so an ack always means "durable".
+        send_frame(sock, ACK, _ACK.pack(sink.store(records)))
+
+
+# --- Self-test ---
+
+class _DroppingSocket:
+    """Wraps a socket and closes it after 'limit' frames have been sent."""
+
+    def __init__(self, sock, limit):
+        self.sock = sock
+        self.limit = limit
+
+    def sendall(self, data):
+        if self.limit == 0:
+            self.sock.close()
+            raise ConnectionError("Simulated link loss")
+        self.limit -= 1
+        self.sock.sendall(data)
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+
+def _session(store, sink, drop_after=None):
+    pi_sock, phone_sock = socket.socketpair()
+    result = {}
+
+    def _phone():
+        try:
+            result["received"] = serve_sync(phone_sock, sink)
+        except (ConnectionError, OSError) as e:
+            result["error"] = str(e)
+        finally:
+            phone_sock.close()
+
+    thread = threading.Thread(target=_phone)
+    thread.start()
+    sender = pi_sock if drop_after is None else _DroppingSocket(pi_sock, drop_after)
+    start = time.perf_counter()
+    try:
+        sent, _ = sync_history(sender, store)
+    except (ConnectionError, OSError):
+        sent = None
+    elapsed = time.perf_counter() - start
+    thread.join()
+    pi_sock.close()
+    return sent, elapsed, result
+
+
+def _selftest():
+    import os
+    import random
+    import tempfile
+    from history_store import HistoryStore
+
+    store = HistoryStore(os.path.join(tempfile.mkdtemp(), "sync_history.db"))
+    rng = random.Random(3)
+    ts, consumed, rows = time.time() - 30 * 86400, 0.0, []
+    for i in range(20000):
+        ts += rng.uniform(60, 600)
+        intake = round(rng.uniform(0, 40), 2)
+        consumed = consumed + intake if consumed < 600 else intake
+        rows.append((ts, round(consumed, 2), intake, "glass" if i % 3 else "bottle"))
+    store.record_readings(rows)
+
+    sink = MemorySink()
+    sent, elapsed, result = _session(store, sink, drop_after=1 + 7)  # HELLO + 7 batches, then the link drops
+    print(f"session 1: interrupted, phone stored {len(sink.records)} readings (last seq {sink.last_seq})")
+    sent, elapsed, result = _session(store, sink)
+    print(f"session 2: resumed, sent {sent} readings in {elapsed * 1e3:.1f} ms")
+    assert [r[0] for r in sink.records] == list(range(1, len(rows) + 1)), "missing or repeated readings"
+    for (seq, ts, weight, intake, profile), row in zip(sink.records, rows):
+        # Timestamps travel as milliseconds.
+        assert abs(ts - row[0]) <= 0.0005 + 1e-6 and (weight, intake, profile) == row[1:], "reading %d differs" % seq
+    print(f"all {len(sink.records)} readings received exactly once and in order")
+
+    sent, elapsed, result = _session(store, sink)
+    print(f"session 3: already up to date, sent {sent} readings in {elapsed * 1e3:.2f} ms")
+
+    # The database is recreated: a new store id, seqs from 1 again.
+    new_path = os.path.join(tempfile.mkdtemp(), "sync_history.db")
+    new_store = HistoryStore(new_path)
+    new_store.record_readings(rows[:30])
+    before = len(sink.records)
+    sent, elapsed, result = _session(new_store, sink)
+    assert sent == 30 and len(sink.records) == before + 30, (sent, result)
+    print(f"session 4: recreated database (new store id), sent all {sent} readings")
+
+    # The same database restored from an older copy: same id, behind the phone.
+    new_store.close()
+    restored = HistoryStore(new_path)
+    with restored._lock:
+        restored._db.execute("DELETE FROM readings WHERE seq > 10")
+        restored._db.execute("UPDATE sqlite_sequence SET seq = 10 WHERE name = 'readings'")
+        restored._db.commit()
+    restored.record_readings(rows[30:35])
+    before = len(sink.records)
+    sent, elapsed, result = _session(restored, sink)
+    assert sent == 15 and len(sink.records) == before + 15 and sink.last_seq == 15, (sent, result)
+    print(f"session 5: restored database (phone ahead of it), RESET and resent all {sent} readings")
+
+    records = store.readings_since(0, BATCH_SIZE)
+    encoded = encode_batch(records)
+    text = "".join(f"Weight Differnce: {r[2]:.2f} grams" for r in records).encode()
+    as_json = json.dumps(records).encode()
+    print(f"{BATCH_SIZE} readings: {len(encoded)} bytes encoded, {len(zlib.compress(as_json))} as "
+          f"zlib JSON, {len(as_json)} as JSON, {len(text)} as text messages (weights only)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "selftest":
+        _selftest()
+    else:
+        print("Usage: python3 history_sync.py selftest")
@@ -1,10 +1,261 @@
-import RPi.GPIO as GPIO
 import time
 import threading
+import logging
+from collections import deque
+from metrics import REGISTRY
+import gpio_backend
+
+log = logging.getLogger("drinksync.hx711")
+
+# Hot-path instrumentation, shared by every HX711 instance in the process.
+CONVERSIONS = REGISTRY.counter(
+    "hx711_conversions_total", "Conversions clocked out of the HX711")
+DROPPED_CONVERSIONS = REGISTRY.counter(
+    "hx711_dropped_conversions_total",
+    "Conversions estimated lost because the previous read came too late")
+READY_WAIT = REGISTRY.histogram(
+    "hx711_ready_wait_seconds", "Time spent spinning on is_ready() per conversion")
+LOCK_WAIT = REGISTRY.histogram(
+    "hx711_lock_wait_seconds", "Time spent waiting for readLock per conversion")
+READ_TIMEOUTS = REGISTRY.counter(
+    "hx711_read_timeouts_total", "Reads that hit their deadline before DOUT went low")
+LOCK_TIMEOUTS = REGISTRY.counter(
+    "hx711_lock_timeouts_total", "Operations that gave up waiting for readLock held by another thread")
+RECOVERIES = REGISTRY.counter(
+    "hx711_recoveries_total", "Power-cycle recoveries after a stalled read, by outcome", ("outcome",))
+HEALTH_STATE = REGISTRY.gauge(
+    "hx711_health_state", "Sensor health: 0 = ok, 1 = degraded, 2 = failed")
+CONVERSION_RATE = REGISTRY.gauge(
+    "hx711_conversion_rate_sps", "Conversion rate measured from data-ready edges")
+
+
+# _BIT_REVERSED[b] is byte b with its bit order reversed (LSB-first bytes).
+_BIT_REVERSED = [int("{:08b}".format(b)[::-1], 2) for b in range(256)]
+_BIT_IDENTITY = list(range(256))
+
+
+class HX711TimeoutError(Exception):
+    """DOUT did not signal data ready before the deadline."""
+
+
+class HX711BusyError(Exception):
+    """
+    Another thread held readLock past the deadline. The sensor is not at
+    fault, so this is not a stall and never triggers a power cycle.
+    """
+
+
+class HX711StalledError(HX711TimeoutError):
+    """The sensor stayed unresponsive after every recovery attempt."""
+
+
+class SensorHealth:
+    """
+    Tracks read stalls and recoveries for one HX711.
+
+    States:
+        OK       - no stall in the last RECOVERED_AFTER successful reads.
+        DEGRADED - a stall happened recently but a power cycle recovered it.
+        FAILED   - recovery was exhausted; the next good read moves to DEGRADED.
+    """
+
+    OK = "ok"
+    DEGRADED = "degraded"
+    FAILED = "failed"
+    _CODES = {OK: 0, DEGRADED: 1, FAILED: 2}
+
+    RECOVERED_AFTER = 50  # Consecutive good reads before DEGRADED returns to OK
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = self.OK
+        self.stalls = 0
+        self.recoveries = 0
+        self.failures = 0
+        self.good_streak = 0
+        self.stall_times = deque(maxlen=100)
+
+    def _set_state(self, state):
+        if state != self.state:
+            log.warning("HX711 health: %s -> %s", self.state, state)
+            self.state = state
+        HEALTH_STATE.set(self._CODES[state])
+
+    def record_success(self):
+        with self._lock:
+            self.good_streak += 1
+            if self.state == self.FAILED:
+                self._set_state(self.DEGRADED)
+            elif self.state == self.DEGRADED and self.good_streak >= self.RECOVERED_AFTER:
+                self._set_state(self.OK)
+
+    def record_stall(self):
+        with self._lock:
+            self.stalls += 1
+            self.good_streak = 0
+            self.stall_times.append(time.monotonic())
+            if self.state == self.OK:
+                self._set_state(self.DEGRADED)
+
+    def record_recovery(self, succeeded):
+        with self._lock:
+            if succeeded:
+                self.recoveries += 1
+            else:
+                self.failures += 1
+                self._set_state(self.FAILED)
+
+    def stalls_in_last(self, seconds):
+        cutoff = time.monotonic() - seconds
+        with self._lock:
+            return sum(1 for t in self.stall_times if t >= cutoff)
+
+    def snapshot(self):
+        with self._lock:
+            result = {"state": self.state, "stalls": self.stalls,
+                      "recoveries": self.recoveries, "failures": self.failures}
+        result["stalls_last_hour"] = self.stalls_in_last(3600)
+        return result
+
+
+class ConversionClock:
+    """
+    Learns the HX711 output rate from data-ready edges and predicts the next one.
+
+    The rate is 10 or 80 SPS depending on the RATE pin, shifted a few percent
+    by the oscillator, so it is measured rather than assumed. A read that
+    arrives before DOUT goes low sees the edge itself ("exact"); the interval
+    between two consecutive exact reads is one conversion period, because
+    conversions free-run whether or not anyone reads them. The period is the
+    median of the last WINDOW such intervals.
+
+    A read that finds DOUT already low only knows the conversion finished
+    within the last period, so its timestamp is placed on the predicted edge.
+    """
+
+    WINDOW = 16  # Exact intervals kept for the period estimate
+    INITIAL_SPS = 10  # Assumed until the first exact interval is seen
+    MAX_OVERSLEEPS = 3  # Consecutive sleeps past the edge before re-measuring
+
+    def __init__(self, initial_sps=INITIAL_SPS):
+        self.period_ns = 10 ** 9 // initial_sps
+        self.measured = False
+        self.last_ready_ns = None
+        self.last_exact = False
+        self.conversions = 0
+        self.missed = 0
+        self.oversleeps = 0
+        self._intervals = deque(maxlen=self.WINDOW)
+
+    @property
+    def sps(self):
+        return 1e9 / self.period_ns
+
+    def reset(self):
+        """Forgets the conversion phase, e.g. after a power cycle. The period is kept."""
+        self.last_ready_ns = None
+        self.last_exact = False
+
+    def note_sleep(self, overslept):
+        """
+        Reports whether a sleep scheduled by next_ready_ns() woke after the
+        edge. Repeated oversleeps mean the period is wrong (e.g. the RATE pin
+        changed), so the estimate is dropped and re-measured by spinning.
+        """
+        if not overslept:
+            self.oversleeps = 0
+            return
+        self.oversleeps += 1
+        if self.oversleeps >= self.MAX_OVERSLEEPS:
+            log.warning("HX711 conversions arrive earlier than predicted; re-measuring the rate")
+            self.measured = False
+            self._intervals.clear()
+            self.oversleeps = 0
+
+    def observe(self, ready_ns, exact, max_gap_periods=None):
+        """
+        Records one conversion.
+
+        Args:
+            ready_ns (int): time.monotonic_ns() when DOUT was seen low.
+            exact (bool): True if DOUT went low while we were waiting for it.
+            max_gap_periods (int): Gaps longer than this many periods are the
+                caller being idle, not missed conversions.
+
+        Returns:
+            tuple: (ts_ns, missed) - the best estimate of when the conversion
+            completed, and how many conversions were skipped since the last one.
+        """
+        last = self.last_ready_ns
+        period = self.period_ns
+        ts_ns = ready_ns
+        missed = 0
+        if last is not None:
+            if exact:
+                late = (ready_ns - last) % period
+                if self.measured and period // 8 < late < period - period // 8:
+                    # Well off the edge grid: we were descheduled while
+                    # spinning and saw DOUT late, so trust the grid instead.
+                    ts_ns = ready_ns - late
+                periods = (ts_ns - last + period // 2) // period
+                if self.last_exact and periods <= 1 and ts_ns == ready_ns:
+                    self._intervals.append(ready_ns - last)
+                    ordered = sorted(self._intervals)
+                    self.period_ns = ordered[len(ordered) // 2]
+                    self.measured = True
+                    CONVERSION_RATE.set(round(self.sps, 2))
+            else:
+                # Finished at or before ready_ns: snap back onto the edge grid
+                # (never forward - less than a period since the last edge
+                # means the estimate is off, so keep the read time).
+                periods = (ready_ns - last) // period
+                if periods < 1:
+                    periods = 1
+                elif self.measured:
+                    ts_ns = last + periods * period
+            if max_gap_periods is None or periods < max_gap_periods:
+                missed = max(0, periods - 1)
+        self.last_ready_ns = ts_ns
+        self.last_exact = exact
+        self.conversions += 1
+        self.missed += missed
+        return ts_ns, missed
+
+    def next_ready_ns(self, now_ns=None):
+        """Predicted time of the next data-ready edge, or None until the rate is measured."""
+        if self.last_ready_ns is None or not self.measured:
+            return None
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        elapsed = now_ns - self.last_ready_ns
+        if elapsed < self.period_ns:
+            return self.last_ready_ns + self.period_ns
+        return self.last_ready_ns + (elapsed // self.period_ns + 1) * self.period_ns
+
 
 class HX711:
 
-    def __init__(self, dout, pd_sck, gain=128):
+    # Gaps longer than this many periods are treated as the client being idle
+    # rather than as dropped conversions.
+    MAX_DROP_PERIODS = 10
+
+    # Sleep until this long before the predicted data-ready edge, then spin on
+    # DOUT. Covers Linux wake-up latency without burning a whole period of CPU.
+    READY_SPIN_MARGIN_S = 0.003
+
+    # Stalled-read recovery: power cycle up to this many times, sleeping
+    # RECOVERY_BACKOFF_S, then twice that, ... (capped) between attempts.
+    MAX_RECOVERY_ATTEMPTS = 3
+    RECOVERY_BACKOFF_S = 0.05
+    MAX_RECOVERY_BACKOFF_S = 1.0
+
+    # Output settling time after power-up: 400 ms at 10 SPS, 50 ms at 80 SPS,
+    # i.e. this many conversion periods. The chip does not promise to hold
+    # DOUT high meanwhile, so reads wait out one period more than that: the
+    # conversion they then get finished after the chip had settled.
+    SETTLE_PERIODS = 4
+
+    def __init__(self, dout, pd_sck, gain=128, read_timeout=None, gpio=None):
         self.PD_SCK = pd_sck
 
         self.DOUT = dout
@@ -12,10 +263,12 @@ class HX711:
         # Mutex for reading from the HX711, in case multiple threads in client
         # software try to access get values from the class at the same time.
         self.readLock = threading.Lock()
-        
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.PD_SCK, GPIO.OUT)
-        GPIO.setup(self.DOUT, GPIO.IN)
+
+        # Pin access (gpio_backend.py); RPi.GPIO unless told otherwise.
+        self.gpio = gpio if gpio is not None else gpio_backend.create_backend()
+        self.gpio.setup_output(self.PD_SCK)
+        self.gpio.setup_input(self.DOUT)
+        self.shiftIn = self.gpio.shift_in
 
         self.GAIN = 0
 
@@ -26,17 +279,35 @@ class HX711:
 
         self.OFFSET = 1
         self.OFFSET_B = 1
+
+        # Optional channel A conversion from net counts to weight that replaces
+        # the REFERENCE_UNIT division, e.g. the convert of calibration.load_table().
+        self.calibration = None
         self.lastVal = int(0)
 
+        # Data-ready timing: measured rate, last edge and missed conversions.
+        self.clock = ConversionClock()
+        self.lastReadyNs = None
+        # time.monotonic_ns() before which conversions may not have settled;
+        # set on power-up.
+        self.settledNs = 0
+
+        # Deadline in seconds for a single conversion (None waits forever, the
+        # original behaviour). Applies to every read made through read_long().
+        self.read_timeout = read_timeout
+        self.health = SensorHealth()
+
         self.DEBUG_PRINTING = False
 
         self.byte_format = 'MSB'
         self.bit_format = 'MSB'
+        self.decodeRaw = None
 
+        # The chip may have just been powered on. set_gain() reads (and
+        # discards) a conversion, which waits out the settling time, so the
+        # chip has settled by the time the constructor returns.
+        self.markPoweredUp()
         self.set_gain(gain)
-        
-        # Think about whether this is necessary.
-        time.sleep(1)
 
 
     def convertFromTwosComplement24bit(self, inputValue):
@@ -44,7 +315,66 @@ class HX711:
 
     
     def is_ready(self):
-        return GPIO.input(self.DOUT) == 0
+        return self.gpio.read(self.DOUT) == 0
+
+
+    def set_read_timeout(self, timeout):
+        self.read_timeout = timeout
+
+
+    def markPoweredUp(self):
+        # Conversions settle SETTLE_PERIODS (plus one, see there) periods of
+        # the measured rate after this; the initial guess is the slow 10 SPS.
+        self.settledNs = time.monotonic_ns() + (self.SETTLE_PERIODS + 1) * self.clock.period_ns
+
+
+    def waitSettled(self):
+        # Sleeps until conversions have settled after power-up. Call it with
+        # readLock held, so no power cycle can slip in before the read.
+        # Bounded by the conversion rate (at most 0.5 s) and not part of a
+        # read timeout.
+        remaining = self.settledNs - time.monotonic_ns()
+        if remaining > 0:
+           time.sleep(remaining / 1e9)
+
+
+    def waitForReady(self, timeout):
+        # Waits for DOUT to go low. Sleeps until just before the predicted
+        # data-ready edge and only spins for the last READY_SPIN_MARGIN_S.
+        # Returns True if the conversion was already waiting for us.
+        if self.is_ready():
+           return True
+
+        start = time.monotonic_ns()
+        deadline = None if timeout is None else start + int(timeout * 1e9)
+        nextReady = self.clock.next_ready_ns(start)
+        if nextReady is not None:
+           wake = nextReady - int(self.READY_SPIN_MARGIN_S * 1e9)
+           if deadline is not None:
+              wake = min(wake, deadline)
+           if wake > start:
+              time.sleep((wake - start) / 1e9)
+              overslept = self.is_ready()
+              self.clock.note_sleep(overslept)
+              if overslept:
+                 return True
+
+        while not self.is_ready():
+           if deadline is not None and time.monotonic_ns() > deadline:
+              READ_TIMEOUTS.inc()
+              raise HX711TimeoutError("HX711 not ready within %.3f s" % timeout)
+        return False
+
+
+    def recordConversion(self, wasReady):
+        # Timestamps the conversion just clocked out and counts any conversions
+        # skipped since the previous read.
+        readyNs, missed = self.clock.observe(time.monotonic_ns(), not wasReady,
+                                             self.MAX_DROP_PERIODS)
+        if missed:
+           DROPPED_CONVERSIONS.inc(missed)
+        self.lastReadyNs = readyNs
+        return readyNs
 
     
     def set_gain(self, gain):
@@ -55,10 +385,10 @@ class HX711:
         elif gain == 32:
             self.GAIN = 2
 
-        GPIO.output(self.PD_SCK, False)
+        self.gpio.write(self.PD_SCK, 0)
 
         # Read out a set of raw bytes and throw it away.
-        self.readRawBytes()
+        self.readRawValue()
 
         
     def get_gain(self):
@@ -77,9 +407,9 @@ class HX711:
        # Clock HX711 Digital Serial Clock (PD_SCK).  DOUT will be
        # ready 1us after PD_SCK rising edge, so we sample after
        # lowering PD_SCL, when we know DOUT will be stable.
-       GPIO.output(self.PD_SCK, True)
-       GPIO.output(self.PD_SCK, False)
-       value = GPIO.input(self.DOUT)
+       self.gpio.write(self.PD_SCK, 1)
+       self.gpio.write(self.PD_SCK, 0)
+       value = self.gpio.read(self.DOUT)
 
        # Convert Boolean to int and return it.
        return int(value)
@@ -102,53 +432,161 @@ class HX711:
        return byteValue 
         
 
-    def readRawBytes(self):
+    def readRawValue(self, timeout=None):
+        # Reads one conversion as an unsigned 24 bit value in the configured
+        # byte and bit order. 'timeout' (seconds, defaults to
+        # self.read_timeout) bounds both the lock wait and the wait for DOUT;
+        # HX711BusyError or HX711TimeoutError is raised when it expires.
+        if timeout is None:
+           timeout = self.read_timeout
+
         # Wait for and get the Read Lock, in case another thread is already
         # driving the HX711 serial interface.
-        self.readLock.acquire()
-
-        # Wait until HX711 is ready for us to read a sample.
-        while not self.is_ready():
-           pass
-
-        # Read three bytes of data from the HX711.
-        firstByte  = self.readNextByte()
-        secondByte = self.readNextByte()
-        thirdByte  = self.readNextByte()
-
-        # HX711 Channel and gain factor are set by number of bits read
-        # after 24 data bits.
-        for i in range(self.GAIN):
-           # Clock a bit out of the HX711 and throw it away.
-           self.readNextBit()
-
-        # Release the Read Lock, now that we've finished driving the HX711
-        # serial interface.
-        self.readLock.release()           
-
+        lockStart = time.perf_counter()
+        self.acquireReadLock(timeout)
+
+        # The try/finally releases the lock even if a read raises, so one
+        # failed read cannot deadlock other callers.
+        try:
+           readyStart = time.perf_counter()
+           LOCK_WAIT.observe(readyStart - lockStart)
+           self.waitSettled()
+
+           # Wait until HX711 is ready for us to read a sample. If DOUT is
+           # already low the conversion has been waiting for us, and any
+           # further conversions since the last read were overwritten.
+           if timeout is not None:
+              timeout = max(0.0, timeout - (readyStart - lockStart))
+           readyStart = time.perf_counter()
+           wasReady = self.waitForReady(timeout)
+
+           READY_WAIT.observe(time.perf_counter() - readyStart)
+           self.recordConversion(wasReady)
+
+           # Clock out the 24 data bits plus the GAIN bits that select the
+           # channel and gain of the next conversion, in one backend call so
+           # PD_SCK pulses are not stretched by per-bit Python overhead.
+           raw = self.shiftIn(self.PD_SCK, self.DOUT, 24 + self.GAIN) >> self.GAIN
+        finally:
+           # Release the Read Lock, now that we've finished driving the HX711
+           # serial interface.
+           self.readLock.release()
+
+        CONVERSIONS.inc()
+
+        if self.decodeRaw is not None:
+           raw = self.decodeRaw(raw)
+        return raw
+
+
+    def acquireReadLock(self, timeout=None):
+        # Takes readLock, waiting at most 'timeout' seconds (forever if None),
+        # and raises HX711BusyError if another thread still holds it.
+        if not self.readLock.acquire(timeout=-1 if timeout is None else timeout):
+           LOCK_TIMEOUTS.inc()
+           raise HX711BusyError("HX711 readLock not available within %.3f s" % timeout)
+
+
+    def readRawBytes(self, timeout=None):
         # Depending on how we're configured, return an ordered list of raw byte
         # values.
-        if self.byte_format == 'LSB':
-           return [thirdByte, secondByte, firstByte]
+        raw = self.readRawValue(timeout)
+        return [raw >> 16, (raw >> 8) & 0xFF, raw & 0xFF]
+
+
+    def read_long_timed(self):
+        """
+        Reads one conversion like read_long(), also timing each PD_SCK pulse.
+
+        Returns:
+            tuple: (value, ready_ns, max_high_ns) where ready_ns is the
+            time.monotonic_ns() at which DOUT signalled data ready (see
+            ConversionClock for reads that found it already low) and
+            max_high_ns is the longest PD_SCK high time. Pulses over 60us
+            power the HX711 down and corrupt the conversion.
+
+        Raises:
+            HX711BusyError: readLock was held past self.read_timeout.
+            HX711TimeoutError: DOUT stayed high past self.read_timeout.
+        """
+        raw = 0
+        maxHighNs = 0
+        write, read = self.gpio.write, self.gpio.read
+        self.acquireReadLock(self.read_timeout)
+        try:
+            self.waitSettled()
+            wasReady = self.waitForReady(self.read_timeout)
+            readyNs = self.recordConversion(wasReady)
+
+            for i in range(24 + self.GAIN):
+               start = time.perf_counter_ns()
+               write(self.PD_SCK, 1)
+               write(self.PD_SCK, 0)
+               highNs = time.perf_counter_ns() - start
+               if highNs > maxHighNs:
+                  maxHighNs = highNs
+               if i < 24:
+                  raw = (raw << 1) | read(self.DOUT)
+        finally:
+            self.readLock.release()
+        CONVERSIONS.inc()
+
+        if self.decodeRaw is not None:
+           raw = self.decodeRaw(raw)
+        value = self.convertFromTwosComplement24bit(raw)
+        self.lastVal = value
+        return int(value), readyNs, maxHighNs
+
+
+    def readRawValueWithRecovery(self, timeout):
+        # Bounded read: on a stall, power cycle the HX711 with exponential
+        # backoff and retry, so the worst case is roughly
+        # (MAX_RECOVERY_ATTEMPTS + 1) * timeout plus the backoff sleeps. Every
+        # readLock wait in here, the power cycle's included, is bounded by
+        # 'timeout' too. HX711BusyError (another thread is on the bus) is
+        # passed on untouched: power cycling would cut that thread's read.
+        try:
+           raw = self.readRawValue(timeout)
+           self.health.record_success()
+           return raw
+        except HX711TimeoutError as e:
+           self.health.record_stall()
+           log.warning("HX711 read stalled (%s); attempting recovery", e)
+
+        backoff = self.RECOVERY_BACKOFF_S
+        for attempt in range(1, self.MAX_RECOVERY_ATTEMPTS + 1):
+           time.sleep(backoff)
+           backoff = min(backoff * 2, self.MAX_RECOVERY_BACKOFF_S)
+           try:
+              self.reset(timeout)
+              raw = self.readRawValue(timeout)
+           except HX711TimeoutError:
+              continue
+           RECOVERIES.labels("recovered").inc()
+           self.health.record_recovery(True)
+           self.health.record_success()
+           log.info("HX711 recovered after %d power cycle(s)", attempt)
+           return raw
+
+        RECOVERIES.labels("failed").inc()
+        self.health.record_recovery(False)
+        raise HX711StalledError("HX711 unresponsive after %d recovery attempts"
+                                % self.MAX_RECOVERY_ATTEMPTS)
+
+
+    def read_long(self, timeout=None):
+        # Get a sample from the HX711 as a 24bit 2s complement value. With a
+        # timeout (or self.read_timeout) the read is bounded and recovers
+        # from stalls.
+        if timeout is None:
+            timeout = self.read_timeout
+        if timeout is None:
+            twosComplementValue = self.readRawValue()
         else:
-           return [firstByte, secondByte, thirdByte]
-
-
-    def read_long(self):
-        # Get a sample from the HX711 in the form of raw bytes.
-        dataBytes = self.readRawBytes()
-
+            twosComplementValue = self.readRawValueWithRecovery(timeout)
 
         if self.DEBUG_PRINTING:
-            print(dataBytes,)
-        
-        # Join the raw bytes into a single 24bit 2s complement value.
-        twosComplementValue = ((dataBytes[0] << 16) |
-                               (dataBytes[1] << 8)  |
-                               dataBytes[2])
-
-        if self.DEBUG_PRINTING:
-            print("Twos: 0x%06x" % twosComplementValue)
+            log.debug("Twos: 0x%06x", twosComplementValue)
         
         # Convert from 24bit twos-complement to a signed value.
         signedIntValue = self.convertFromTwosComplement24bit(twosComplementValue)
@@ -160,6 +598,18 @@ class HX711:
         return int(signedIntValue)
 
     
+    def read_sample(self, timeout=None):
+        """
+        Reads one conversion together with its timestamp.
+
+        Returns:
+            tuple: (value, ts_ns) where ts_ns is the time.monotonic_ns() of the
+            conversion's data-ready edge.
+        """
+        value = self.read_long(timeout)
+        return value, self.lastReadyNs
+
+    
     def read_average(self, times=3):
         # Make sure we've been asked to take a rational amount of samples.
         if times <= 0:
@@ -244,6 +694,8 @@ class HX711:
 
     def get_weight_A(self, times=3):
         value = self.get_value_A(times)
+        if self.calibration is not None:
+            return self.calibration(value)
         value = value / self.REFERENCE_UNIT
         return value
 
@@ -266,7 +718,7 @@ class HX711:
         value = self.read_average(times)
 
         if self.DEBUG_PRINTING:
-            print("Tare A value:", value)
+            log.debug("Tare A value: %s", value)
         
         self.set_offset_A(value)
 
@@ -288,7 +740,7 @@ class HX711:
         value = self.read_average(times)
 
         if self.DEBUG_PRINTING:
-            print("Tare B value:", value)
+            log.debug("Tare B value: %s", value)
         
         self.set_offset_B(value)
 
@@ -314,6 +766,28 @@ class HX711:
         else:
             raise ValueError("Unrecognised bitformat: \"%s\"" % bit_format)
 
+        self.updateDecoder()
+
+
+    def updateDecoder(self):
+        # Precompute the byte/bit reordering for the configured format, so
+        # reads do no per-bit or per-byte format checks. MSB/MSB is the order
+        # the bits arrive in and needs no decoding at all.
+        if self.byte_format == 'MSB' and self.bit_format == 'MSB':
+            self.decodeRaw = None
+            return
+
+        table = _BIT_REVERSED if self.bit_format == 'LSB' else _BIT_IDENTITY
+        # Shift for the first, second and third byte clocked out.
+        s0, s1, s2 = (0, 8, 16) if self.byte_format == 'LSB' else (16, 8, 0)
+
+        def decodeRaw(raw):
+            return ((table[raw >> 16] << s0) |
+                    (table[(raw >> 8) & 0xFF] << s1) |
+                    (table[raw & 0xFF] << s2))
+
+        self.decodeRaw = decodeRaw
+
             
     # sets offset for channel A for compatibility reasons
     def set_offset(self, offset):
@@ -336,6 +810,12 @@ class HX711:
 
 
     
+    def set_calibration(self, convert):
+        # 'convert' maps net counts (reading minus offset) to weight; None
+        # reverts to dividing by the reference unit.
+        self.calibration = convert
+
+
     def set_reference_unit(self, reference_unit):
         self.set_reference_unit_A(reference_unit)
 
@@ -370,53 +850,60 @@ class HX711:
         return self.REFERENCE_UNIT_B
         
         
-    def power_down(self):
+    def power_down(self, timeout=None):
         # Wait for and get the Read Lock, in case another thread is already
-        # driving the HX711 serial interface.
-        self.readLock.acquire()
-
-        # Because a rising edge on HX711 Digital Serial Clock (PD_SCK).  We then
-        # leave it held up and wait 100us.  After 60us the HX711 should be
-        # powered down.
-        GPIO.output(self.PD_SCK, False)
-        GPIO.output(self.PD_SCK, True)
-
-        time.sleep(0.0001)
-
-        # Release the Read Lock, now that we've finished driving the HX711
-        # serial interface.
-        self.readLock.release()           
-
-
-    def power_up(self):
+        # driving the HX711 serial interface. 'timeout' (seconds, defaults to
+        # self.read_timeout) bounds the wait; HX711BusyError is raised when
+        # it expires.
+        self.acquireReadLock(self.read_timeout if timeout is None else timeout)
+        try:
+            # Because a rising edge on HX711 Digital Serial Clock (PD_SCK).  We then
+            # leave it held up and wait 100us.  After 60us the HX711 should be
+            # powered down.
+            self.gpio.write(self.PD_SCK, 0)
+            self.gpio.write(self.PD_SCK, 1)
+
+            time.sleep(0.0001)
+        finally:
+            self.readLock.release()
+
+
+    def power_up(self, timeout=None):
         # Wait for and get the Read Lock, incase another thread is already
-        # driving the HX711 serial interface.
-        self.readLock.acquire()
-
-        # Lower the HX711 Digital Serial Clock (PD_SCK) line.
-        GPIO.output(self.PD_SCK, False)
-
-        # Wait 100 us for the HX711 to power back up.
-        time.sleep(0.0001)
-
-        # Release the Read Lock, now that we've finished driving the HX711
-        # serial interface.
-        self.readLock.release()
+        # driving the HX711 serial interface. 'timeout' as for power_down().
+        if timeout is None:
+            timeout = self.read_timeout
+        self.acquireReadLock(timeout)
+        try:
+            # Lower the HX711 Digital Serial Clock (PD_SCK) line.
+            self.gpio.write(self.PD_SCK, 0)
+
+            # Conversions restart from power-up, so the old edge phase is stale
+            # and the next ones have to settle first.
+            self.clock.reset()
+            self.markPoweredUp()
+
+            # Wait 100 us for the HX711 to power back up.
+            time.sleep(0.0001)
+        finally:
+            self.readLock.release()
 
         # HX711 will now be defaulted to Channel A with gain of 128.  If this
         # isn't what client software has requested from us, take a sample and
         # throw it away, so that next sample from the HX711 will be from the
         # correct channel/gain.
         if self.get_gain() != 128:
-            self.readRawBytes()
+            self.readRawValue(timeout)
 
 
-    def reset(self):
-        self.power_down()
-        self.power_up()
+    def reset(self, timeout=None):
+        self.power_down(timeout)
+        self.power_up(timeout)
 
 def hx711_add_event_detect(hx711_instance, event_callback):
-        GPIO.add_event_detect(self.DOUT, GPIO.FALLING, 
+        # Edge detection needs RPi.GPIO, whatever backend does the reads.
+        import RPi.GPIO as GPIO
+        GPIO.add_event_detect(hx711_instance.DOUT, GPIO.FALLING,
             callback=event_callback)
 
 # EOF - hx711.py
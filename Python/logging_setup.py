@@ -0,0 +1,222 @@
+# File: logging_setup.py
+#
+# Queue-backed, rate-limited logging for the scale scripts.
+#
+# Hot loops (tare/acquisition sampling, the 10 Hz stability monitor, HX711
+# debug output) log through the standard 'logging' module under the
+# "drinksync" logger. setup_logging() attaches a QueueHandler to it, so the
+# calling thread only runs the rate-limit filter and a non-blocking queue put;
+# formatting and the (possibly slow) console/journald write happen on a
+# background listener thread.
+#
+# Run directly (`python3 logging_setup.py`) to measure loop jitter with
+# synchronous print() versus queued logging on a slow output stream.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+# --- Configuration ---
+ROOT_LOGGER_NAME = "drinksync"
+DEFAULT_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+QUEUE_SIZE = 10000  # Records buffered for the listener before new ones are dropped
+RATE_LIMIT_BURST = 10  # Identical messages allowed per interval...
+RATE_LIMIT_INTERVAL = 1.0  # ...of this many seconds
+
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Allows at most 'burst' records per 'interval' seconds for each message
+    template (logger name + unformatted msg), so a loop repeating the same
+    warning cannot flood the output.
+
+    The number of suppressed records is attached to the next record that
+    passes as 'record.suppressed'.
+    """
+
+    def __init__(self, burst=RATE_LIMIT_BURST, interval=RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}  # key -> [window_start, count, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = record.created
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        record.suppressed = suppressed
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks the calling thread: records are queued
+    unformatted and dropped (and counted) when the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting is deferred to the listener thread.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    """Standard text format, noting how many similar records were rate limited."""
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" (+{suppressed} similar suppressed)"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line. Values passed as extra={"fields": {...}} are
+    included as top-level keys.
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level=logging.INFO, stream=None, json_format=False,
+                  burst=RATE_LIMIT_BURST, interval=RATE_LIMIT_INTERVAL):
+    """
+    Routes the "drinksync" loggers through a rate-limited queue to a
+    background writer thread. Calling it again replaces the previous setup.
+
+    Args:
+        level (int): Minimum level for the "drinksync" loggers.
+        stream: Output stream for the listener (default: sys.stderr).
+        json_format (bool): Emit JSON lines instead of plain text.
+        burst (int): Identical messages allowed per 'interval' seconds.
+        interval (float): Rate limit window in seconds.
+
+    Returns:
+        logging.handlers.QueueListener: The running listener.
+    """
+    global _listener
+    shutdown_logging()
+
+    output = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format else TextFormatter(DEFAULT_FORMAT))
+
+    handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    handler.addFilter(RateLimitFilter(burst, interval))
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(handler.queue, output)
+    _listener.start()
+    return _listener
+
+
+# The listener thread is a daemon; flush whatever is still queued at exit.
+atexit.register(lambda: shutdown_logging())
+
+
+def ensure_logging(**kwargs):
+    """Calls setup_logging(**kwargs) unless logging has already been set up."""
+    if _listener is None:
+        setup_logging(**kwargs)
+    return _listener
+
+
+def shutdown_logging():
+    """Flushes queued records and stops the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# --- Loop Jitter Benchmark ---
+if __name__ == "__main__":
+    import io
+    import statistics
+
+    LOOP_PERIOD = 0.01  # 100 Hz keeps the benchmark short; the monitor runs at 10 Hz
+    ITERATIONS = 300
+    WRITE_DELAY = 0.002  # Emulates a slow serial console / journald write
+
+    class SlowStream(io.StringIO):
+        def write(self, text):
+            time.sleep(WRITE_DELAY)
+            return len(text)
+
+    def run_loop(emit):
+        periods = []
+        last = time.perf_counter()
+        for i in range(ITERATIONS):
+            emit(i)
+            time.sleep(LOOP_PERIOD)
+            now = time.perf_counter()
+            periods.append(now - last)
+            last = now
+        return [abs(p - LOOP_PERIOD) * 1e3 for p in periods]
+
+    def report(label, jitter_ms):
+        jitter_ms = sorted(jitter_ms)
+        p99 = jitter_ms[int(len(jitter_ms) * 0.99) - 1]
+        print(f"{label: <24} jitter mean={statistics.mean(jitter_ms):6.3f} ms  "
+              f"p99={p99:6.3f} ms  max={jitter_ms[-1]:6.3f} ms")
+
+    slow = SlowStream()
+    print(f"{ITERATIONS} iterations at {LOOP_PERIOD * 1e3:.0f} ms, "
+          f"{WRITE_DELAY * 1e3:.0f} ms per output write, 2 lines per iteration")
+    report("print()", run_loop(lambda i: (print(f"  Tare sample {i}", file=slow),
+                                          print(f"Status: STABLE {i}", end="\r", file=slow))))
+
+    bench_log = logging.getLogger(ROOT_LOGGER_NAME + ".bench")
+    for label, burst in (("queued", ITERATIONS * 2), ("queued + rate-limited", RATE_LIMIT_BURST)):
+        setup_logging(level=logging.DEBUG, stream=slow, burst=burst)
+        report(label, run_loop(lambda i: (bench_log.debug("  Tare sample %d", i),
+                                          bench_log.info("Status: STABLE %d", i))))
+        shutdown_logging()
@@ -0,0 +1,279 @@
+# File: metrics.py
+#
+# Low-overhead counters and histograms for the scale daemon hot paths
+# (HX711 reads, take_reading and Bluetooth messaging), exported as
+# Prometheus text either over a local HTTP endpoint or to a file.
+#
+# Run directly (`python3 metrics.py`) to benchmark the per-call overhead.
+
+import bisect
+import logging
+import os
+import threading
+import time
+
+# --- Configuration ---
+# Latency buckets in seconds, from a few microseconds (bit-bang spins) up to
+# several seconds (Bluetooth service discovery).
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_HTTP_ADDRESS = "127.0.0.1"  # Only expose metrics locally
+
+log = logging.getLogger("drinksync.metrics")
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """
+    A monotonically increasing counter.
+
+    Increments are a plain attribute update, so they rely on the GIL rather
+    than a lock. A lost increment under heavy thread contention is acceptable
+    for monitoring and keeps the hot path to a single addition.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.value = 0
+        self._children = {}
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def labels(self, *labelvalues):
+        """Returns the child counter for the given label values."""
+        child = self._children.get(labelvalues)
+        if child is None:
+            child = Counter(self.name, self.documentation)
+            self._children[labelvalues] = child
+        return child
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s counter" % self.name]
+        if self.labelnames:
+            for labelvalues, child in sorted(self._children.items()):
+                labels = _format_labels(self.labelnames, labelvalues)
+                lines.append("%s%s %s" % (self.name, labels, _format_value(child.value)))
+        else:
+            lines.append("%s %s" % (self.name, _format_value(self.value)))
+        return lines
+
+
+class Gauge:
+    """A value that can go up and down, e.g. a state code or a queue depth."""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.documentation),
+                "# TYPE %s gauge" % self.name,
+                "%s %s" % (self.name, _format_value(self.value))]
+
+
+class Histogram:
+    """
+    A cumulative histogram with fixed bucket boundaries.
+
+    observe() does one bisect and three additions; cumulative bucket counts
+    are only computed when the histogram is rendered.
+    """
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # One extra slot for observations above the largest bucket (+Inf).
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """Context manager that observes the duration of the enclosed block."""
+        return _Timer(self)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        bounds = self.buckets + (float("inf"),)
+        for bound, count in zip(bounds, list(self.counts)):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, _format_value(bound), cumulative))
+        lines.append("%s_sum %s" % (self.name, repr(self.sum)))
+        lines.append("%s_count %d" % (self.name, self.count))
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Registry:
+    """Holds every metric of the process and renders them as Prometheus text."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, *args)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError("Metric '%s' already registered with another type" % name)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation):
+        return self._register(Gauge, name, documentation)
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry used by hx711.py, scale_persistent_tare.py and bt.py.
+REGISTRY = Registry()
+
+
+# --- Exporters ---
+
+def start_http_server(port, address=METRICS_HTTP_ADDRESS, registry=REGISTRY):
+    """
+    Serves the registry as Prometheus text on http://address:port/metrics
+    from a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer: The running server (call shutdown() to stop it).
+    """
+    # Imported here: http.server pulls in http.client, email and ssl (~40 ms
+    # at start-up), and every module that only counts things imports metrics.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Keep scrapes out of the console
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def write_metrics_file(path, registry=REGISTRY):
+    """Atomically writes the registry to 'path' (e.g. for node_exporter's textfile collector)."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+def start_file_writer(path, interval=15.0, registry=REGISTRY):
+    """
+    Rewrites the metrics file every 'interval' seconds from a daemon thread.
+
+    Returns:
+        threading.Event: Set it to stop the writer.
+    """
+    stop_event = threading.Event()
+
+    def _loop():
+        while not stop_event.wait(interval):
+            try:
+                write_metrics_file(path, registry)
+            except OSError as e:
+                log.warning("Could not write metrics file '%s': %s", path, e)
+
+    threading.Thread(target=_loop, name="metrics-file", daemon=True).start()
+    return stop_event
+
+
+# --- Overhead Benchmark ---
+if __name__ == "__main__":
+    iterations = 1000000
+    bench_registry = Registry()
+    counter = bench_registry.counter("bench_total", "Benchmark counter")
+    labelled = bench_registry.counter("bench_labelled_total", "Benchmark counter", ("reason",))
+    histogram = bench_registry.histogram("bench_seconds", "Benchmark histogram")
+
+    def _bench(label, fn):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        elapsed = time.perf_counter() - start
+        print(f"{label: <28} {elapsed / iterations * 1e9:8.1f} ns/op")
+
+    print(f"Metrics overhead ({iterations} iterations each):")
+    _bench("empty loop (baseline)", lambda: None)
+    _bench("Counter.inc()", counter.inc)
+    _bench("Counter.labels().inc()", lambda: labelled.labels("overflow").inc())
+    _bench("Histogram.observe()", lambda: histogram.observe(0.0003))
+    _bench("perf_counter() + observe()", lambda: histogram.observe(time.perf_counter() - 1.0))
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        bench_registry.render()
+    print(f"{'Registry.render()': <28} {(time.perf_counter() - start) * 1e3:8.1f} us/op")
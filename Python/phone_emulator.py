@@ -0,0 +1,299 @@
+# File: phone_emulator.py
+#
+# Python stand-in for the Android app's message server (startServer() in
+# MainActivity.kt), listening on a TCP or Unix socket so the whole send path
+# (bt.py, delivery.py) can be load-tested on one machine.
+#
+# It behaves like the app:
+#   - reads up to 1024 bytes at a time and treats each read as one message;
+#   - parses it with the app's regex, "Average weight: <grams> grams";
+#   - optionally answers "OK <grams> g", "ERR Parse" or "ERR Format" (the
+#     replies that are commented out in the app; ack=False matches the app
+#     as shipped);
+#   - with accept_once=True, serves only the first connection, as the app's
+#     server thread does.
+#
+# Usage:
+#   python3 phone_emulator.py serve tcp://127.0.0.1:9000 [--no-ack] [--once]
+#   python3 phone_emulator.py bench [tcp|unix] [seconds]   # throughput and latency of the send path
+#   python3 phone_emulator.py check                        # how the send path fares against the app as shipped
+
+import logging
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+log = logging.getLogger("drinksync.emulator")
+
+# --- Configuration ---
+APP_PATTERN = re.compile(r"Average weight:\s*(\d+\.?\d*)\s*grams")  # Same as MainActivity.kt
+READ_SIZE = 1024  # The app's read buffer
+BENCH_SECONDS = 3.0
+
+
+class PhoneEmulator:
+    """
+    Emulated app server.
+
+    Args:
+        url (str): tcp://<host>:<port> (port 0 picks a free one) or unix://<path>.
+        ack (bool): Answer every read like the app's commented-out replies.
+        accept_once (bool): Stop listening after the first connection, like the app.
+        delay_s (float): Processing time per message, before the reply.
+        drop_every (int): Close the connection instead of storing every n-th message.
+    """
+
+    def __init__(self, url, ack=True, accept_once=False, delay_s=0.0, drop_every=None):
+        self.ack = ack
+        self.accept_once = accept_once
+        self.delay_s = delay_s
+        self.drop_every = drop_every
+        self._server = _listen(url)
+        if self._server.family == socket.AF_UNIX:
+            self.url = url
+        else:
+            self.url = "tcp://%s:%d" % self._server.getsockname()[:2]
+        self._lock = threading.Lock()
+        self._clients = []
+        self._closed = False
+        self._reads = 0
+
+        # Statistics
+        self.messages = []  # Accepted messages, as received
+        self.grams = []
+        self.format_errors = 0
+        self.parse_errors = 0
+        self.connections = 0
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, name="phone-emulator", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._closed = True
+        self._server.close()
+        with self._lock:
+            clients = list(self._clients)
+        for conn in clients:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._server.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.url.partition("://")[2])
+            except OSError:
+                pass
+
+    def _accept_loop(self):
+        while not self._closed:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            with self._lock:
+                self._clients.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+            if self.accept_once:
+                # The app's server thread never calls accept() again.
+                self._server.close()
+                return
+
+    def _serve(self, conn):
+        try:
+            while True:
+                data = conn.recv(READ_SIZE)
+                if not data:
+                    return
+                with self._lock:
+                    self._reads += 1
+                    drop = self.drop_every and self._reads % self.drop_every == 0
+                if drop:
+                    return  # Lost before it was stored; the sender has to retry it
+                if self.delay_s:
+                    time.sleep(self.delay_s)
+                reply = self._handle(data.decode(errors="replace").strip())
+                if self.ack:
+                    conn.sendall(reply)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._clients.remove(conn)
+            conn.close()
+
+    def _handle(self, message):
+        match = APP_PATTERN.search(message)
+        if match is None:
+            with self._lock:
+                self.format_errors += 1
+            return b"ERR Format\n"
+        grams = float(match.group(1))
+        if grams <= 0:
+            with self._lock:
+                self.parse_errors += 1
+            return b"ERR Parse\n"
+        with self._lock:
+            self.messages.append(message)
+            self.grams.append(grams)
+        return ("OK %s g\n" % match.group(1)).encode()
+
+    def stats(self):
+        with self._lock:
+            return {"accepted": len(self.messages), "formatErrors": self.format_errors,
+                    "parseErrors": self.parse_errors, "connections": self.connections}
+
+
+def _listen(url):
+    scheme, _, rest = url.partition("://")
+    if scheme == "tcp":
+        host, _, port = rest.rpartition(":")
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host or "127.0.0.1", int(port)))
+    elif scheme == "unix":
+        if os.path.exists(rest):
+            os.unlink(rest)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(rest)
+    else:
+        raise ValueError("The emulator listens on tcp:// or unix:// URLs, not '%s'" % url)
+    server.listen(16)
+    return server
+
+
+# --- Benchmarks ---
+
+def _local_url(kind):
+    if kind == "unix":
+        return "unix://" + os.path.join(tempfile.mkdtemp(), "phone.sock")
+    return "tcp://127.0.0.1:0"
+
+
+def _report(label, latencies, elapsed):
+    latencies.sort()
+    n = len(latencies)
+    pick = lambda q: latencies[min(int(q * n), n - 1)] * 1e3
+    print(f"{label: <34} {n / elapsed:9.0f} msg/s   p50 {pick(0.5):6.3f} ms   "
+          f"p95 {pick(0.95):6.3f} ms   p99 {pick(0.99):6.3f} ms")
+
+
+def _bench(kind="tcp", seconds=BENCH_SECONDS):
+    import bt
+    import delivery
+
+    logging.getLogger("drinksync").setLevel(logging.ERROR)
+    phone = PhoneEmulator(_local_url(kind)).start()
+    transport = bt.transport_from_url(phone.url)
+    print(f"Emulated phone on {phone.url}")
+
+    # 1. bt.send_message(): a new connection per message, as the scripts do today.
+    latencies = []
+    start = time.perf_counter()
+    i = 0
+    while time.perf_counter() - start < seconds:
+        t0 = time.perf_counter()
+        if not bt.send_message("Average weight: %.2f grams" % (10 + i % 500), transport):
+            raise SystemExit("send_message() failed against the emulator")
+        latencies.append(time.perf_counter() - t0)
+        i += 1
+    _report("send_message (connect per message)", latencies, time.perf_counter() - start)
+
+    # 2. One persistent, acknowledged session through delivery.py, one message in flight.
+    manager = delivery.DeliveryManager()
+    session = manager.add_peer("emulator", transport.connect, ack=True)
+    latencies = []
+    start = time.perf_counter()
+    i = 0
+    while time.perf_counter() - start < seconds:
+        t0 = time.perf_counter()
+        manager.send("Average weight: %.2f grams" % (10 + i % 500))
+        session.wait_idle()
+        latencies.append(time.perf_counter() - t0)
+        i += 1
+    _report("persistent session, acknowledged", latencies, time.perf_counter() - start)
+
+    # 3. Same session, queue kept full: throughput of the delivery thread.
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for j in range(100):
+            manager.send("Average weight: %.2f grams" % (10 + j))
+        count += 100
+        manager.flush()
+    elapsed = time.perf_counter() - start
+    stats = session.stats()
+    print(f"{'persistent session, queued': <34} {count / elapsed:9.0f} msg/s   "
+          f"p50 {stats['latencyP50Ms']:6.3f} ms   p95 {stats['latencyP95Ms']:6.3f} ms (incl. queueing)")
+    manager.close()
+
+    stats = phone.stats()
+    print(f"Emulator: {stats['accepted']} messages accepted over {stats['connections']} connections, "
+          f"{stats['formatErrors']} format errors")
+    phone.stop()
+
+
+def _check():
+    """Runs the send path against the app as shipped: no replies, one connection."""
+    import bt
+    import delivery
+
+    logging.getLogger("drinksync").setLevel(logging.ERROR)
+    bt.REPLY_TIMEOUT_S = 0.2
+    phone = PhoneEmulator(_local_url("tcp"), ack=False, accept_once=True).start()
+    transport = bt.transport_from_url(phone.url)
+    results = [bt.send_message("Average weight: %d.00 grams" % grams, transport) for grams in (100, 200, 300)]
+    time.sleep(0.1)
+    print(f"send_message x3 (new connection each): returned {results}, "
+          f"app stored {phone.stats()['accepted']} (second and later connections are not served)")
+    phone.stop()
+
+    default_gap_s = delivery.UNACKED_GAP_S
+    for gap_s in (0.0, 0.05):
+        delivery.UNACKED_GAP_S = gap_s
+        phone = PhoneEmulator(_local_url("tcp"), ack=False, accept_once=True).start()
+        manager = delivery.DeliveryManager()
+        manager.add_peer("app", bt.transport_from_url(phone.url).connect)
+        for grams in range(1, 41):
+            manager.send("Average weight: %d.00 grams" % grams)
+        manager.flush(timeout=10)
+        time.sleep(0.2)
+        stats = manager.stats()["app"]
+        print(f"persistent session, 40 unacknowledged messages {gap_s * 1e3:.0f} ms apart: "
+              f"{stats['delivered']} delivered, {stats['unconfirmed']} unconfirmed, "
+              f"app stored {phone.stats()['accepted']} (messages arriving in one read are merged)")
+        manager.close()
+        phone.stop()
+    delivery.UNACKED_GAP_S = default_gap_s
+
+    phone = PhoneEmulator(_local_url("tcp"), ack=True).start()
+    bt.send_message("Weight Differnce: 12.50 grams", bt.transport_from_url(phone.url))
+    print(f"scale_persistent_tare.py message format: {phone.stats()['formatErrors']} format error(s)")
+    phone.stop()
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "serve" and len(sys.argv) > 2:
+        logging.basicConfig(level=logging.INFO)
+        phone = PhoneEmulator(sys.argv[2], ack="--no-ack" not in sys.argv,
+                              accept_once="--once" in sys.argv).start()
+        print(f"Emulating the app on {phone.url}; set bt.TRANSPORT_URL to it. Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(5)
+                log.info("%s", phone.stats())
+        except KeyboardInterrupt:
+            phone.stop()
+    elif command == "bench":
+        _bench(sys.argv[2] if len(sys.argv) > 2 else "tcp",
+               float(sys.argv[3]) if len(sys.argv) > 3 else BENCH_SECONDS)
+    elif command == "check":
+        _check()
+    else:
+        print("Usage: python3 phone_emulator.py serve <url> [--no-ack] [--once] | bench [tcp|unix] [seconds] | check")
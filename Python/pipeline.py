@@ -0,0 +1,773 @@
+# File: pipeline.py
+#
+# Streaming pipeline for the scale: a source (HX711, gyroscope, replayed
+# values) feeds a chain of independent stages - decode, outlier rejection,
+# smoothing, stability gating, event detection - ending in sinks (Bluetooth,
+# log, socket).
+#
+# A stage only sees items: process(item) yields zero or more output items and
+# finish() yields whatever it holds when the stream ends. Stages do not know
+# their neighbours, so they can be swapped, reordered or given several worker
+# threads (for stateless or I/O-bound stages) without touching the others.
+#
+# Pipeline.run() gives the source and every stage their own thread,
+# connected by bounded queues, so a slow sink applies backpressure instead of
+# growing memory. Pipeline.run_inline() pushes the same items through the
+# same stages on the calling thread, for short fixed readings where threads
+# would only add overhead. Either way, stats() reports each stage's items
+# in/out, throughput and busy time.
+#
+# The scripts are configurations of it. tare() is the one tare every entry
+# point uses (scale.py, scale_persistent_tare.py, scale_daemon.py); sampling
+# and filtering in take_reading() and the gyroscope trigger in
+# stability_scale_trigger.py run on it, and so do scale_daemon.py's weight
+# events (outlier rejection, smoothing, stability gating, change detection).
+# The intake decision and delivery in scale_persistent_tare.py are still
+# plain code.
+#
+# Usage:
+#   python3 pipeline.py bench    # per-stage throughput on synthetic samples, no hardware
+
+import json
+import logging
+import math
+import queue
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+import fast_stats
+
+log = logging.getLogger("drinksync.pipeline")
+
+# --- Configuration ---
+QUEUE_SIZE = 64  # Items buffered between two stages
+
+# ts_ns: time.monotonic_ns() of the conversion, raw: HX711 counts (None once
+# aggregated), weight: grams (None until decoded).
+Reading = namedtuple("Reading", ["ts_ns", "raw", "weight"])
+# gyro: (x, y, z) in deg/s, or None if the sensor could not be read.
+Motion = namedtuple("Motion", ["ts_ns", "gyro"])
+Event = namedtuple("Event", ["ts_ns", "type", "weight", "fields"])
+
+_END = object()  # End-of-stream marker passed through the queues
+
+
+class Stage:
+    """
+    One step of a pipeline. Subclasses override process() and, if they hold
+    state across items, finish().
+
+    Args:
+        name (str): Shown in stats(); the class name by default.
+        workers (int): Threads running process() in Pipeline.run(). Only for
+            stages without state between items: with several workers the
+            output order is not guaranteed.
+    """
+
+    def __init__(self, name=None, workers=1):
+        self.name = name or type(self).__name__
+        self.workers = workers
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def process(self, item):
+        yield item
+
+    def finish(self):
+        return ()
+
+    # --- Statistics ---
+
+    def reset_stats(self):
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.dropped = 0
+        self.busy_ns = 0
+
+    def _account(self, items_in, items_out, busy_ns):
+        with self._stats_lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.busy_ns += busy_ns
+
+
+# --- Sources ---
+#
+# A source is any iterable; these generators wrap the hardware.
+
+def hx711_source(hx, duration_s=None, count=None, timeout=None, on_error=None):
+    """
+    Yields a Reading per HX711 conversion until 'duration_s' has passed or
+    'count' conversions were read (forever if neither is given). Stops if
+    the sensor stalls beyond recovery.
+
+    Args:
+        on_error: Called with "stalled", "overflow" or "read_error" for
+            every conversion that could not be read.
+    """
+    from hx711 import HX711StalledError
+
+    deadline = None if duration_s is None else time.monotonic() + duration_s
+    n = 0
+    while (deadline is None or time.monotonic() < deadline) and (count is None or n < count):
+        try:
+            raw, ts_ns = hx.read_sample(timeout)
+        except HX711StalledError:
+            # Recovery already failed; more samples won't succeed.
+            log.error("HX711 stalled and did not recover; ending the stream.")
+            reason = "stalled"
+        except OverflowError:
+            log.warning("Overflow error during reading, discarding value.")
+            reason = "overflow"
+        except Exception as e:
+            log.warning("Error during individual weight reading: %s", e)
+            reason = "read_error"
+        else:
+            n += 1
+            yield Reading(ts_ns, raw, None)
+            continue
+        if on_error is not None:
+            on_error(reason)
+        if reason == "stalled":
+            return
+
+
+def gyro_source(sensor, interval_s):
+    """
+    Yields a Motion every 'interval_s' from an mpu6050 sensor (gyro None on read errors).
+
+    Args:
+        interval_s: Seconds between reads, or a callable returning them before
+            every sleep (e.g. duty_cycle.DutyCycleScheduler.gyro_interval).
+    """
+    import tracing
+
+    interval = interval_s if callable(interval_s) else (lambda: interval_s)
+    while True:
+        try:
+            with tracing.span("gyro.read"):
+                data = sensor.get_gyro_data()
+            yield Motion(time.monotonic_ns(), (data["x"], data["y"], data["z"]))
+        except Exception as e:
+            log.warning("Error reading gyroscope data: %s", e)
+            tracing.instant("stability.read_error")
+            yield Motion(time.monotonic_ns(), None)
+            time.sleep(interval())  # Wait a bit longer after an error
+        time.sleep(interval())
+
+
+def replay_source(weights, interval_s=0.0, start_ns=None):
+    """Yields decoded Readings for recorded or simulated weights, 'interval_s' apart."""
+    ts_ns = time.monotonic_ns() if start_ns is None else start_ns
+    step = int(interval_s * 1e9)
+    for weight in weights:
+        yield Reading(ts_ns, None, weight)
+        ts_ns += step
+
+
+# --- Filters ---
+
+class MedianOf(Stage):
+    """Emits the median of every 'n' items (of Reading field 'field'), like hx.read_median(n)."""
+
+    def __init__(self, n, field="raw", name=None):
+        super().__init__(name)
+        self.n = n
+        self.field = field
+        self._batch = []
+
+    def process(self, item):
+        self._batch.append(item)
+        if len(self._batch) >= self.n:
+            batch, self._batch = self._batch, []
+            values = sorted(getattr(r, self.field) for r in batch)
+            yield batch[-1]._replace(**{self.field: fast_stats.median(values)})
+
+
+class Decode(Stage):
+    """Converts raw counts to grams with hx's current offset and calibration (as get_weight_A)."""
+
+    def __init__(self, hx, name=None, workers=1):
+        super().__init__(name, workers)
+        self.hx = hx
+
+    def process(self, item):
+        hx = self.hx
+        value = item.raw - hx.OFFSET
+        weight = hx.calibration(value) if hx.calibration is not None else value / hx.REFERENCE_UNIT
+        yield item._replace(weight=weight)
+
+
+class RangeCheck(Stage):
+    """Drops readings whose weight is at least 'limit' grams from zero (wiring or bus errors)."""
+
+    def __init__(self, limit, on_reject=None, name=None):
+        super().__init__(name)
+        self.limit = limit
+        self.on_reject = on_reject
+
+    def process(self, item):
+        if abs(item.weight) < self.limit:
+            yield item
+            return
+        log.warning("Discarding potentially erroneous reading: %s", item.weight)
+        self.dropped += 1
+        if self.on_reject is not None:
+            self.on_reject(item)
+
+
+class RejectOutliers(Stage):
+    """
+    Hampel filter: drops a reading more than 'threshold' scaled median
+    absolute deviations from the median of the last 'window' readings.
+    """
+
+    def __init__(self, window=9, threshold=3.5, min_deviation=0.5, name=None):
+        super().__init__(name)
+        self.threshold = threshold
+        self.min_deviation = min_deviation  # grams; keeps a perfectly flat window from rejecting noise
+        self._window = deque(maxlen=window)
+
+    def process(self, item):
+        window = self._window
+        window.append(item.weight)
+        if len(window) < 3:
+            yield item
+            return
+        median = fast_stats.median(window)
+        mad = 1.4826 * fast_stats.median(abs(w - median) for w in window)
+        if abs(item.weight - median) > self.threshold * max(mad, self.min_deviation):
+            self.dropped += 1
+            return
+        yield item
+
+
+class Smooth(Stage):
+    """Moving average over the last 'window' weights."""
+
+    def __init__(self, window=5, name=None):
+        super().__init__(name)
+        self._window = deque(maxlen=window)
+        self._total = 0.0
+
+    def process(self, item):
+        window = self._window
+        if len(window) == window.maxlen:
+            self._total -= window[0]
+        window.append(item.weight)
+        self._total += item.weight
+        yield item._replace(weight=self._total / len(window))
+
+
+class Aggregate(Stage):
+    """Collects the whole stream and emits one Reading with reduce() of Reading field 'field' at the end."""
+
+    def __init__(self, reduce=fast_stats.median, field="weight", name=None):
+        super().__init__(name)
+        self.reduce = reduce
+        self.field = field
+        self._values = []
+        self._last_ts = None
+
+    def process(self, item):
+        self._values.append(getattr(item, self.field))
+        self._last_ts = item.ts_ns
+        return ()
+
+    def finish(self):
+        if self._values:
+            yield Reading(self._last_ts, None, None)._replace(**{self.field: self.reduce(self._values)})
+
+
+# --- Decisions ---
+
+class StabilityGate(Stage):
+    """
+    Emits one Reading (the mean weight) each time the weight has stayed
+    within 'tolerance_g' for 'duration_s'; the weight must leave the band
+    before the gate fires again.
+    """
+
+    def __init__(self, tolerance_g=2.0, duration_s=1.0, name=None):
+        super().__init__(name)
+        self.tolerance_g = tolerance_g
+        self.duration_ns = int(duration_s * 1e9)
+        # The run in band: its first item (the band's centre) and a running
+        # sum, so a weight that stays put for hours holds no more than that.
+        self._first = None
+        self._sum = 0.0
+        self._count = 0
+        self._fired = False
+
+    def process(self, item):
+        first = self._first
+        if first is None or abs(item.weight - first.weight) > self.tolerance_g:
+            self._first = first = item
+            self._sum = 0.0
+            self._count = 0
+            self._fired = False
+        if self._fired:
+            return
+        self._sum += item.weight
+        self._count += 1
+        if item.ts_ns - first.ts_ns >= self.duration_ns:
+            self._fired = True
+            yield item._replace(weight=self._sum / self._count)
+
+
+class ChangeDetector(Stage):
+    """Turns stable weights into Events when they differ from the previous one by 'min_change_g'."""
+
+    def __init__(self, min_change_g=5.0, name=None):
+        super().__init__(name)
+        self.min_change_g = min_change_g
+        self.last = None
+
+    def process(self, item):
+        if self.last is None:
+            self.last = item.weight
+            yield Event(item.ts_ns, "placed", item.weight, {})
+            return
+        delta = item.weight - self.last
+        if abs(delta) >= self.min_change_g:
+            self.last = item.weight
+            yield Event(item.ts_ns, "removed" if delta < 0 else "added", item.weight, {"delta": delta})
+
+
+class MotionGate(Stage):
+    """
+    Emits a "stable_period" Event once the gyroscope has stayed below the
+    per-axis thresholds for 'duration_s', then waits for a fresh stable
+    period. Logs the status once per second, like the old trigger loop.
+
+    Args:
+        thresholds (tuple): Max |x|, |y|, |z| in deg/s.
+        magnitude (float): If given, compare sqrt(x^2 + y^2 + z^2) with it instead.
+        logger (logging.Logger): Where status lines go; this module's by default.
+        on_motion: Called with every Motion above the thresholds.
+    """
+
+    def __init__(self, thresholds, duration_s, magnitude=None, logger=None, on_motion=None, name=None):
+        super().__init__(name)
+        self.log = logger or log
+        self.on_motion = on_motion
+        self.thresholds = thresholds
+        self.magnitude = magnitude
+        self.duration_ns = int(duration_s * 1e9)
+        self.stable_since = None
+        self._last_status = 0
+
+    def reset(self):
+        self.stable_since = None
+        self._last_status = 0
+
+    def process(self, item):
+        import tracing
+
+        if item.gyro is None:
+            self.stable_since = None  # Reset stability on sensor read error
+            return
+        gx, gy, gz = item.gyro
+        if self.magnitude is not None:
+            stable = math.sqrt(gx ** 2 + gy ** 2 + gz ** 2) < self.magnitude
+        else:
+            tx, ty, tz = self.thresholds
+            stable = abs(gx) < tx and abs(gy) < ty and abs(gz) < tz
+        now = item.ts_ns
+
+        if now - self._last_status > 1e9:
+            elapsed = (now - self.stable_since) / 1e9 if self.stable_since is not None else 0
+            self.log.info("Status: %-8s | Stable Time: %4.1fs | Gx=%+6.1f, Gy=%+6.1f, Gz=%+6.1f",
+                     "STABLE" if stable else "UNSTABLE", elapsed, gx, gy, gz)
+            self._last_status = now
+
+        if not stable:
+            if self.on_motion is not None:
+                self.on_motion(item)
+            if self.stable_since is not None:
+                tracing.instant("stability.unstable")
+                self.log.info("Unstable condition detected. Resetting timer...")
+                self.reset()
+            return
+        if self.stable_since is None:
+            self.stable_since = now
+            tracing.instant("stability.stable")
+            self.log.info("Stable condition met. Starting timer...")
+            self._last_status = 0
+        elif now - self.stable_since >= self.duration_ns:
+            duration = (now - self.stable_since) / 1e9
+            self.reset()
+            yield Event(now, "stable_period", None, {"duration": duration})
+
+
+# --- Sinks ---
+#
+# Sinks act on each item and pass it on, so several can be chained.
+
+class CallbackSink(Stage):
+    def __init__(self, fn, name=None, workers=1):
+        super().__init__(name or getattr(fn, "__name__", None), workers)
+        self.fn = fn
+
+    def process(self, item):
+        self.fn(item)
+        yield item
+
+
+class LogSink(Stage):
+    def __init__(self, template="{weight:.2f} grams", level=logging.INFO, name=None):
+        super().__init__(name)
+        self.template = template
+        self.level = level
+
+    def process(self, item):
+        log.log(self.level, self.template.format(**item._asdict()))
+        yield item
+
+
+class BluetoothSink(Stage):
+    """
+    Sends each item formatted with 'template' through 'send' - bt.send_message
+    by default, or e.g. a delivery.DeliveryManager's send.
+    """
+
+    def __init__(self, template="Average weight: {weight:.2f} grams", send=None, name=None, workers=1):
+        super().__init__(name, workers)
+        self.template = template
+        if send is None:
+            from bt import send_message as send
+        self.send = send
+        self.failed = 0
+
+    def process(self, item):
+        message = self.template.format(**item._asdict())
+        if self.send(message):
+            log.info("Message sent successfully: %s", message)
+        else:
+            log.warning("Failed to send the message: %s", message)
+            self.failed += 1
+        yield item
+
+
+class SocketSink(Stage):
+    """Writes each item as a JSON line to a bt.transport_from_url() URL, reconnecting as needed."""
+
+    def __init__(self, url, name=None):
+        super().__init__(name)
+        import bt
+
+        self.transport = bt.transport_from_url(url)
+        self._sock = None
+
+    def process(self, item):
+        line = (json.dumps(item._asdict()) + "\n").encode()
+        try:
+            if self._sock is None:
+                self._sock = self.transport.connect()
+            self._sock.sendall(line)
+        except OSError as e:
+            log.warning("Socket sink %s: %s", self.transport.url, e)
+            self.dropped += 1
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+        yield item
+
+    def finish(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        return ()
+
+
+# --- Pipeline ---
+
+class Pipeline:
+    """
+    A source followed by stages. The last stage's output is collected and
+    returned by run() / run_inline() (keep it small, e.g. end in Aggregate
+    or drop items in a sink) unless collect=False.
+
+    Example:
+        readings = Pipeline(hx711_source(hx, duration_s=3),
+                            [MedianOf(5), Decode(hx), Aggregate()]).run_inline()
+    """
+
+    def __init__(self, source, stages, queue_size=QUEUE_SIZE, collect=True, drop_when_full=False):
+        self.source = source
+        self.stages = list(stages)
+        self.queue_size = queue_size
+        self.collect = collect
+        # Real-time sources drop new items instead of blocking when the first
+        # stage falls behind (counted as the source's drops).
+        self.drop_when_full = drop_when_full
+        self.source_stats = Stage("source")
+        self.results = []
+        self._queues = []
+        self._threads = []
+        self._stop = threading.Event()
+        self._started = None
+        self._finished = None
+
+    # --- Inline ---
+
+    def run_inline(self):
+        """Runs every stage on the calling thread; returns the collected output."""
+        self._started = time.monotonic()
+        source = iter(self.source)
+        while True:
+            t0 = time.perf_counter_ns()
+            item = next(source, _END)
+            self.source_stats._account(0, item is not _END, time.perf_counter_ns() - t0)
+            if item is _END or self._stop.is_set():
+                break
+            self._push_inline(0, [item])
+        for index, stage in enumerate(self.stages):
+            t0 = time.perf_counter_ns()
+            outputs = list(stage.finish())
+            stage._account(0, len(outputs), time.perf_counter_ns() - t0)
+            self._push_inline(index + 1, outputs)
+        self._finished = time.monotonic()
+        return self.results
+
+    def _push_inline(self, index, items):
+        for stage in self.stages[index:]:
+            if not items:
+                return
+            outputs = []
+            t0 = time.perf_counter_ns()
+            for item in items:
+                try:
+                    outputs.extend(stage.process(item))
+                except Exception as e:
+                    stage.errors += 1
+                    log.warning("Stage %s failed on %r: %s", stage.name, item, e)
+            stage._account(len(items), len(outputs), time.perf_counter_ns() - t0)
+            items = outputs
+        if self.collect:
+            self.results.extend(items)
+
+    # --- Threaded ---
+
+    def start(self):
+        """Starts the source and stage threads; use join() or run() to wait."""
+        self._started = time.monotonic()
+        self._queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        self._threads = [threading.Thread(target=self._run_source, name="pipeline-source", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            for worker in range(stage.workers):
+                self._threads.append(threading.Thread(
+                    target=self._run_stage, args=(index, stage, remaining),
+                    name="pipeline-%s-%d" % (stage.name, worker), daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        if not any(thread.is_alive() for thread in self._threads):
+            self._finished = self._finished or time.monotonic()
+            return True
+        return False
+
+    def run(self):
+        """Runs threaded until the source is exhausted and every stage has drained."""
+        self.start()
+        self.join()
+        return self.results
+
+    def stop(self):
+        """Ends the stream after the current source item; stages drain what is queued."""
+        self._stop.set()
+
+    def _emit(self, index, item):
+        # Output of stage 'index - 1' (or of the source for index 0).
+        if index < len(self._queues):
+            self._queues[index].put(item)
+        elif item is not _END and self.collect:
+            self.results.append(item)
+
+    def _run_source(self):
+        first = self._queues[0] if self._queues else None
+        source = iter(self.source)
+        while not self._stop.is_set():
+            t0 = time.perf_counter_ns()
+            try:
+                item = next(source, _END)
+            except Exception as e:
+                log.warning("Pipeline source failed: %s", e)
+                self.source_stats.errors += 1
+                break
+            self.source_stats._account(0, item is not _END, time.perf_counter_ns() - t0)
+            if item is _END:
+                break
+            if self.drop_when_full and first is not None:
+                try:
+                    first.put_nowait(item)
+                except queue.Full:
+                    self.source_stats.dropped += 1
+            else:
+                self._emit(0, item)
+        self._emit(0, _END)
+
+    def _run_stage(self, index, stage, remaining):
+        inbox = self._queues[index]
+        while True:
+            item = inbox.get()
+            if item is _END:
+                with stage._stats_lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if not last:
+                    inbox.put(_END)  # Let the sibling workers see it too
+                    return
+                t0 = time.perf_counter_ns()
+                outputs = list(stage.finish())
+                stage._account(0, len(outputs), time.perf_counter_ns() - t0)
+                for output in outputs:
+                    self._emit(index + 1, output)
+                self._emit(index + 1, _END)
+                if index + 1 == len(self.stages):
+                    self._finished = time.monotonic()
+                return
+            t0 = time.perf_counter_ns()
+            try:
+                outputs = list(stage.process(item))
+            except Exception as e:
+                stage.errors += 1
+                log.warning("Stage %s failed on %r: %s", stage.name, item, e)
+                outputs = []
+            stage._account(1, len(outputs), time.perf_counter_ns() - t0)
+            for output in outputs:
+                self._emit(index + 1, output)
+
+    # --- Reporting ---
+
+    def stats(self):
+        """Per stage: items in/out, items per second, busy fraction, queued input, drops, errors."""
+        end = self._finished or time.monotonic()
+        elapsed = max(end - self._started, 1e-9) if self._started else None
+        report = []
+        for index, stage in enumerate([self.source_stats] + self.stages):
+            queued = None
+            if index > 0 and self._queues:
+                queued = self._queues[index - 1].qsize()
+            count = stage.items_out if index == 0 else stage.items_in
+            workers = getattr(stage, "workers", 1)
+            report.append({
+                "stage": stage.name,
+                "in": stage.items_in,
+                "out": stage.items_out,
+                "perSecond": count / elapsed if elapsed else None,
+                "busy": stage.busy_ns / 1e9 / elapsed / workers if elapsed else None,
+                "queued": queued,
+                "dropped": stage.dropped,
+                "errors": stage.errors,
+            })
+        return report
+
+    def format_stats(self):
+        lines = ["%-16s %8s %8s %10s %6s %7s %8s" % ("stage", "in", "out", "items/s", "busy", "queued", "dropped")]
+        for row in self.stats():
+            lines.append("%-16s %8d %8d %10.0f %5.0f%% %7s %8d" % (
+                row["stage"], row["in"], row["out"], row["perSecond"] or 0, (row["busy"] or 0) * 100,
+                "-" if row["queued"] is None else row["queued"], row["dropped"]))
+        return "\n".join(lines)
+
+
+# --- Shared Configurations ---
+
+def tare(hx, samples, per_sample=5, power_cycle=True, on_error=None):
+    """
+    Tares the empty scale: the median of 'samples' readings, each the median
+    of 'per_sample' conversions like hx.read_median(per_sample), becomes hx's
+    offset. There are no fixed delays: every read waits for its conversion,
+    and the first one after the power cycle waits out the settling time.
+
+    Args:
+        hx (HX711): Configured sensor.
+        samples (int): Filtered readings the offset is the median of.
+        per_sample (int): Conversions per filtered reading.
+        power_cycle (bool): Power the HX711 down and up first; a failure there
+            is logged and taring goes on.
+        on_error: Passed to hx711_source().
+
+    Returns:
+        float: The offset now set on hx, or None if no reading succeeded
+        (hx is left unchanged).
+    """
+    import tracing
+
+    if power_cycle:
+        try:
+            with tracing.span("tare.power_cycle"):
+                hx.power_down()
+                hx.power_up()
+        except Exception as e:
+            log.warning("Error during power cycle before tare: %s", e)  # The reads may still work
+    taring = Pipeline(hx711_source(hx, count=samples * per_sample, on_error=on_error),
+                      [MedianOf(per_sample), Aggregate(fast_stats.median, field="raw")])
+    with tracing.span("tare.sampling") as sampling_span:
+        result = taring.run_inline()
+        sampling_span.set(readings=taring.stages[0].items_out)
+    log.debug("Tare stages: %s", taring.stats())
+    if not result:
+        return None
+    offset = result[0].raw
+    hx.set_offset(offset)
+    return offset
+
+
+# --- Benchmark ---
+
+def _synthetic_weights(n, seed=7):
+    import random
+
+    rng = random.Random(seed)
+    weights, level = [], 480.0
+    for i in range(n):
+        if i % 400 == 200:
+            level -= rng.uniform(10, 40)  # A sip
+        w = level + rng.gauss(0, 0.4)
+        if rng.random() < 0.01:
+            w += rng.choice((-1, 1)) * rng.uniform(50, 500)  # Bus glitch
+        weights.append(w)
+    return weights
+
+
+def _bench(n=200000):
+    weights = _synthetic_weights(n)
+
+    def chain():
+        return [RejectOutliers(), Smooth(), StabilityGate(tolerance_g=2.0, duration_s=1.0),
+                ChangeDetector(), CallbackSink(lambda event: None, name="events")]
+
+    for label, method in (("inline", "run_inline"), ("threaded", "run")):
+        pipe = Pipeline(replay_source(weights, interval_s=0.0125), chain())
+        start = time.perf_counter()
+        events = getattr(pipe, method)()
+        elapsed = time.perf_counter() - start
+        print(f"\n{label}: {n} samples in {elapsed:.2f} s ({n / elapsed:,.0f} samples/s), "
+              f"{len(events)} events ({sum(e.type != 'placed' for e in events)} sips)")
+        print(pipe.format_stats())
+
+    # A sink that waits on I/O (1 ms per item) with 1 and 4 workers.
+    for workers in (1, 4):
+        sink = CallbackSink(lambda item: time.sleep(0.001), name="slow_sink", workers=workers)
+        pipe = Pipeline(replay_source(weights[:2000]), [sink], collect=False)
+        start = time.perf_counter()
+        pipe.run()
+        print(f"\nslow sink, {workers} worker(s): {2000 / (time.perf_counter() - start):,.0f} items/s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        _bench()
+    else:
+        print("Usage: python3 pipeline.py bench")
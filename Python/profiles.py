@@ -0,0 +1,346 @@
+# File: profiles.py
+#
+# Container profiles, so switching bottles doesn't mean deleting
+# scale_config.json and sitting through a tare and max-weight capture.
+#
+# scale_config.json keeps describing the scale itself (offset of the empty
+# scale, reference unit). Each profile describes one container, as gross
+# weights on that tared scale:
+#
+#   tareWeight   - the empty container
+#   fullWeight   - the container when full (replaces initialMaxWeight)
+#   calibration  - optional calibration.py model used while it is on the scale,
+#                  fitted by `profiles.py calibrate` against the scale's offset
+#
+# The first stable reading after a bottle is put down is matched against all
+# profiles (recognize()), so a swap costs one reading rather than a re-tare.
+#
+# The file is replaced atomically on every change, and every process holding
+# a ProfileStore picks up changes by calling reload_if_changed(), which only
+# stats the file.
+#
+# Usage:
+#   python3 profiles.py list
+#   python3 profiles.py add <name> [fullWeight]   # measures on the scale when asked
+#   python3 profiles.py calibrate <name> 100 250 500   # place each weight (grams) when asked
+#   python3 profiles.py remove <name>
+#   python3 profiles.py bench                     # recognition and reload cost, no hardware
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+log = logging.getLogger("drinksync.profiles")
+
+# --- Configuration ---
+PROFILES_FILE = "container_profiles.json"
+RECOGNITION_TOLERANCE_G = 15.0  # Allowed distance outside a profile's [tare, full] range
+PROFILE_SAMPLES = 15  # Samples averaged when measuring a new profile
+DOUT_PIN = 5  # Data pin
+PD_SCK_PIN = 6  # Clock pin
+
+
+class ContainerProfile:
+    """Weights of one container on the tared scale, in grams."""
+
+    def __init__(self, name, tare_weight, full_weight, calibration=None):
+        if full_weight <= tare_weight:
+            raise ValueError("Profile '%s': full weight must exceed the tare weight" % name)
+        self.name = name
+        self.tare_weight = float(tare_weight)
+        self.full_weight = float(full_weight)
+        self.calibration = calibration  # calibration.CalibrationModel.to_dict() or None
+
+    @property
+    def capacity(self):
+        return self.full_weight - self.tare_weight
+
+    def distance(self, weight):
+        """Grams by which 'weight' lies outside [tare_weight, full_weight] (0 inside)."""
+        if weight < self.tare_weight:
+            return self.tare_weight - weight
+        if weight > self.full_weight:
+            return weight - self.full_weight
+        return 0.0
+
+    def to_dict(self):
+        data = {"tareWeight": self.tare_weight, "fullWeight": self.full_weight}
+        if self.calibration is not None:
+            data["calibration"] = self.calibration
+        return data
+
+    @classmethod
+    def from_dict(cls, name, data):
+        return cls(name, data["tareWeight"], data["fullWeight"], data.get("calibration"))
+
+
+class ProfileStore:
+    """
+    Profiles kept in memory and mirrored to 'path'.
+
+    Compiled calibration tables are cached per profile, so activating a
+    profile never recompiles one.
+    """
+
+    def __init__(self, path=PROFILES_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self.profiles = {}
+        self.active = None
+        self._tables = {}
+        self._stamp = None
+        self.reload_if_changed()
+
+    # --- File handling ---
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def reload_if_changed(self):
+        """Re-reads the file if it changed since the last load. Returns True if it did."""
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return False
+        profiles, active = {}, None
+        if stamp is not None:
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                for name, entry in data.get("profiles", {}).items():
+                    profiles[name] = ContainerProfile.from_dict(name, entry)
+                active = data.get("active")
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # Keep serving the previous profiles rather than none.
+                log.warning("Could not load profiles from %s: %s", self.path, e)
+                self._stamp = stamp
+                return False
+        with self._lock:
+            self.profiles = profiles
+            self.active = active if active in profiles else None
+            self._tables = {}
+            self._stamp = stamp
+        log.info("Loaded %d container profile(s) from %s", len(profiles), self.path)
+        return True
+
+    def save(self):
+        """Writes all profiles atomically (temp file, fsync, rename)."""
+        with self._lock:
+            data = {"active": self.active,
+                    "profiles": {name: p.to_dict() for name, p in self.profiles.items()}}
+        # A unique temp file, so two processes saving at once can't interleave
+        # their writes into one file and rename a mix of both.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                        prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._stamp = self._file_stamp()
+
+    # --- Profiles ---
+
+    def get(self, name):
+        return self.profiles.get(name)
+
+    def put(self, profile):
+        with self._lock:
+            self.profiles[profile.name] = profile
+            self._tables.pop(profile.name, None)
+        self.save()
+
+    def remove(self, name):
+        with self._lock:
+            removed = self.profiles.pop(name, None)
+            self._tables.pop(name, None)
+            if self.active == name:
+                self.active = None
+        if removed is not None:
+            self.save()
+        return removed
+
+    def activate(self, name):
+        """Marks 'name' as the container on the scale (persisted) and returns its profile."""
+        profile = self.profiles[name]
+        if self.active != name:
+            self.active = name
+            self.save()
+        return profile
+
+    def active_profile(self):
+        return self.profiles.get(self.active) if self.active else None
+
+    def table(self, name):
+        """Compiled calibration (see calibration.CalibrationModel.compile()) for a profile, or None if it has none."""
+        profile = self.profiles.get(name)
+        if profile is None or profile.calibration is None:
+            return None
+        table = self._tables.get(name)
+        if table is None:
+            import calibration
+
+            table = calibration.CalibrationModel.from_dict(profile.calibration).compile()
+            self._tables[name] = table
+        return table
+
+    def recognize(self, weight, tolerance=RECOGNITION_TOLERANCE_G):
+        """
+        Finds the profile matching a gross weight reading.
+
+        A profile matches when the weight lies within 'tolerance' of its
+        [tare, full] range. The active profile wins if it matches (the same
+        bottle put back); otherwise the closest range wins, ties going to the
+        container whose full weight is nearest (a new bottle is usually full).
+
+        Returns:
+            ContainerProfile or None
+        """
+        profiles = self.profiles
+        active = profiles.get(self.active) if self.active else None
+        if active is not None and active.distance(weight) <= tolerance:
+            return active
+        best, best_key = None, None
+        for profile in profiles.values():
+            distance = profile.distance(weight)
+            if distance > tolerance:
+                continue
+            key = (distance, abs(profile.full_weight - weight))
+            if best_key is None or key < best_key:
+                best, best_key = profile, key
+        return best
+
+
+# --- Command Line ---
+
+def _measure(hx, message):
+    input(message + " Press Enter...")
+    return hx.get_weight(PROFILE_SAMPLES)
+
+
+def _open_scale():
+    """Returns the HX711 set up with the saved offset and reference unit, and the saved config."""
+    import calibration
+    from hx711 import HX711
+
+    with open(calibration.CONFIG_FILE, "r") as f:
+        config = json.load(f)
+    hx = HX711(DOUT_PIN, PD_SCK_PIN, read_timeout=1.0)
+    hx.set_reading_format("MSB", "MSB")
+    hx.set_offset(config["offset"])
+    hx.set_reference_unit(config["referenceUnit"])
+    return hx, config
+
+
+def _add_profile(store, name, full_weight=None):
+    import calibration
+
+    hx, _ = _open_scale()
+    # Measure in the same grams the scale reports: through the multi-point
+    # calibration when there is one, as scale_persistent_tare does.
+    table = calibration.load_table(calibration.CONFIG_FILE)
+    if table is not None:
+        hx.set_calibration(table.convert)
+    tare_weight = _measure(hx, "Put the EMPTY container on the scale.")
+    if full_weight is None:
+        full_weight = _measure(hx, "Put the FULL container on the scale.")
+    hx.power_down()
+    store.put(ContainerProfile(name, tare_weight, full_weight))
+    print(f"Saved '{name}': tare {tare_weight:.1f} g, full {full_weight:.1f} g")
+
+
+def _calibrate_profile(store, name, weights, kind=None):
+    """
+    Fits a calibration model for the container 'name' and stores it in its profile.
+
+    Args:
+        store (ProfileStore): Profiles; 'name' must exist.
+        name (str): Profile to calibrate.
+        weights (list): Reference weights in grams, placed in turn.
+        kind (str): calibration.MODELS entry (default: calibration.DEFAULT_MODEL).
+
+    Returns:
+        bool: False if there is no such profile.
+    """
+    import calibration
+
+    profile = store.get(name)
+    if profile is None:
+        return False
+    hx, config = _open_scale()
+    offset, points = calibration.calibrate(hx, weights)
+    hx.power_down()
+    # calibrate() tares afresh, but the profile's model is applied to counts
+    # net of the scale's saved offset, so move the points onto that offset.
+    shift = offset - config["offset"]
+    model = calibration.CalibrationModel.fit([(net + shift, grams) for net, grams in points],
+                                             kind or calibration.DEFAULT_MODEL)
+    for (net, grams), error in zip(model.points, model.residuals()):
+        print(f"  {grams:8.1f} g  {net:12.1f} counts  residual {error:+.2f} g")
+    profile.calibration = model.to_dict()
+    store.put(profile)
+    print(f"Saved {model.kind} calibration ({len(points)} points) for '{name}'")
+    return True
+
+
+def _bench():
+    path = os.path.join(tempfile.mkdtemp(), PROFILES_FILE)
+    store = ProfileStore(path)
+    for i in range(50):
+        tare = 150.0 + 7.3 * i
+        store.profiles["bottle-%d" % i] = ContainerProfile("bottle-%d" % i, tare, tare + 330 + 10 * (i % 7))
+    start = time.perf_counter()
+    store.save()
+    print(f"save (50 profiles):       {(time.perf_counter() - start) * 1e3:8.2f} ms")
+
+    iterations = 20000
+    start = time.perf_counter()
+    for i in range(iterations):
+        store.recognize(200.0 + (i % 700))
+    print(f"recognize():              {(time.perf_counter() - start) / iterations * 1e6:8.2f} us")
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        store.reload_if_changed()
+    print(f"reload_if_changed() noop: {(time.perf_counter() - start) / iterations * 1e6:8.2f} us")
+
+    other = ProfileStore(path)
+    other.put(ContainerProfile("new", 100, 600))
+    start = time.perf_counter()
+    store.reload_if_changed()
+    print(f"reload after change:      {(time.perf_counter() - start) * 1e3:8.2f} ms "
+          f"({len(store.profiles)} profiles)")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "list"
+    if command == "bench":
+        _bench()
+        sys.exit(0)
+    store = ProfileStore()
+    if command == "list":
+        for name, p in sorted(store.profiles.items()):
+            marker = "*" if name == store.active else " "
+            print(f"{marker} {name: <20} tare {p.tare_weight:8.1f} g  full {p.full_weight:8.1f} g"
+                  f"{'  (calibrated)' if p.calibration else ''}")
+    elif command == "add" and len(sys.argv) > 2:
+        _add_profile(store, sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else None)
+    elif command == "calibrate" and len(sys.argv) > 3:
+        if not _calibrate_profile(store, sys.argv[2], [float(w) for w in sys.argv[3:]]):
+            print("No such profile; add it first.")
+    elif command == "remove" and len(sys.argv) > 2:
+        print("Removed." if store.remove(sys.argv[2]) else "No such profile.")
+    else:
+        print("Usage: python3 profiles.py list | add <name> [fullWeight] | calibrate <name> <grams> [<grams> ...]"
+              " | remove <name> | bench")
@@ -0,0 +1,203 @@
+# File: sample_hub.py
+#
+# Publish/subscribe fan-out of one HX711 sample stream.
+#
+# Instead of every consumer (trigger loop, calibration, diagnostics) driving
+# the bus itself and splitting the conversion rate between them, a single
+# producer publishes each conversion into a fixed-size ring and every
+# subscriber reads it through its own cursor, filter and rate limit.
+#
+# The producer only takes a short lock to store the sample and wake waiters;
+# it never waits for subscribers. A subscriber that falls more than a ring
+# length behind skips ahead and counts the samples it missed.
+
+import logging
+import threading
+import time
+from collections import namedtuple
+
+log = logging.getLogger("drinksync.hub")
+
+# --- Configuration ---
+HUB_CAPACITY = 1024  # Samples kept for subscribers (~100 s at 10 SPS)
+
+# seq: publish counter, ts_ns: time.monotonic_ns() of the conversion,
+# value: raw HX711 reading (or whatever the producer publishes).
+Sample = namedtuple("Sample", ["seq", "ts_ns", "value"])
+
+
+class SampleHub:
+    """
+    Fan-out hub for one sample stream.
+
+    Example:
+        hub = SampleHub()
+        hub.start_producer(hx.read_long)
+        with hub.subscribe(max_rate_hz=2) as sub:
+            for sample in sub:
+                ...
+    """
+
+    def __init__(self, capacity=HUB_CAPACITY):
+        self.capacity = capacity
+        self._ring = [None] * capacity
+        self._seq = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self._producer = None
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def publish(self, value, ts_ns=None):
+        """Stores one sample and wakes waiting subscribers. Never blocks on them."""
+        if ts_ns is None:
+            ts_ns = time.monotonic_ns()
+        with self._cond:
+            self._seq += 1
+            self._ring[self._seq % self.capacity] = Sample(self._seq, ts_ns, value)
+            self._cond.notify_all()
+
+    def start_producer(self, read_fn, name="hub-producer", timestamped=False):
+        """
+        Starts a thread that publishes read_fn() in a loop, e.g. hx.read_long
+        (which blocks until the next conversion is ready).
+
+        With timestamped=True, read_fn returns (value, ts_ns) - e.g.
+        hx.read_sample - and samples carry that time instead of the publish time.
+        """
+
+        def _produce():
+            while not self._closed:
+                try:
+                    result = read_fn()
+                except Exception as e:
+                    log.warning("Sample producer read failed: %s", e)
+                    time.sleep(0.1)
+                    continue
+                if timestamped:
+                    self.publish(*result)
+                else:
+                    self.publish(result)
+
+        self._producer = threading.Thread(target=_produce, name=name, daemon=True)
+        self._producer.start()
+        return self._producer
+
+    def close(self):
+        """Stops the producer and releases every blocked subscriber."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def subscribe(self, filter=None, max_rate_hz=None, from_latest=True):
+        """
+        Creates an independent cursor on the stream.
+
+        Args:
+            filter (callable): Called with each Sample; return a (possibly
+                modified) Sample to deliver it or None to skip it.
+            max_rate_hz (float): Deliver at most this many samples per second
+                of sample time; intermediate samples are skipped.
+            from_latest (bool): Start after the newest sample instead of at
+                the oldest one still in the ring.
+
+        Returns:
+            Subscription
+        """
+        with self._cond:
+            if from_latest:
+                cursor = self._seq
+            else:
+                cursor = max(0, self._seq - self.capacity)
+        return Subscription(self, cursor, filter, max_rate_hz)
+
+    # --- Used by Subscription ---
+
+    def _next_after(self, cursor, timeout, subscription=None):
+        """
+        Returns (sample, skipped) for the first sample after 'cursor', waiting
+        up to 'timeout'; (None, 0) at once if the hub or 'subscription' closes.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._seq <= cursor:
+                if self._closed or (subscription is not None and subscription.closed):
+                    return None, 0
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None, 0
+                self._cond.wait(remaining)
+            oldest = max(1, self._seq - self.capacity + 1)
+            skipped = max(0, oldest - (cursor + 1))
+            return self._ring[max(cursor + 1, oldest) % self.capacity], skipped
+
+
+class Subscription:
+    """A subscriber's cursor into a SampleHub. Iterate it or call get()."""
+
+    def __init__(self, hub, cursor, filter, max_rate_hz):
+        self.hub = hub
+        self.cursor = cursor
+        self.filter = filter
+        self.min_interval_ns = int(1e9 / max_rate_hz) if max_rate_hz else 0
+        self.last_delivered_ns = None
+        self.delivered = 0
+        self.overruns = 0  # Samples lost because this subscriber fell a full ring behind
+        self.closed = False
+
+    def get(self, timeout=None):
+        """
+        Returns the next Sample that passes the filter and rate limit, or None
+        if 'timeout' expires or the hub/subscription is closed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.closed:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            sample, skipped = self.hub._next_after(self.cursor, remaining, self)
+            if sample is None:
+                return None
+            self.overruns += skipped
+            self.cursor = sample.seq
+
+            if (self.min_interval_ns and self.last_delivered_ns is not None
+                    and sample.ts_ns - self.last_delivered_ns < self.min_interval_ns):
+                continue
+            if self.filter is not None:
+                sample = self.filter(sample)
+                if sample is None:
+                    continue
+            self.last_delivered_ns = sample.ts_ns
+            self.delivered += 1
+            return sample
+        return None
+
+    def drain(self):
+        """Returns every pending sample without waiting."""
+        samples = []
+        while True:
+            sample = self.get(timeout=0)
+            if sample is None:
+                return samples
+            samples.append(sample)
+
+    def close(self):
+        """Ends the subscription, releasing a get() or iteration blocked on it."""
+        with self.hub._cond:
+            self.closed = True
+            self.hub._cond.notify_all()
+
+    def __iter__(self):
+        while True:
+            sample = self.get()
+            if sample is None:
+                return
+            yield sample
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -1,14 +1,13 @@
 import time
 import sys
-import numpy as np
-import RPi.GPIO as GPIO
+import fast_stats
 from hx711 import HX711
-from bt import send_message  # Import the send_message function
+import pipeline
 
 
 def cleanAndExit():
     print("\nCleaning up...")
-    GPIO.cleanup()
+    hx.gpio.cleanup()
     print("Bye!")
     sys.exit()
 
@@ -22,24 +21,22 @@ hx.set_reading_format("MSB", "MSB")
 
 # Function to stabilize tare
 def stable_tare(samples=20):
-    readings = []
     print("Taring... Please wait.")
-    for _ in range(samples):
-        readings.append(hx.get_weight(5))
-        time.sleep(0.1)
-    avg_tare = np.median(readings)
-    hx.set_offset(avg_tare)
+    # The same tare as scale_persistent_tare.py: median of 'samples' median-of-5 raw readings
+    avg_tare = pipeline.tare(hx, samples)
+    if avg_tare is None:
+        print("Tare failed: no valid readings.")
+        cleanAndExit()
     print(f"Tare complete. Offset set to: {avg_tare}")
 
 
 # Function to get stable weight reading
 def get_filtered_weight(samples=15):
     readings = [hx.get_weight(5) for _ in range(samples)]
-    return np.median(readings)  # Median helps remove noise
+    return fast_stats.median(readings)  # Median helps remove noise
 
 
-# Reset and Tare
-hx.reset()
+# Tare (power cycles the HX711 first)
 stable_tare()
 
 referenceUnit = 425.37  # Adjust this based on calibration
@@ -53,31 +50,25 @@ def take_reading():
     Takes a 3-second average reading from the scale and sends it as a message using bt.py.
     """
     try:
-        start_time = time.time()
-        readings = []
-
-        # Collect readings for 3 seconds
-        while time.time() - start_time < 3:
-            readings.append(hx.get_weight(5))
-            time.sleep(0.1)  # Small delay to avoid excessive sampling
-
-        # Calculate the average weight
-        average_weight = np.mean(readings)
-
-        # Send the average weight as a message using the send_message function
-        if send_message(f"Average weight: {average_weight:.2f} grams"):
-            print(
-                f"Message sent successfully: Average weight: {average_weight:.2f} grams"
-            )
-        else:
+        # Collect readings for 3 seconds, one per conversion as the HX711
+        # signals it, and send their average
+        sink = pipeline.BluetoothSink("Average weight: {weight:.2f} grams")
+        reading = pipeline.Pipeline(
+            pipeline.hx711_source(hx, duration_s=3),
+            [pipeline.MedianOf(5),
+             pipeline.Decode(hx),
+             pipeline.CallbackSink(lambda r: print(f"Raw Value: {r.weight}")),  # Debugging info
+             pipeline.Aggregate(fast_stats.mean),
+             sink])
+        average_weight = reading.run_inline()[0].weight
+        if sink.failed:
             print("Failed to send the message.")
-
-        print(f"Raw Values: {readings}")  # Debugging info
+        else:
+            print(f"Message sent successfully: Average weight: {average_weight:.2f} grams")
         print(f"Average Weight Sent: {average_weight:.2f} grams\n")
 
         hx.power_down()
-        hx.power_up()
-        time.sleep(0.5)
+        hx.power_up()  # The next read waits out the settling time
 
     except Exception as e:
         print(f"Error during reading: {e}")
@@ -0,0 +1,569 @@
+# File: scale_daemon.py
+#
+# Long-running daemon that owns the HX711 and the MPU6050 and answers queries
+# from local processes over a Unix domain socket, so clients never touch GPIO
+# or re-tare the scale.
+#
+# Protocol: one request per line, one response per line, on a persistent
+# connection. A request is a command optionally followed by one argument:
+#
+#   PING             -> OK {"pong": true}
+#   WEIGHT           -> OK {"weight": 123.4, "ts": 1712345678.9, "ts_ns": 8123456789, "seq": 42}
+#   FILTERED         -> OK {"weight": 123.1, "samples": 15, "ts": ...}
+#   STATE            -> OK {"stable": true, "stable_for": 2.3, "gyro": [x, y, z]}
+#   EVENTS [since]   -> OK {"events": [{"seq": 7, "type": "stable_period", ...}, ...]}
+#                       gyroscope: "stable", "unstable", "stable_period";
+#                       weight: "placed", "added", "removed" (with "delta")
+#   HEALTH           -> OK {"state": "ok", "stalls": 0, "sps": 10.01, "missed": 0, ...}
+#
+# "ts" is wall-clock time; "ts_ns" is the time.monotonic_ns() of the HX711
+# data-ready edge, for computing intervals between conversions.
+#   SNAPSHOT         -> OK {...all of the above...}
+#
+# Errors are reported as "ERR <message>".
+#
+# Usage:
+#   python3 scale_daemon.py                 # run the daemon
+#   python3 scale_daemon.py query WEIGHT    # one-off client query
+#   python3 scale_daemon.py bench           # round-trip latency without hardware
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import statistics
+import sys
+import threading
+import time
+from collections import deque
+
+import calibration
+import duty_cycle
+import logging_setup
+import pipeline
+from sample_hub import SampleHub
+
+log = logging.getLogger("drinksync.daemon")
+
+# --- Configuration ---
+SOCKET_PATH = "/tmp/drinksync_scale.sock"
+CONFIG_FILE = "scale_config.json"  # Written by scale_persistent_tare.py
+DEFAULT_REFERENCE_UNIT = 425.37
+STABLE_TARE_SAMPLES = 20  # Only used when no configuration file exists
+DOUT_PIN = 5  # Data pin
+PD_SCK_PIN = 6  # Clock pin
+READ_TIMEOUT_S = 1.0  # A conversion later than this is a stall; the HX711 is power cycled
+GYROSCOPE_I2C_ADDRESS = 0x68
+FILTER_WINDOW = 15  # Conversions in the median-filtered weight
+EVENT_HISTORY = 200  # Recent events kept for EVENTS queries
+HISTORY_DB = "drinksync_history.db"  # stable_period events are recorded here; None disables
+# Clock the HX711 from a dedicated process writing a shared-memory ring (see
+# shm_acquisition.py) instead of a thread competing for the GIL.
+USE_SHM_ACQUISITION = False
+
+# --- Stability Detection (same meaning as in stability_scale_trigger.py) ---
+GYRO_THRESHOLD_X = 4  # deg/s
+GYRO_THRESHOLD_Y = 4
+GYRO_THRESHOLD_Z = 4
+STABILITY_DURATION_REQUIRED = 3.0  # seconds
+SAMPLE_INTERVAL = 0.1  # seconds between gyro polls
+
+# --- Weight Events ---
+# Every conversion goes through outlier rejection, smoothing, a stability gate
+# and a change detector (pipeline.py); a settled weight differing from the
+# last one by WEIGHT_CHANGE_MIN_G becomes a "placed", "added" or "removed"
+# event. The WEIGHT and FILTERED queries see every conversion unfiltered.
+WEIGHT_STABLE_TOLERANCE_G = 2.0  # The smoothed weight must stay within this band...
+WEIGHT_STABLE_DURATION_S = 1.0  # ...for this long to count as settled
+WEIGHT_CHANGE_MIN_G = 5.0
+EVENTS_SOCKET_URL = None  # Also write weight events as JSON lines here (bt.transport_from_url(), e.g. "tcp://127.0.0.1:9713")
+
+# --- Duty Cycling ---
+# In the hours the history (HISTORY_DB) shows as quiet, poll the gyroscope
+# less often and power the HX711 down between sparse conversions (see
+# duty_cycle.py); motion restores full rate at once. The shared-memory
+# acquisition process keeps converting at full rate.
+DUTY_CYCLE_ENABLED = True
+
+
+class ScaleState:
+    """
+    Latest sensor data shared between the acquisition threads and the socket
+    server. Writers hold the lock only to swap in new values, so queries never
+    wait on the sensors.
+    """
+
+    def __init__(self, filter_window=FILTER_WINDOW, event_history=EVENT_HISTORY):
+        self._lock = threading.Lock()
+        self.weight = None
+        self.weight_ts = None
+        self.weight_ts_ns = None
+        self.weight_seq = 0
+        self.window = deque(maxlen=filter_window)
+        self.stable = False
+        self.stable_since = None
+        self.gyro = None
+        self.gyro_ts = None
+        self.events = deque(maxlen=event_history)
+        self.event_seq = 0
+        self.health_source = None  # Callable returning the HX711 health snapshot
+
+    def update_weight(self, weight, ts=None, ts_ns=None):
+        if ts_ns is None:
+            ts_ns = time.monotonic_ns()
+        if ts is None:
+            # Wall-clock time of the conversion, not of this update.
+            ts = time.time() - (time.monotonic_ns() - ts_ns) / 1e9
+        with self._lock:
+            self.weight = weight
+            self.weight_ts = ts
+            self.weight_ts_ns = ts_ns
+            self.weight_seq += 1
+            self.window.append(weight)
+
+    def update_motion(self, gyro, stable, ts=None):
+        with self._lock:
+            self.gyro = gyro
+            self.gyro_ts = ts if ts is not None else time.time()
+            if stable and not self.stable:
+                self.stable_since = self.gyro_ts
+            elif not stable:
+                self.stable_since = None
+            self.stable = stable
+
+    def add_event(self, event_type, **fields):
+        with self._lock:
+            self.event_seq += 1
+            event = {"seq": self.event_seq, "type": event_type, "ts": time.time()}
+            event.update(fields)
+            self.events.append(event)
+            return event
+
+    # --- Queries ---
+
+    def latest_weight(self):
+        with self._lock:
+            return {"weight": self.weight, "ts": self.weight_ts, "ts_ns": self.weight_ts_ns,
+                    "seq": self.weight_seq}
+
+    def filtered_weight(self):
+        with self._lock:
+            values = sorted(self.window)
+            ts = self.weight_ts
+        if not values:
+            return {"weight": None, "samples": 0, "ts": None}
+        mid = len(values) // 2
+        median = values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+        return {"weight": median, "samples": len(values), "ts": ts}
+
+    def stability(self):
+        with self._lock:
+            stable_for = (time.time() - self.stable_since) if self.stable_since else 0.0
+            return {"stable": self.stable, "stable_for": stable_for,
+                    "gyro": self.gyro, "ts": self.gyro_ts}
+
+    def recent_events(self, since=0):
+        with self._lock:
+            return {"events": [e for e in self.events if e["seq"] > since]}
+
+    def sensor_health(self):
+        if self.health_source is None:
+            return {"state": "unknown"}
+        return self.health_source()
+
+    def snapshot(self):
+        result = {"weight": self.latest_weight(), "filtered": self.filtered_weight(),
+                  "state": self.stability(), "health": self.sensor_health()}
+        result.update(self.recent_events())
+        return result
+
+
+# --- Socket Server ---
+
+class ScaleRequestHandler(socketserver.StreamRequestHandler):
+    """Answers newline-terminated requests until the client disconnects."""
+
+    def handle(self):
+        state = self.server.state
+        for line in self.rfile:
+            parts = line.decode(errors="replace").split()
+            if not parts:
+                continue
+            command = parts[0].upper()
+            try:
+                if command == "PING":
+                    result = {"pong": True}
+                elif command == "WEIGHT":
+                    result = state.latest_weight()
+                elif command == "FILTERED":
+                    result = state.filtered_weight()
+                elif command == "STATE":
+                    result = state.stability()
+                elif command == "EVENTS":
+                    result = state.recent_events(int(parts[1]) if len(parts) > 1 else 0)
+                elif command == "HEALTH":
+                    result = state.sensor_health()
+                elif command == "SNAPSHOT":
+                    result = state.snapshot()
+                else:
+                    self.wfile.write(b"ERR unknown command\n")
+                    continue
+                response = "OK " + json.dumps(result, separators=(",", ":")) + "\n"
+            except ValueError as e:
+                response = f"ERR {e}\n"
+            self.wfile.write(response.encode())
+
+
+class ScaleSocketServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, state):
+        # Remove a stale socket left behind by a previous run.
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, ScaleRequestHandler)
+        self.state = state
+        self.path = path
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def serve(state, path=SOCKET_PATH):
+    """Starts the socket server on a daemon thread and returns it."""
+    server = ScaleSocketServer(path, state)
+    threading.Thread(target=server.serve_forever, name="scale-socket", daemon=True).start()
+    return server
+
+
+# --- Client ---
+
+class ScaleClient:
+    """
+    Persistent connection to the daemon. Reusing one client avoids the
+    connect() cost on every query.
+    """
+
+    def __init__(self, path=SOCKET_PATH, timeout=1.0):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.reader = self.sock.makefile("rb")
+
+    def query(self, command):
+        """
+        Sends one request and returns the decoded response.
+
+        Raises:
+            RuntimeError: If the daemon answered with an error.
+        """
+        self.sock.sendall(command.encode() + b"\n")
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Scale daemon closed the connection")
+        status, _, body = line.decode().rstrip("\n").partition(" ")
+        if status != "OK":
+            raise RuntimeError(body)
+        return json.loads(body)
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def query(command, path=SOCKET_PATH, timeout=1.0):
+    """One-off query helper: connects, sends 'command' and returns the result."""
+    with ScaleClient(path, timeout) as client:
+        return client.query(command)
+
+
+# --- Daemon (hardware owner) ---
+
+class ScaleDaemon:
+    """
+    Owns the sensors and keeps a ScaleState up to date. Every conversion is
+    published once to 'hub', so in-process consumers (calibration,
+    diagnostics) can subscribe instead of driving the HX711 themselves.
+    """
+
+    def __init__(self, state, config_file=CONFIG_FILE):
+        self.state = state
+        self.config_file = config_file
+        self.hx = None
+        self.acquisition = None
+        self.offset = None
+        self.reference_unit = DEFAULT_REFERENCE_UNIT
+        self.convert = None  # Compiled multi-point calibration, if configured
+        self.gyro_sensor = None
+        self.hub = SampleHub()
+        self.history = None
+        self.scheduler = None
+        self._stop = threading.Event()
+
+    def setup(self):
+        from mpu6050 import mpu6050
+
+        config = self._load_config()
+        if config is not None:
+            self.offset = config["offset"]
+            self.reference_unit = config["referenceUnit"]
+            log.info("Using offset %s and reference unit %s from %s",
+                     self.offset, self.reference_unit, self.config_file)
+            table = calibration.load_table(self.config_file)
+            if table is not None:
+                self.convert = table.convert
+                log.info("Using %s calibration from %s",
+                         config[calibration.CALIBRATION_KEY]["model"], self.config_file)
+        else:
+            log.warning("No usable %s; taring with the default reference unit. "
+                        "Run scale_persistent_tare.py once to create it.", self.config_file)
+
+        if USE_SHM_ACQUISITION:
+            from shm_acquisition import AcquisitionProcess
+
+            self.acquisition = AcquisitionProcess(DOUT_PIN, PD_SCK_PIN)
+            self.acquisition.start()
+            self.state.health_source = self._ring_health
+            if self.offset is None:
+                self.offset = self._tare_from_ring()
+        else:
+            from hx711 import HX711
+
+            self.hx = HX711(DOUT_PIN, PD_SCK_PIN, read_timeout=READ_TIMEOUT_S)
+            self.hx.set_reading_format("MSB", "MSB")
+            self.state.health_source = self._hx_health
+            if self.offset is None:
+                # The tare the scripts use, one conversion per reading to keep start-up short
+                self.offset = pipeline.tare(self.hx, STABLE_TARE_SAMPLES, per_sample=1)
+                if self.offset is None:
+                    raise RuntimeError("Could not tare: no valid HX711 readings")
+
+        self.gyro_sensor = mpu6050(GYROSCOPE_I2C_ADDRESS)
+
+        if HISTORY_DB:
+            from history_store import HistoryStore
+
+            self.history = HistoryStore(HISTORY_DB)
+        if DUTY_CYCLE_ENABLED and self.history is not None:
+            self.scheduler = duty_cycle.DutyCycleScheduler(store=self.history,
+                                                           full_gyro_interval_s=SAMPLE_INTERVAL)
+
+    def _tare_from_ring(self):
+        readings, last_seq = [], 0
+        while len(readings) < STABLE_TARE_SAMPLES:
+            time.sleep(self.acquisition.ring.period_ns / 1e9)
+            samples, last_seq, _ = self.acquisition.ring.read_since(last_seq)
+            readings.extend(value for _, _, value in samples)
+        readings.sort()
+        return readings[len(readings) // 2]
+
+    def _hx_health(self):
+        result = self.hx.health.snapshot()
+        result["sps"] = round(self.hx.clock.sps, 2) if self.hx.clock.measured else None
+        result["missed"] = self.hx.clock.missed
+        return result
+
+    def _ring_health(self):
+        stats = self.acquisition.ring.stats()
+        if not self.acquisition.is_alive():
+            state = "failed"
+        elif stats["stalls"]:
+            state = "degraded"
+        else:
+            state = "ok"
+        return {"state": state, "stalls": stats["stalls"], "sps": round(1e9 / stats["period_ns"], 2),
+                "missed": stats["dropped"], "timing_violations": stats["timing_violations"]}
+
+    def _load_config(self):
+        try:
+            with open(self.config_file, "r") as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning("Could not read %s: %s", self.config_file, e)
+            return None
+        if "offset" not in config or "referenceUnit" not in config:
+            return None
+        return config
+
+    def start(self):
+        # Subscribe before the producer starts so no conversion is missed.
+        weight_subscription = self.hub.subscribe()
+        if self.acquisition is not None:
+            threading.Thread(target=self._ring_producer_loop, name="scale-ring", daemon=True).start()
+        else:
+            # read_sample() blocks until data is ready, so the producer runs at
+            # the HX711 output rate and stamps each sample with its ready edge.
+            read_sample = self.hx.read_sample
+            if self.scheduler is not None:
+                read_sample = duty_cycle.duty_cycled_reader(self.hx, self.scheduler)
+            self.hub.start_producer(read_sample, timestamped=True)
+        threading.Thread(target=self._weight_loop, args=(weight_subscription,),
+                         name="scale-weight", daemon=True).start()
+        threading.Thread(target=self._motion_loop, name="scale-motion", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self.hub.close()
+
+    def _to_weight(self, raw):
+        if self.convert is not None:
+            return self.convert(raw - self.offset)
+        return (raw - self.offset) / self.reference_unit
+
+    def weight_pipeline(self, subscription):
+        """Conversions from 'subscription' -> ScaleState weights -> weight events. Run it with run_inline()."""
+        readings = (pipeline.Reading(sample.ts_ns, sample.value, self._to_weight(sample.value))
+                    for sample in subscription)
+        stages = [pipeline.CallbackSink(self._update_weight, name="state"),
+                  pipeline.RejectOutliers(),
+                  pipeline.Smooth(),
+                  pipeline.StabilityGate(WEIGHT_STABLE_TOLERANCE_G, WEIGHT_STABLE_DURATION_S),
+                  pipeline.ChangeDetector(WEIGHT_CHANGE_MIN_G),
+                  pipeline.CallbackSink(self._weight_event, name="events")]
+        if EVENTS_SOCKET_URL is not None:
+            stages.append(pipeline.SocketSink(EVENTS_SOCKET_URL))
+        return pipeline.Pipeline(readings, stages, collect=False)
+
+    def _update_weight(self, reading):
+        self.state.update_weight(reading.weight, ts_ns=reading.ts_ns)
+
+    def _weight_event(self, event):
+        self.state.add_event(event.type, weight=event.weight, **event.fields)
+
+    def _weight_loop(self, subscription):
+        weights = self.weight_pipeline(subscription)
+        weights.run_inline()
+        log.debug("Weight stages: %s", weights.stats())
+
+    def _ring_producer_loop(self):
+        ring = self.acquisition.ring
+        last_seq = ring.write_seq
+        while not self._stop.is_set():
+            # Twice per conversion, at the rate the acquisition process measured.
+            poll_interval = ring.period_ns / 2e9
+            samples, last_seq, lost = ring.read_since(last_seq)
+            if lost:
+                log.warning("Fell behind the acquisition ring; %d conversions lost", lost)
+            for _, ts_ns, value in samples:
+                self.hub.publish(value, ts_ns)
+            if not self.acquisition.is_alive():
+                log.error("HX711 acquisition process exited")
+                return
+            time.sleep(poll_interval)
+
+    def _motion_loop(self):
+        stable_reported = False
+        while not self._stop.is_set():
+            try:
+                data = self.gyro_sensor.get_gyro_data()
+            except Exception as e:
+                log.warning("Error reading gyroscope data: %s", e)
+                self.state.update_motion(None, False)
+                time.sleep(SAMPLE_INTERVAL * 2)
+                continue
+
+            gx, gy, gz = data["x"], data["y"], data["z"]
+            stable = (abs(gx) < GYRO_THRESHOLD_X and
+                      abs(gy) < GYRO_THRESHOLD_Y and
+                      abs(gz) < GYRO_THRESHOLD_Z)
+            was_stable = self.state.stable
+            self.state.update_motion([gx, gy, gz], stable)
+            if not stable and self.scheduler is not None:
+                self.scheduler.note_motion()
+
+            if stable and not was_stable:
+                self.state.add_event("stable")
+                stable_reported = False
+            elif not stable and was_stable:
+                self.state.add_event("unstable")
+            elif stable and not stable_reported:
+                stable_for = self.state.stability()["stable_for"]
+                if stable_for >= STABILITY_DURATION_REQUIRED:
+                    filtered = self.state.filtered_weight()
+                    event = self.state.add_event("stable_period", duration=stable_for,
+                                                 weight=filtered["weight"])
+                    if self.history is not None:
+                        self.history.record_event("stable_period", ts=event["ts"],
+                                                  duration=stable_for, weight=filtered["weight"])
+                    stable_reported = True
+
+            time.sleep(self.scheduler.gyro_interval() if self.scheduler is not None else SAMPLE_INTERVAL)
+
+
+def _exit_on_sigterm(signum, frame):
+    raise SystemExit(0)
+
+
+def run_daemon(path=SOCKET_PATH):
+    # systemd stops services with SIGTERM; unwind through the cleanup below.
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    state = ScaleState()
+    daemon = ScaleDaemon(state)
+    daemon.setup()
+    daemon.start()
+    server = serve(state, path)
+    log.info("Scale daemon listening on %s", path)
+    try:
+        while True:
+            time.sleep(1)
+    except (KeyboardInterrupt, SystemExit):
+        log.info("Shutting down.")
+    finally:
+        daemon.stop()
+        server.shutdown()
+        server.server_close()
+        if daemon.acquisition is not None:
+            daemon.acquisition.stop()
+        if daemon.hx is not None:
+            daemon.hx.power_down()
+            daemon.hx.gpio.cleanup()
+
+
+def run_benchmark(iterations=5000):
+    """Measures query round-trip latency over a persistent connection, no hardware needed."""
+    path = SOCKET_PATH + ".bench"
+    state = ScaleState()
+    for i in range(FILTER_WINDOW):
+        state.update_weight(100.0 + i * 0.1)
+    state.update_motion([0.1, 0.2, 0.3], True)
+    state.add_event("stable_period", duration=3.0, weight=100.7)
+    server = serve(state, path)
+    try:
+        with ScaleClient(path) as client:
+            for command in ("WEIGHT", "FILTERED", "STATE", "SNAPSHOT"):
+                for _ in range(100):  # Warm up
+                    client.query(command)
+                latencies = []
+                for _ in range(iterations):
+                    start = time.perf_counter()
+                    client.query(command)
+                    latencies.append((time.perf_counter() - start) * 1e6)
+                latencies.sort()
+                print(f"{command: <9} p50={statistics.median(latencies):7.1f} us  "
+                      f"p99={latencies[int(len(latencies) * 0.99)]:7.1f} us")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        print(json.dumps(query(" ".join(sys.argv[2:]) or "SNAPSHOT"), indent=2))
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench":
+        run_benchmark()
+    else:
+        logging_setup.ensure_logging()
+        run_daemon()
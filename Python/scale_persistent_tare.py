@@ -1,28 +1,60 @@
 import time
 import sys
-import numpy as np
-import RPi.GPIO as GPIO
 from hx711 import HX711
 # Assuming bt.py is in the same directory or accessible via PYTHONPATH
-from bt import send_message
+from bt import send_message, sync_history
+from metrics import REGISTRY
+import calibration
+import delivery
+import fast_stats
+import pipeline
+import profiles
+import tracing
+from history_store import HistoryStore
 import json  # Needed for reading/writing config file
 import os   # Needed for checking if config file exists
+import logging
+import logging_setup
 
 # --- Configuration ---
 CONFIG_FILE = "scale_config.json"  # File to store/load scale settings
+PROFILES_FILE = "container_profiles.json"  # Per-container tare/full weights (see profiles.py)
+HISTORY_DB = "drinksync_history.db"  # Reading history and intake rollups (see history_store.py)
+PEERS_FILE = "delivery_peers.json"  # Phones to mirror readings to (see delivery.py); else bt.send_message
 DEFAULT_REFERENCE_UNIT = 425.37  # Adjust this based on your initial calibration
 STABLE_TARE_SAMPLES = 20  # Samples for the initial tare process
 GET_WEIGHT_SAMPLES = 5   # Samples per single weight reading (used in tare and take_reading)
 TAKE_READING_DURATION_S = 3  # Duration to average readings over in take_reading
-TAKE_READING_SAMPLE_DELAY = 0.1 # Delay between samples within take_reading
+# No delay between samples: every read blocks until the HX711 signals the next
+# conversion, so take_reading uses each one at 10 or 80 SPS alike.
 DOUT_PIN = 5  # Data pin
 PD_SCK_PIN = 6  # Clock pin
+READ_TIMEOUT_S = 1.0  # Give up on a conversion after this long and power cycle the HX711
+HISTORY_SYNC = False  # Also push unsent history after each reading (needs the app's sync service;
+                      # with delivery peers it runs on the first peer's thread, see delivery.py)
+
+log = logging.getLogger("drinksync.scale")
+
+# --- Metrics ---
+READING_SECONDS = REGISTRY.histogram(
+    "take_reading_seconds", "Duration of take_reading() including Bluetooth send")
+READINGS_REJECTED = REGISTRY.counter(
+    "take_reading_rejected_total", "Samples or results discarded by take_reading() filters", ("reason",))
+READINGS_COMPLETED = REGISTRY.counter(
+    "take_reading_results_total", "take_reading() calls by outcome", ("outcome",))
 
 # --- Global HX711 Object ---
 hx = None
 # --- Global Variable for Initial Max Weight ---
 # This will store the first weight measured after configuration (either loaded or tared)
 initial_max_weight = None
+# --- Container Profiles and the scale-wide calibration they fall back to ---
+profile_store = None
+calibration_table = None
+# --- On-device history of accepted readings ---
+history = None
+# --- Fan-out to several phones (None: single phone via bt.send_message) ---
+delivery_manager = None
 
 
 # --- Function Definitions ---
@@ -36,58 +68,78 @@ def cleanAndExit():
             hx.power_down()
     except Exception as e:
         print(f"  Warning: Could not power down HX711 during cleanup: {e}")
-    GPIO.cleanup()
+    if delivery_manager is not None:
+        # Give queued readings a moment to reach the phones
+        delivery_manager.flush(timeout=2.0)
+        delivery_manager.close()
+    if hx:
+        hx.gpio.cleanup()
     print("Bye!")
     sys.exit()
 
 
 def stable_tare(hx_instance, samples=STABLE_TARE_SAMPLES):
     """
-Performs tare measurement, sets the offset on the hx_instance,
-and returns the calculated offset value.
+Performs tare measurement (pipeline.tare(), shared with scale.py and the
+daemon), sets the offset on the hx_instance, and returns the calculated
+offset value.
     """
     if not hx_instance:
-        print("Error: HX711 instance not provided for tare.")
+        log.error("HX711 instance not provided for tare.")
         return None # Indicate failure
 
-    readings = []
-    print("Taring... Please ensure scale is empty and stable.")
-    # Power cycle before tare might help stability
-    try:
-        hx_instance.power_down()
-        hx_instance.power_up()
-        time.sleep(0.5) # Allow settle time
-    except Exception as e:
-        print(f"  Warning: Error during power cycle before tare: {e}")
-        # Continue anyway, might still work
-
-    for i in range(samples):
-        try:
-            # Use read_average for tare to get value before offset subtraction
-            raw_reading = hx_instance.read_average(times=GET_WEIGHT_SAMPLES)
-            if raw_reading is not False: # Check for valid reading
-                readings.append(raw_reading)
-                print(f"  Tare sample {i+1}/{samples}: {raw_reading}")
-            else:
-                print(f"  Warning: Got invalid raw reading during tare sample {i+1}")
-            time.sleep(0.1)
-        except Exception as e:
-            print(f"  Error getting raw data during tare: {e}")
-            # Decide if you want to break or continue after an error
-            # break # uncomment to stop taring on first error
-
-    if not readings:
-        print("ERROR: Could not get any valid readings during tare. Cannot set offset.")
-        # Consider raising an error or returning a specific failure value
+    log.info("Taring... Please ensure scale is empty and stable.")
+    with tracing.span("stable_tare", samples=samples):
+        offset = pipeline.tare(hx_instance, samples, per_sample=GET_WEIGHT_SAMPLES,
+                               on_error=lambda reason: tracing.instant("stable_tare.read_error", error=reason))
+    if offset is None:
+        log.error("Could not get any valid readings during tare. Cannot set offset.")
         return None
-    else:
-        # Use median for robustness against outliers
-        avg_tare_offset = np.median(readings)
+    log.info("Tare complete. Offset set to: %s", offset)
+    return offset # Return the calculated offset
+
 
-    hx_instance.set_offset(avg_tare_offset)
-    print(f"Tare complete. Offset set to: {avg_tare_offset}")
-    time.sleep(0.5) # Short delay after setting offset
-    return avg_tare_offset # Return the calculated offset
+def select_profile(weight):
+    """
+Switches to the container profile recognized from 'weight' (a gross reading):
+its full weight becomes initial_max_weight and its calibration, if any, is used.
+Returns True if the weight conversion changed, i.e. 'weight' is stale.
+    """
+    global initial_max_weight
+    profile = profile_store.recognize(weight)
+    if profile is None:
+        log.info("No container profile matches %.1f g; keeping current settings.", weight)
+        return False
+    if profile.name != profile_store.active:
+        log.info("Recognized container '%s' (full %.1f g).", profile.name, profile.full_weight)
+        profile_store.activate(profile.name)
+    initial_max_weight = profile.full_weight
+
+    table = profile_store.table(profile.name) or calibration_table
+    convert = table.convert if table is not None else None
+    if convert is hx.calibration:
+        return False
+    hx.set_calibration(convert)
+    return True
+
+
+def record_history(consumed):
+    """
+Stores an accepted reading ('consumed' grams since the container was full)
+with the intake since the previous reading of the same container.
+    """
+    if history is None:
+        return
+    profile = profile_store.active if profile_store is not None else None
+    try:
+        last = history.last_reading()
+        if last is None or last["profile"] != profile or consumed < last["weight"]:
+            intake = consumed  # A different or refilled container: all of it is new
+        else:
+            intake = consumed - last["weight"]
+        history.record_reading(consumed, intake, profile=profile)
+    except Exception as e:
+        log.warning("Could not record reading in history: %s", e)
 
 
 def take_reading():
@@ -97,45 +149,79 @@ calculates the average weight, sends it via Bluetooth, and returns the weight.
     """
     global hx # Access the global hx object
     if not hx:
-        print("Error: Scale (hx) not initialized. Cannot take reading.")
+        log.error("Scale (hx) not initialized. Cannot take reading.")
+        READINGS_COMPLETED.labels("not_initialized").inc()
         return None # Indicate failure
 
+    with READING_SECONDS.time(), tracing.span("take_reading"):
+        try:
+            return _take_reading()
+        finally:
+            # Power down the sensor to save power until the next reading, also
+            # after a rejected one. It will be powered up at the start of the
+            # next take_reading call.
+            try:
+                hx.power_down()
+            except Exception as e:
+                log.warning("Could not power down HX711 after reading: %s", e)
+
+
+def _sync_history():
+    with tracing.span("take_reading.sync_history"):
+        sync_history(history)
+
+
+def _reject_sample(reason):
+    READINGS_REJECTED.labels(reason).inc()
+    tracing.instant("take_reading.rejected", reason=reason)
+
+
+def _take_reading():
+    """Body of take_reading(); timed by the caller."""
     try:
-        start_time = time.time()
+        start_time = time.monotonic()
         readings = []
-        print(f"Taking reading for {TAKE_READING_DURATION_S} seconds...")
+        log.info("Taking reading for %s seconds...", TAKE_READING_DURATION_S)
 
-        # Power cycle before reading might improve consistency
-        hx.power_down()
-        hx.power_up()
-        time.sleep(0.1) # Allow time for power up
+        # Power cycle before reading might improve consistency. The first read
+        # waits out the HX711's settling time after power-up (hx711.SETTLE_PERIODS).
+        with tracing.span("take_reading.power_cycle"):
+            hx.power_down()
+            hx.power_up()
 
-        # Collect readings for the specified duration
-        while time.time() - start_time < TAKE_READING_DURATION_S:
-            try:
-                # get_weight uses the offset and reference unit already set in 'hx'
-                val = hx.get_weight(GET_WEIGHT_SAMPLES)
-                # Basic check for unusually large values which might indicate errors
-                # Adjust the threshold based on expected weights
-                if val is not False and abs(val) < 100000: # Example threshold
-                    readings.append(val)
-                else:
-                    print(f"  Warning: Discarding potentially erroneous reading: {val}")
-                # print(f"  Raw reading: {val:.2f}") # Uncomment for detailed debug
-                time.sleep(TAKE_READING_SAMPLE_DELAY) # Small delay
-            except OverflowError:
-                print("  Warning: Overflow error during reading, discarding value.")
-            except Exception as e:
-                print(f"  Warning: Error during individual weight reading: {e}")
+        # Recognize the container from the first reading, so a swapped bottle
+        # is picked up without a re-tare.
+        if profile_store is not None:
+            profile_store.reload_if_changed()  # Picks up profiles added by other processes
+        if profile_store is not None and profile_store.profiles:
+            with tracing.span("take_reading.recognize"):
+                first = hx.get_weight(GET_WEIGHT_SAMPLES)
+                if not select_profile(first) and abs(first) < 100000:
+                    readings.append(first)
+
+        # Collect readings for the rest of the duration: each conversion is
+        # median-filtered in groups like get_weight(), decoded and range-checked.
+        sampling = pipeline.Pipeline(
+            pipeline.hx711_source(hx, duration_s=TAKE_READING_DURATION_S - (time.monotonic() - start_time),
+                                  on_error=_reject_sample),
+            [pipeline.MedianOf(GET_WEIGHT_SAMPLES),
+             pipeline.Decode(hx),
+             # Basic check for unusually large values which might indicate errors
+             # Adjust the threshold based on expected weights
+             pipeline.RangeCheck(100000, on_reject=lambda reading: _reject_sample("out_of_range"))])
+        with tracing.span("take_reading.sampling") as sampling_span:
+            readings.extend(reading.weight for reading in sampling.run_inline())
+            sampling_span.set(valid=len(readings))
+        log.debug("Sampling stages: %s", sampling.stats())
 
         if not readings:
-            print("Error: No valid readings collected.")
-            # Optional: power down hx here if desired after failed reading
-            # hx.power_down()
+            log.error("No valid readings collected.")
+            READINGS_COMPLETED.labels("no_samples").inc()
             return None
 
         # Calculate the average weight using median for noise reduction
-        average_weight = np.median(readings)
+        with tracing.span("take_reading.aggregate", samples=len(readings)):
+            average_weight = fast_stats.median(readings)
 
         # Prepare message
 
@@ -147,40 +233,60 @@ calculates the average weight, sends it via Bluetooth, and returns the weight.
 
         # Do not send the message if (1) the weight is negative or (2) weight is higher than the initial max weight
         if average_weight < 0 or (initial_max_weight is not None and average_weight > initial_max_weight):
-            print(f"Warning: Discarding message due to invalid weight: {average_weight:.2f} grams")
+            log.warning("Discarding message due to invalid weight: %.2f grams", average_weight)
+            READINGS_REJECTED.labels("invalid_weight").inc()
+            READINGS_COMPLETED.labels("rejected").inc()
             return None
         
         # Filter bad readings: don't send if weight difference is too small
         if abs(average_weight) < 5: # Example threshold for small weight differences
-            print(f"Warning: Discarding message due to small weight difference: {average_weight:.2f} grams")
+            log.warning("Discarding message due to small weight difference: %.2f grams", average_weight)
+            READINGS_REJECTED.labels("too_small").inc()
+            READINGS_COMPLETED.labels("rejected").inc()
             return None
         
 
+        # Keep the reading on the device whether or not the phone is reachable
+        with tracing.span("take_reading.record_history"):
+            record_history(average_weight)
+
         # Send the average weight as a message
-        if send_message(message):
-            print(f"Message sent successfully: {message}")
+        if delivery_manager is not None:
+            # Queued for every phone; each session delivers and retries on its own thread
+            delivery_manager.send(message)
+            log.info("Message queued for %d phone(s): %s", len(delivery_manager.sessions), message)
+            READINGS_COMPLETED.labels("queued").inc()
+            # Catch the phone up on readings it missed while out of range: on
+            # the first phone's delivery thread, once this message has reached
+            # it, so an unreachable phone does not hold up the reading
+            if HISTORY_SYNC and history is not None:
+                delivery_manager.call_after_delivery(_sync_history)
         else:
-            print(f"Failed to send the message: {message}")
+            with tracing.span("take_reading.send_message"):
+                sent = send_message(message)
+            if sent:
+                log.info("Message sent successfully: %s", message)
+                READINGS_COMPLETED.labels("sent").inc()
+            else:
+                log.warning("Failed to send the message: %s", message)
+                READINGS_COMPLETED.labels("send_failed").inc()
 
-        # Power down the sensor to save power until the next reading
-        # It will be powered up at the start of the next take_reading call
-        hx.power_down()
+            # Catch the phone up on readings it missed while out of range
+            if HISTORY_SYNC and sent and history is not None:
+                _sync_history()
 
         return average_weight # Return the calculated weight
 
     except Exception as e:
-        print(f"Error during take_reading: {e}")
-        # Attempt to power down even on error
-        try:
-            if hx: hx.power_down()
-        except:
-            pass # Ignore errors during power down in cleanup
+        log.exception("Error during take_reading: %s", e)
+        READINGS_COMPLETED.labels("error").inc()
         # Consider calling cleanAndExit() or raising the exception
         return None # Indicate failure
 
 
 # --- Initialization Code (Runs ONCE when script is imported or executed) ---
 
+logging_setup.ensure_logging()
 print("--- Initializing Scale ---")
 config_loaded_successfully = False
 loaded_offset = None
@@ -230,7 +336,7 @@ try:
     # Choose BCM or BOARD consistently
     # GPIO.setmode(GPIO.BCM) # Example: Use Broadcom pin numbering
 
-    hx = HX711(DOUT_PIN, PD_SCK_PIN)
+    hx = HX711(DOUT_PIN, PD_SCK_PIN, read_timeout=READ_TIMEOUT_S)
     # Set byte order and bit order (MUST be done before reading/setting offset/taring)
     hx.set_reading_format("MSB", "MSB")
     print("HX711 sensor initialized.")
@@ -238,7 +344,6 @@ try:
 except Exception as e:
     print(f"FATAL ERROR: Failed to initialize HX711 sensor. Error: {e}")
     print("Check GPIO connections, permissions, and chosen numbering scheme (BCM/BOARD).")
-    GPIO.cleanup() # Attempt basic cleanup
     sys.exit(1) # Exit script if sensor fails
 
 # 3. Configure HX711: Use loaded values or perform tare
@@ -247,12 +352,18 @@ if config_loaded_successfully and loaded_offset is not None and loaded_reference
     print("Applying loaded offset and reference unit...")
     hx.set_offset(loaded_offset)
     hx.set_reference_unit(loaded_reference_unit)
+    # Multi-point calibration (written by calibration.py) replaces the divisor.
+    calibration_table = calibration.load_table(CONFIG_FILE)
+    if calibration_table is not None:
+        hx.set_calibration(calibration_table.convert)
+        print("Using multi-point calibration from config.")
     # Assign the loaded max weight to the global variable
     initial_max_weight = loaded_initial_max_weight
-    # Perform a power cycle after applying settings might be good practice
+    # Perform a power cycle after applying settings might be good practice.
+    # No fixed settle delay: the first read waits out the settling time,
+    # four conversion periods (0.4 s at 10 SPS, 50 ms at 80 SPS).
     hx.power_down()
     hx.power_up()
-    time.sleep(0.5)
     print("Scale configured using saved settings.")
     if initial_max_weight is not None:
          print(f"Using saved Initial Max Weight: {initial_max_weight:.2f} grams")
@@ -262,15 +373,22 @@ if config_loaded_successfully and loaded_offset is not None and loaded_reference
 else:
     # Perform initial tare and save the configuration
     print("No valid configuration found or loaded. Performing initial tare...")
-    hx.reset() # Reset the chip before taring
-    calculated_offset = stable_tare(hx) # This also sets the offset on hx
+    calculated_offset = stable_tare(hx) # Power cycles the chip first; also sets the offset on hx
 
     if calculated_offset is not None:
-        # Use the default reference unit for the first time
-        # (Or implement a calibration step here if needed)
-        current_reference_unit = DEFAULT_REFERENCE_UNIT
-        hx.set_reference_unit(current_reference_unit)
-        print(f"Reference unit set to default: {current_reference_unit}")
+        # Use the multi-point calibration if calibration.py has run (it
+        # stores no initial max weight), else the default reference unit
+        calibration_model = calibration.load_calibration(CONFIG_FILE)
+        if calibration_model is not None:
+            current_reference_unit = calibration_model.reference_unit()
+            hx.set_reference_unit(current_reference_unit)
+            calibration_table = calibration_model.compile()
+            hx.set_calibration(calibration_table.convert)
+            print("Using multi-point calibration from config.")
+        else:
+            current_reference_unit = DEFAULT_REFERENCE_UNIT
+            hx.set_reference_unit(current_reference_unit)
+            print(f"Reference unit set to default: {current_reference_unit}")
 
         # --- TAKE THE FIRST MEASUREMENT (Initial Max Weight) ---
         print("\nTaking initial 'max' measurement...")
@@ -281,8 +399,7 @@ else:
         try:
             # Power cycle before critical measurement
             hx.power_down()
-            hx.power_up()
-            time.sleep(0.5) # Allow settle time
+            hx.power_up()  # The first read waits out the settling time
             # Get a single, averaged reading using the new settings
             first_measurement_val = hx.get_weight(GET_WEIGHT_SAMPLES)
             # Check if the reading is valid
@@ -299,15 +416,14 @@ else:
             initial_max_weight = None # Set to None on error
 
         # --- Save Configuration (including the initial max weight) ---
+        # Merged into the file, so a calibration saved there is kept
         print(f"Saving configuration to {CONFIG_FILE}...")
         try:
-            config_data_to_save = {
+            calibration.update_config({
                 'offset': calculated_offset,
                 'referenceUnit': current_reference_unit,
                 'initialMaxWeight': initial_max_weight # Save the measured value (or None if failed)
-            }
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(config_data_to_save, f, indent=4)
+            }, CONFIG_FILE)
             print("Configuration saved successfully.")
         except Exception as e:
             print(f"Warning: Failed to save configuration to {CONFIG_FILE}. Error: {e}")
@@ -322,6 +438,28 @@ else:
         hx.set_reference_unit(DEFAULT_REFERENCE_UNIT)
         initial_max_weight = None # Ensure it's None if tare failed
 
+# 4. Container profiles: the active one overrides the saved initial max weight
+profile_store = profiles.ProfileStore(PROFILES_FILE)
+if profile_store.active_profile() is not None:
+    active_profile = profile_store.active_profile()
+    initial_max_weight = active_profile.full_weight
+    active_table = profile_store.table(active_profile.name)
+    if active_table is not None:
+        hx.set_calibration(active_table.convert)
+    print(f"Using container profile '{active_profile.name}' ({len(profile_store.profiles)} known).")
+
+# 5. Reading history
+try:
+    history = HistoryStore(HISTORY_DB)
+    print(f"Recording reading history in {HISTORY_DB}.")
+except Exception as e:
+    print(f"Warning: Could not open history database '{HISTORY_DB}'. Error: {e}")
+
+# 6. Phones to deliver readings to
+delivery_manager = delivery.manager_from_file(PEERS_FILE)
+if delivery_manager is not None:
+    print(f"Delivering readings to {len(delivery_manager.sessions)} phone(s) from {PEERS_FILE}.")
+
 # Final check after initialization logic
 print("\n--- Scale Ready ---")
 if initial_max_weight is not None:
@@ -0,0 +1,384 @@
+# File: shm_acquisition.py
+#
+# Optional acquisition mode that isolates the timing-sensitive HX711
+# bit-banging from the GIL. A dedicated child process does nothing but clock
+# conversions into a multiprocessing.shared_memory ring buffer; any number of
+# consumer processes attach to the ring by name and read samples in place.
+#
+# Ring layout (little endian, 8-byte aligned):
+#
+#   header  magic u32 | capacity u32 | write_seq u64 | conversions u64 |
+#           timing_violations u64 | dropped u64 | max_high_ns u64 |
+#           stalls u64 | period_ns u64 | writer_pid u64
+#   slots   capacity x (seq u64 | ts_ns u64 | value i32 | high_ns u32)
+#
+# The single writer fills a slot, then stores its seq, then publishes
+# write_seq. Readers re-check a slot's seq after copying it, so a slot that
+# was overwritten mid-read is detected and skipped instead of returned torn.
+#
+# Consumers attach without registering the block with their resource tracker
+# (Python registers every attach before 3.13, and a process's tracker unlinks
+# what it registered when the process exits), so only the owner ever unlinks.
+#
+# Usage:
+#   python3 shm_acquisition.py bench      # ring throughput, no hardware needed
+#   python3 shm_acquisition.py selftest   # consumers attach, exit and re-attach
+
+import gc
+import logging
+import multiprocessing
+import os
+import struct
+import subprocess
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+log = logging.getLogger("drinksync.shm")
+
+# --- Configuration ---
+SHM_NAME = "drinksync_hx711"  # Consumers attach with SharedRing.attach(SHM_NAME)
+RING_CAPACITY = 4096  # Conversions kept (~7 minutes at 10 SPS, ~50 s at 80 SPS)
+EXPECTED_SPS = 10  # Initial guess only; the writer measures the real rate (RATE pin low: 10, high: 80)
+POWER_DOWN_HIGH_NS = 60000  # PD_SCK high longer than this powers the HX711 down
+READY_SPIN_MARGIN_S = 0.003  # Sleep until this long before the next expected conversion
+ACQUISITION_NICE = -10  # Needs CAP_SYS_NICE; ignored when not permitted
+READ_TIMEOUT_S = 0.5  # A conversion later than this counts as a stall and power cycles the HX711
+
+_MAGIC = 0x48583731  # "HX71"
+_HEADER = struct.Struct("<IIQQQQQQQQ")
+_SLOT = struct.Struct("<QQiI")
+_WRITE_SEQ_OFFSET = 8
+# Sequence numbers use the native format, which struct copies as one aligned
+# value rather than byte by byte as for "<Q". That is not atomic everywhere:
+# on a Pi Zero (32-bit ARMv6) it is two 32-bit accesses, and neither side uses
+# memory barriers. What readers rely on is the slot protocol instead: the
+# writer zeroes the slot seq, writes the payload, then stores the seq, and
+# _read_slot() copies the slot and re-reads its seq, dropping it on any
+# mismatch; a torn seq cannot equal the one asked for. Without barriers that
+# is a best-effort check, not a memory-model guarantee; ARM may make the
+# stores visible out of order, though the interpreter's work between them
+# leaves no realistic window. (Every platform the scale runs on is little
+# endian, matching the layout.)
+_SEQ = struct.Struct("Q")
+_COUNTERS = struct.Struct("<QQQQQ")  # conversions, timing_violations, dropped, max_high_ns, stalls
+_COUNTERS_OFFSET = 16
+_PERIOD_OFFSET = 56
+
+
+class SharedRing:
+    """A single-writer, multi-reader ring of timestamped conversions in shared memory."""
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.buf = shm.buf
+        self.owner = owner
+        magic, self.capacity = struct.unpack_from("<II", self.buf, 0)
+        if magic != _MAGIC:
+            raise ValueError("Shared memory block '%s' is not an HX711 ring" % shm.name)
+        self.name = shm.name
+
+    @classmethod
+    def create(cls, name=None, capacity=RING_CAPACITY, period_ns=10 ** 9 // EXPECTED_SPS):
+        size = _HEADER.size + capacity * _SLOT.size
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a writer that did not shut down cleanly.
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _HEADER.pack_into(shm.buf, 0, _MAGIC, capacity, 0, 0, 0, 0, 0, 0, period_ns, os.getpid())
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+            # Otherwise this process's resource tracker unlinks the block when
+            # the process exits, under the owner and every other consumer.
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, owner=False)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            # Register again first: a spawned consumer shares our resource
+            # tracker, and its attach() dropped the entry unlink() removes.
+            resource_tracker.register(self.shm._name, "shared_memory")
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+                log.warning("Shared memory '%s' was already unlinked", self.name)
+
+    # --- Writer side (acquisition process only) ---
+
+    def append(self, ts_ns, value, high_ns=0):
+        seq = _SEQ.unpack_from(self.buf, _WRITE_SEQ_OFFSET)[0] + 1
+        offset = _HEADER.size + (seq % self.capacity) * _SLOT.size
+        # Invalidate the slot first so readers never pair the old seq with new data.
+        _SEQ.pack_into(self.buf, offset, 0)
+        struct.pack_into("<QiI", self.buf, offset + 8, ts_ns, value, min(high_ns, 0xFFFFFFFF))
+        _SEQ.pack_into(self.buf, offset, seq)
+        _SEQ.pack_into(self.buf, _WRITE_SEQ_OFFSET, seq)
+        return seq
+
+    def set_period(self, period_ns):
+        _SEQ.pack_into(self.buf, _PERIOD_OFFSET, period_ns)
+
+    def set_counters(self, conversions, timing_violations, dropped, max_high_ns, stalls=0):
+        _COUNTERS.pack_into(self.buf, _COUNTERS_OFFSET, conversions, timing_violations,
+                            dropped, max_high_ns, stalls)
+
+    # --- Reader side ---
+
+    @property
+    def write_seq(self):
+        return _SEQ.unpack_from(self.buf, _WRITE_SEQ_OFFSET)[0]
+
+    @property
+    def period_ns(self):
+        """Conversion period measured by the writer (EXPECTED_SPS until measured)."""
+        return _SEQ.unpack_from(self.buf, _PERIOD_OFFSET)[0]
+
+    def stats(self):
+        fields = _HEADER.unpack_from(self.buf, 0)
+        return {"write_seq": fields[2], "conversions": fields[3],
+                "timing_violations": fields[4], "dropped": fields[5],
+                "max_high_ns": fields[6], "stalls": fields[7], "period_ns": fields[8],
+                "writer_pid": fields[9]}
+
+    def _read_slot(self, seq):
+        """Returns (slot_seq, ts_ns, value, high_ns); slot_seq != seq means the slot is not usable."""
+        offset = _HEADER.size + (seq % self.capacity) * _SLOT.size
+        slot_seq, ts_ns, value, high_ns = _SLOT.unpack_from(self.buf, offset)
+        if _SEQ.unpack_from(self.buf, offset)[0] != slot_seq:
+            slot_seq = 0  # Rewritten while we were copying it
+        return slot_seq, ts_ns, value, high_ns
+
+    def latest(self):
+        """Returns (seq, ts_ns, value) of the newest conversion, or None if empty."""
+        seq = self.write_seq
+        while seq > 0:
+            slot_seq, ts_ns, value, _ = self._read_slot(seq)
+            if slot_seq == seq:
+                return seq, ts_ns, value
+            seq = self.write_seq
+        return None
+
+    def read_since(self, last_seq):
+        """
+        Returns the conversions published after 'last_seq'.
+
+        Returns:
+            tuple: (samples, new_last_seq, lost) where samples is a list of
+            (seq, ts_ns, value) and lost counts conversions that were
+            overwritten before this reader got to them.
+        """
+        head = self.write_seq
+        if head <= last_seq:
+            return [], last_seq, 0
+        first = max(last_seq + 1, head - self.capacity + 1, 1)
+        lost = first - (last_seq + 1)
+        samples = []
+        for seq in range(first, head + 1):
+            slot_seq, ts_ns, value, _ = self._read_slot(seq)
+            if slot_seq == seq:
+                samples.append((seq, ts_ns, value))
+            elif slot_seq > seq:
+                lost += 1  # Overwritten by the writer (reader fell a full lap behind)
+            else:
+                return samples, seq - 1, lost  # Being written right now; resume here
+        return samples, head, lost
+
+    def numpy_view(self):
+        """
+        Zero-copy structured NumPy view of all slots (fields: seq, ts_ns,
+        value, high_ns). Entries can change underneath the view; compare the
+        seq field against write_seq before trusting a row.
+        """
+        import numpy as np
+
+        dtype = np.dtype([("seq", "<u8"), ("ts_ns", "<u8"), ("value", "<i4"), ("high_ns", "<u4")])
+        return np.ndarray((self.capacity,), dtype=dtype, buffer=self.buf, offset=_HEADER.size)
+
+
+# --- Acquisition Process ---
+
+def _raise_priority():
+    # Best effort: favour the clock loop over the rest of the system. A
+    # real-time policy is deliberately not used, since the ready spin would
+    # then starve everything else on a single-core Pi Zero.
+    try:
+        os.nice(ACQUISITION_NICE)
+    except OSError:
+        pass
+
+
+def _acquisition_main(ring_name, dout, pd_sck, gain, sps, stop_event):
+    from hx711 import ConversionClock, HX711, HX711TimeoutError
+
+    _raise_priority()
+    # Nothing else runs in this process, so garbage collection pauses are the
+    # only remaining source of stalls; the loop allocates no reference cycles.
+    gc.disable()
+
+    ring = SharedRing.attach(ring_name)
+    hx = HX711(dout, pd_sck, gain, read_timeout=READ_TIMEOUT_S)
+    hx.set_reading_format("MSB", "MSB")
+    hx.clock = ConversionClock(sps)
+    # read_long_timed() sleeps until just before each predicted data-ready
+    # edge. This loop reads continuously, so every gap is a real miss.
+    hx.READY_SPIN_MARGIN_S = READY_SPIN_MARGIN_S
+    hx.MAX_DROP_PERIODS = None
+
+    conversions = 0
+    timing_violations = 0
+    max_high_ns = 0
+    stalls = 0
+    period_ns = hx.clock.period_ns
+    try:
+        while not stop_event.is_set():
+            try:
+                value, ready_ns, high_ns = hx.read_long_timed()
+            except HX711TimeoutError:
+                # Power cycle and start timing afresh (reset() forgets the edge
+                # phase); the gap is reported as a stall, not as dropped conversions.
+                stalls += 1
+                ring.set_counters(conversions, timing_violations, hx.clock.missed, max_high_ns, stalls)
+                try:
+                    hx.reset()
+                except HX711TimeoutError:
+                    pass
+                continue
+            conversions += 1
+            if high_ns > POWER_DOWN_HIGH_NS:
+                # The chip may have powered down mid-read; the value is suspect.
+                timing_violations += 1
+            if high_ns > max_high_ns:
+                max_high_ns = high_ns
+            ring.append(ready_ns, value, high_ns)
+            ring.set_counters(conversions, timing_violations, hx.clock.missed, max_high_ns, stalls)
+            if hx.clock.period_ns != period_ns:
+                period_ns = hx.clock.period_ns
+                ring.set_period(period_ns)
+    finally:
+        ring.buf = None
+        ring.shm.close()
+
+
+class AcquisitionProcess:
+    """
+    Runs the HX711 clock loop in a child process feeding a SharedRing.
+
+    Example:
+        acq = AcquisitionProcess(5, 6)
+        acq.start()
+        samples, last_seq, lost = acq.ring.read_since(0)
+    """
+
+    def __init__(self, dout, pd_sck, gain=128, sps=EXPECTED_SPS, capacity=RING_CAPACITY,
+                 name=SHM_NAME):
+        self.dout = dout
+        self.pd_sck = pd_sck
+        self.gain = gain
+        self.sps = sps
+        self.ring = SharedRing.create(name, capacity, period_ns=10 ** 9 // sps)
+        context = multiprocessing.get_context("spawn")  # No inherited threads or locks
+        self._stop_event = context.Event()
+        self._process = context.Process(
+            target=_acquisition_main, name="hx711-acquisition", daemon=True,
+            args=(self.ring.name, dout, pd_sck, gain, sps, self._stop_event))
+
+    def start(self):
+        self._process.start()
+        log.info("HX711 acquisition process %d writing to shared memory '%s'",
+                 self._process.pid, self.ring.name)
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def stop(self, timeout=2.0):
+        self._stop_event.set()
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self.ring.close()
+
+
+# --- Ring Benchmark ---
+
+def _bench_writer(ring_name, count):
+    ring = SharedRing.attach(ring_name)
+    for i in range(count):
+        ring.append(time.monotonic_ns(), i)
+    ring.buf = None
+    ring.shm.close()
+
+
+# A consumer in an unrelated interpreter, with its own resource tracker.
+_CONSUMER = """
+import sys
+from shm_acquisition import SharedRing
+ring = SharedRing.attach(sys.argv[1])
+print(ring.latest()[2])
+ring.close()
+"""
+
+
+def _selftest():
+    ring = SharedRing.create("drinksync_selftest_%d" % os.getpid(), capacity=16)
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get("PYTHONPATH")])))
+        for value in (1, 2, 3):
+            ring.append(time.monotonic_ns(), value)
+            # Each consumer exits (and its tracker shuts down) before the next attaches.
+            done = subprocess.run([sys.executable, "-c", _CONSUMER, ring.name], env=env,
+                                  capture_output=True, text=True, timeout=30)
+            assert done.returncode == 0, "consumer %d failed to attach:\n%s" % (value, done.stderr)
+            assert done.stdout.strip() == str(value), done.stdout
+            assert "leaked" not in done.stderr, done.stderr
+        # A spawned child shares this process's tracker.
+        writer = multiprocessing.get_context("spawn").Process(target=_bench_writer, args=(ring.name, 10))
+        writer.start()
+        writer.join()
+        assert writer.exitcode == 0 and ring.write_seq == 13, ring.write_seq
+        SharedRing.attach(ring.name).close()
+    finally:
+        ring.close()
+    try:
+        SharedRing.attach(ring.name)
+    except FileNotFoundError:
+        pass
+    else:
+        raise AssertionError("the owner's close() did not unlink the ring")
+    print("shm_acquisition selftest passed: 3 consumer processes attached, exited and re-attached; "
+          "owner unlinked cleanly")
+
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "selftest":
+    _selftest()
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "bench":
+    count = 200000
+    ring = SharedRing.create(capacity=RING_CAPACITY)
+    writer = multiprocessing.get_context("spawn").Process(target=_bench_writer, args=(ring.name, count))
+    start = time.perf_counter()
+    writer.start()
+    last_seq, received, lost = 0, 0, 0
+    while writer.is_alive() or last_seq < ring.write_seq:
+        samples, last_seq, missed = ring.read_since(last_seq)
+        received += len(samples)
+        lost += missed
+    elapsed = time.perf_counter() - start
+    writer.join()
+    print(f"writer: {count} conversions in {elapsed:.2f} s ({count / elapsed:,.0f}/s)")
+    print(f"reader: {received} received, {lost} overwritten before read")
+    ring.close()
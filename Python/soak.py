@@ -0,0 +1,590 @@
+# File: soak.py
+#
+# Long-duration soak test of the whole scale stack on simulated hardware.
+#
+# Runs the real code - stability_scale_trigger's monitor pipeline,
+# scale_persistent_tare.take_reading(), the HX711 driver, the history store
+# and bt.send_message() - against:
+#   - SimulatedHX711: a GpioMemBackend register block converting at 80 SPS,
+#     with PD_SCK power-down, settling after power-up and injected stalls;
+#   - SimulatedGyro and DrinkingScenario: a bottle picked up, sipped from and
+#     refilled at a daily rhythm;
+#   - phone_emulator.PhoneEmulator behind FlakyTransport, which breaks every
+#     n-th connection so send_message()'s error path runs too. Like the app,
+#     the emulator never replies, so every send_message() waits out
+#     bt.REPLY_TIMEOUT_S; the soak shortens that real-time wait to
+#     SOAK_REPLY_TIMEOUT_S and moves the clock over the rest. --phone-acks
+#     runs against an emulator that replies instead.
+#
+# Not modelled: the app serves only the first connection it accepts, while
+# send_message() connects once per message, so on a real phone only the
+# first reading gets through (phone_emulator.py check); the soak's phone
+# accepts every connection. Nor are device discovery, RFCOMM pairing and
+# link loss, or the app's timing for reading and merging what arrives.
+#
+# AcceleratedClock replaces time.monotonic()/monotonic_ns()/sleep()/time():
+# sleeps return at once and advance the clock, and so does spinning on the
+# simulated HX711's DOUT, so only the CPU work is done in real time and a
+# simulated day takes minutes. Reading latency is measured on the real clock
+# (time.perf_counter), i.e. it is the CPU time of a reading plus the
+# SOAK_REPLY_TIMEOUT_S wait for the reply.
+#
+# Every simulated hour the soak samples RSS, open file descriptors, threads
+# and the reading latency percentiles. After the warm-up it fails (exit
+# status 1) if descriptors or threads grew, RSS grew faster than
+# RSS_GROWTH_LIMIT_MB_PER_DAY, the p99 latency crept up, or the phone stored
+# fewer messages than were reported sent.
+#
+# scale_persistent_tare.py sends "Weight Differnce: ... grams", which the
+# app's regex ("Average weight: ... grams") rejects, so as things stand the
+# phone stores none of them and the soak fails on that alone. To soak the
+# rest of the stack regardless, --allow-format-mismatch counts messages the
+# app rejected for their format as stored; they still have to arrive.
+#
+# Usage:
+#   python3 soak.py [hours] [--no-faults] [--allow-format-mismatch] [--phone-acks]    # default: SOAK_HOURS simulated hours
+
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+from gpio_backend import FakeGpioRegion, GpioMemBackend
+
+# --- Configuration ---
+SOAK_HOURS = 24.0  # Simulated duration
+PROBE_INTERVAL_S = 3600  # Simulated seconds between resource samples
+WARMUP_S = 2 * 3600  # Caches, pools and metrics children fill up during this
+RSS_GROWTH_LIMIT_MB_PER_DAY = 2.0  # Fitted RSS slope after the warm-up
+LATENCY_GROWTH_LIMIT = 1.5  # Late p99 may be at most this times the early p99...
+LATENCY_SLACK_MS = 5.0  # ...plus this much
+LINK_FAULT_EVERY = 10  # Break every n-th phone connection (None: never)
+STALL_EVERY_S = 6 * 3600  # Stall the HX711 this often (simulated seconds; None: never)
+STALL_DURATION_S = 1.5  # Longer than READ_TIMEOUT_S, so recovery runs
+SOAK_REPLY_TIMEOUT_S = 0.02  # Real seconds bt waits for the reply; the clock skips the rest of REPLY_TIMEOUT_S
+
+# The simulated load cell: counts = OFFSET + grams * REFERENCE_UNIT + noise.
+SIM_OFFSET = 8000
+SIM_REFERENCE_UNIT = 425.37
+SIM_NOISE_COUNTS = 150
+SIM_GLITCH_RATE = 0.001  # Conversions with a bus glitch (huge value)
+FULL_BOTTLE_G = 500.0
+REFILL_BELOW_G = 150.0
+DAY_GAP_S = 25 * 60  # Mean time between sips, 07:00-23:00...
+NIGHT_GAP_S = 3 * 3600  # ...and at night
+
+
+class AcceleratedClock:
+    """
+    Simulated time for time.monotonic(), monotonic_ns(), sleep() and time().
+
+    sleep() returns immediately and moves the clock forward; time spent
+    running counts as it is. time.perf_counter() is left alone.
+    """
+
+    def __init__(self):
+        self._real_ns = time.monotonic_ns
+        self._real_sleep = time.sleep
+        self._start_ns = self._real_ns()
+        self._start_wall = time.time()
+        self._skipped_ns = 0
+        self._lock = threading.Lock()
+        self._saved = None
+
+    def monotonic_ns(self):
+        return self._real_ns() + self._skipped_ns
+
+    def monotonic(self):
+        return self.monotonic_ns() / 1e9
+
+    def time(self):
+        return self._start_wall + self.elapsed()
+
+    def slept_ns(self):
+        """Total time skipped by sleep() calls."""
+        return self._skipped_ns
+
+    def elapsed(self):
+        """Simulated seconds since the clock was created."""
+        return (self.monotonic_ns() - self._start_ns) / 1e9
+
+    def advance(self, ns):
+        """Moves the clock 'ns' nanoseconds forward, as if that much time was spent waiting."""
+        if ns > 0:
+            with self._lock:
+                self._skipped_ns += ns
+
+    def sleep(self, seconds):
+        self.advance(int(seconds * 1e9))
+        self._real_sleep(0)  # Still let other threads run
+
+    def install(self):
+        self._saved = (time.monotonic, time.monotonic_ns, time.sleep, time.time)
+        time.monotonic, time.monotonic_ns, time.sleep, time.time = (
+            self.monotonic, self.monotonic_ns, self.sleep, self.time)
+
+    def uninstall(self):
+        if self._saved is not None:
+            time.monotonic, time.monotonic_ns, time.sleep, time.time = self._saved
+            self._saved = None
+
+
+# --- Simulated hardware ---
+
+class SimulatedHX711(FakeGpioRegion):
+    """
+    FakeGpioRegion paced by a clock: a conversion is ready every 1/sps
+    seconds, PD_SCK held high across a sleep of over 60 us powers the chip
+    down (the first conversion after power-up comes SETTLE_PERIODS later),
+    and stall() keeps DOUT high like a chip that stopped converting.
+
+    Polling DOUT while it is high moves the clock halfway to the next
+    conversion (one period while stalled), so a driver spinning on DOUT sees
+    time pass as it would on hardware without burning real time.
+
+    Args:
+        counts: Called for the value of each conversion.
+    """
+
+    SETTLE_PERIODS = 4
+    POWER_DOWN_NS = 60000
+    MIN_POLL_NS = 20000  # Smallest clock step for a poll that finds DOUT high
+
+    def __init__(self, clock, clock_pin, data_pin, counts, sps=80):
+        super().__init__(clock_pin, data_pin)
+        self.clock = clock
+        self.counts = counts
+        self.period_ns = int(1e9 / sps)
+        self.epoch_ns = clock.monotonic_ns()
+        self.read_edge = -1  # Index of the last conversion clocked out
+        self.stalled_until_ns = 0
+        self.stall_pending_s = None
+        self.power_cycles = 0
+        self.stalls = 0
+        self._high_ns = 0
+
+    def stall(self, seconds):
+        """Stops converting for 'seconds' from the next time DOUT is polled."""
+        self.stall_pending_s = seconds
+        self.stalls += 1
+
+    def __getitem__(self, index):
+        if index != GpioMemBackend.GPLEV0:
+            return self.words[index]
+        self._poll()
+        if self.pulses == 0:
+            now = self.clock.monotonic_ns()
+            if self.stall_pending_s is not None:
+                self.stalled_until_ns = now + int(self.stall_pending_s * 1e9)
+                self.stall_pending_s = None
+            if now < self.stalled_until_ns:
+                self.words[index] |= self.data_mask
+                self.clock.advance(self.period_ns)
+            elif (now - self.epoch_ns) // self.period_ns > self.read_edge:
+                self.words[index] &= ~self.data_mask
+            else:
+                self.words[index] |= self.data_mask
+                gap = self.epoch_ns + (self.read_edge + 1) * self.period_ns - now
+                self.clock.advance(gap if gap <= 2 * self.MIN_POLL_NS else gap // 2)
+        return self.words[index]
+
+    def __setitem__(self, index, word):
+        # Only sleeps count towards the high time: these Python registers are
+        # far slower than real ones, and a GC pause or thread switch between
+        # two stores would otherwise power the chip down mid-read.
+        if word & self.clock_mask:
+            if index == GpioMemBackend.GPSET0 and not self._clock_high:
+                self._high_ns = self.clock.slept_ns()
+            elif index == GpioMemBackend.GPCLR0 and self._clock_high:
+                if self.clock.slept_ns() - self._high_ns > self.POWER_DOWN_NS:
+                    self._power_up()
+        super().__setitem__(index, word)
+
+    def _rising_edge(self):
+        if self.pulses == 0:
+            self.read_edge = (self.clock.monotonic_ns() - self.epoch_ns) // self.period_ns
+            self.value = int(self.counts())
+        super()._rising_edge()
+
+    def _power_up(self):
+        self.power_cycles += 1
+        self.pulses = 0
+        self.read_edge = -1
+        self.epoch_ns = self.clock.monotonic_ns() + self.SETTLE_PERIODS * self.period_ns
+        self.words[GpioMemBackend.GPLEV0] |= self.data_mask
+
+
+class DrinkingScenario:
+    """
+    A bottle on the scale: picked up (gyro motion, no weight) every so
+    often - every DAY_GAP_S on average by day, NIGHT_GAP_S at night - put
+    back a sip lighter, and refilled when nearly empty.
+    """
+
+    def __init__(self, clock, seed=1):
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self.level = FULL_BOTTLE_G
+        self.handling = False
+        self.sips = 0
+        self.refills = 0
+        self._until = 0.0
+        self._next_at = self._schedule(clock.time())
+
+    def _schedule(self, now):
+        hour = time.localtime(now).tm_hour
+        mean = DAY_GAP_S if 7 <= hour < 23 else NIGHT_GAP_S
+        return now + self.rng.expovariate(1.0 / mean)
+
+    def update(self):
+        now = self.clock.time()
+        if self.handling and now >= self._until:
+            self.handling = False
+            self.level -= self.rng.uniform(10, 40)
+            self.sips += 1
+            if self.level < REFILL_BELOW_G:
+                self.level = FULL_BOTTLE_G
+                self.refills += 1
+            self._next_at = self._schedule(now)
+        elif not self.handling and now >= self._next_at:
+            self.handling = True
+            self._until = now + self.rng.uniform(4, 15)
+
+    def counts(self):
+        self.update()
+        rng = self.rng
+        if rng.random() < SIM_GLITCH_RATE:
+            return rng.choice((-1, 1)) * rng.randrange(0x400000, 0x7FFFFF)
+        grams = 0.0 if self.handling else self.level
+        return SIM_OFFSET + grams * SIM_REFERENCE_UNIT + rng.gauss(0, SIM_NOISE_COUNTS)
+
+    def gyro(self):
+        self.update()
+        rng = self.rng
+        if self.handling:
+            return {axis: rng.uniform(-80, 80) for axis in "xyz"}
+        return {axis: rng.gauss(0, 0.8) for axis in "xyz"}
+
+
+class SimulatedGyro:
+    """mpu6050 stand-in reading DrinkingScenario; calls on_sample() after every read."""
+
+    def __init__(self, scenario, on_sample=None):
+        self.scenario = scenario
+        self.on_sample = on_sample
+
+    def get_gyro_data(self):
+        data = self.scenario.gyro()
+        if self.on_sample is not None:
+            self.on_sample()
+        return data
+
+
+# --- Faults ---
+
+class FlakyTransport:
+    """
+    Wraps a bt Transport; every n-th connection breaks before the message is written.
+
+    Args:
+        transport: The bt Transport to wrap.
+        every (int): Break every n-th connection (None: never).
+        clock (AcceleratedClock): Advanced by 'timeout_skip_s' whenever
+            send_message() gives up waiting for a reply.
+        timeout_skip_s (float): Simulated seconds the shortened reply wait
+            stands in for.
+    """
+
+    def __init__(self, transport, every, clock=None, timeout_skip_s=0.0):
+        self.transport = transport
+        self.every = every
+        self.clock = clock
+        self.timeout_skip_ns = int(timeout_skip_s * 1e9)
+        self.url = transport.url
+        self.connects = 0
+        self.broken = 0
+        self.timeouts = 0
+
+    def connect(self):
+        sock = self.transport.connect()
+        self.connects += 1
+        if self.every and self.connects % self.every == 0:
+            sock.shutdown(socket.SHUT_WR)  # sendall() now fails with EPIPE
+            self.broken += 1
+        return sock
+
+    def is_timeout(self, error):
+        if not self.transport.is_timeout(error):
+            return False
+        self.timeouts += 1
+        if self.clock is not None:
+            self.clock.advance(self.timeout_skip_ns)
+        return True
+
+
+# --- Measurements ---
+
+def rss_bytes():
+    """Resident set size of this process (peak RSS where /proc is missing)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Probe:
+    """Collects reading latencies and samples resources every PROBE_INTERVAL_S."""
+
+    def __init__(self, clock, duration_s, stop):
+        self.clock = clock
+        self.duration_s = duration_s
+        self.stop = stop
+        self.samples = []
+        self.readings = 0
+        self.unclosed = 0  # Sockets and files closed by the garbage collector
+        self._window = []
+        self._next_probe = 0.0
+
+    def record_latency(self, seconds):
+        self._window.append(seconds * 1e3)
+        self.readings += 1
+
+    def __call__(self):
+        elapsed = self.clock.elapsed()
+        if elapsed < self._next_probe:
+            return
+        self._next_probe += PROBE_INTERVAL_S
+        window = sorted(self._window)
+        self._window = []
+        self.samples.append({
+            "hours": elapsed / 3600, "rssMb": rss_bytes() / 2 ** 20, "fds": open_fds(),
+            "threads": threading.active_count(), "unclosed": self.unclosed, "readings": self.readings,
+            "p50Ms": _percentile(window, 0.5), "p99Ms": _percentile(window, 0.99),
+            "p999Ms": _percentile(window, 0.999),
+        })
+        print(_format_sample(self.samples[-1]), flush=True)
+        if elapsed >= self.duration_s:
+            self.stop()
+
+
+def _format_sample(sample):
+    latency = "-"
+    if sample["p50Ms"] is not None:
+        latency = "p50 %6.1f ms  p99 %6.1f ms  p999 %6.1f ms" % (
+            sample["p50Ms"], sample["p99Ms"], sample["p999Ms"])
+    return "%6.1f h  rss %6.1f MB  fds %3s  threads %2d  unclosed %4d  readings %6d  %s" % (
+        sample["hours"], sample["rssMb"], sample["fds"], sample["threads"], sample["unclosed"],
+        sample["readings"], latency)
+
+
+def _slope_per_day(points):
+    # Least-squares slope of (hours, value), scaled to a day.
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    sxx = sum((x - mean_x) ** 2 for x, _ in points)
+    if sxx == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / sxx * 24
+
+
+def check(samples, sent, phone_stats, allow_format_mismatch=False):
+    """
+    Returns the soak failures (empty if it passed).
+
+    Args:
+        samples (list): Probe.samples.
+        sent (int): Readings take_reading() reported as sent.
+        phone_stats (dict): PhoneEmulator.stats() at the end of the run.
+        allow_format_mismatch (bool): Count messages the app rejected for
+            their format as stored (see the module header).
+    """
+    failures = []
+    settled = [s for s in samples if s["hours"] * 3600 >= WARMUP_S]
+    if len(settled) < 3:
+        return ["Too short to judge: %d samples after the %.1f h warm-up" % (len(settled), WARMUP_S / 3600)]
+    base = settled[0]
+
+    if base["fds"] is not None:
+        peak = max(s["fds"] for s in settled)
+        if peak > base["fds"]:
+            failures.append("Open file descriptors grew from %d to %d" % (base["fds"], peak))
+    if samples[-1]["unclosed"]:
+        # CPython closes them on collection, so the fd count alone misses
+        # these; PyBluez sockets or another interpreter may not.
+        failures.append("%d sockets or files were left to the garbage collector to close"
+                        % samples[-1]["unclosed"])
+    peak = max(s["threads"] for s in settled)
+    if peak > base["threads"]:
+        failures.append("Threads grew from %d to %d" % (base["threads"], peak))
+
+    slope = _slope_per_day([(s["hours"], s["rssMb"]) for s in settled])
+    if slope > RSS_GROWTH_LIMIT_MB_PER_DAY:
+        failures.append("RSS grows %.2f MB per simulated day (limit %.2f)" % (slope, RSS_GROWTH_LIMIT_MB_PER_DAY))
+
+    p99s = [s["p99Ms"] for s in settled if s["p99Ms"] is not None]
+    third = max(1, len(p99s) // 3)
+    if len(p99s) >= 2:
+        early = sorted(p99s[:third])[len(p99s[:third]) // 2]
+        late = sorted(p99s[-third:])[len(p99s[-third:]) // 2]
+        if late > early * LATENCY_GROWTH_LIMIT + LATENCY_SLACK_MS:
+            failures.append("Reading p99 latency crept from %.1f ms to %.1f ms" % (early, late))
+
+    stored = phone_stats["accepted"]
+    if allow_format_mismatch:
+        stored += phone_stats["formatErrors"]
+    if stored != sent:
+        failures.append("%d readings reported sent, the phone stored %d (%d not in the app's format, "
+                        "%d unparsable)" % (sent, phone_stats["accepted"], phone_stats["formatErrors"],
+                                            phone_stats["parseErrors"]))
+    return failures
+
+
+# --- Soak ---
+
+def run_soak(hours=SOAK_HOURS, faults=True, seed=1, allow_format_mismatch=False, phone_acks=False):
+    """
+    Runs the stack for 'hours' simulated hours.
+
+    Args:
+        phone_acks (bool): Reply to every message, which the app never does.
+
+    Returns:
+        list: Failures, empty if the soak passed.
+    """
+    import bt
+    import gpio_backend
+    import logging_setup
+    from phone_emulator import PhoneEmulator
+
+    workdir = tempfile.mkdtemp(prefix="drinksync-soak-")
+    os.chdir(workdir)
+    # Saved settings (scale_persistent_tare.CONFIG_FILE), so start-up skips
+    # the interactive tare.
+    with open("scale_config.json", "w") as f:
+        json.dump({"offset": SIM_OFFSET, "referenceUnit": SIM_REFERENCE_UNIT,
+                   "initialMaxWeight": FULL_BOTTLE_G}, f)
+    log_file = open(os.path.join(workdir, "soak.log"), "w")
+    logging_setup.setup_logging(level=logging.WARNING, stream=log_file)
+
+    clock = AcceleratedClock()
+    clock.install()
+    scenario = DrinkingScenario(clock, seed)
+    region = SimulatedHX711(clock, 6, 5, scenario.counts)
+    gpio_backend.BACKENDS["soak"] = lambda: GpioMemBackend(region)
+    gpio_backend.DEFAULT_BACKEND = "soak"
+
+    phone = PhoneEmulator("tcp://127.0.0.1:0", ack=phone_acks).start()
+    reply_timeout_s = bt.REPLY_TIMEOUT_S
+    if not phone_acks:
+        bt.REPLY_TIMEOUT_S = SOAK_REPLY_TIMEOUT_S
+    transport = FlakyTransport(bt.transport_from_url(phone.url), LINK_FAULT_EVERY if faults else None,
+                               clock, max(0.0, reply_timeout_s - SOAK_REPLY_TIMEOUT_S))
+    bt.set_transport(transport)
+
+    print(f"Soak: {hours:g} simulated hours, faults {'on' if faults else 'off'}, "
+          f"phone {'replies' if phone_acks else 'never replies'}, in {workdir}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        import scale_persistent_tare
+        import stability_scale_trigger
+
+    # Time every reading the trigger makes.
+    take_reading = stability_scale_trigger.take_reading
+
+    def timed_reading():
+        start = time.perf_counter()
+        try:
+            return take_reading()
+        finally:
+            probe.record_latency(time.perf_counter() - start)
+
+    stability_scale_trigger.take_reading = timed_reading
+
+    next_stall = [STALL_EVERY_S if faults and STALL_EVERY_S else None]
+
+    def on_sample():
+        if next_stall[0] is not None and clock.elapsed() >= next_stall[0]:
+            region.stall(STALL_DURATION_S)
+            next_stall[0] += STALL_EVERY_S
+        probe()
+
+    gyro = SimulatedGyro(scenario, on_sample)
+    monitor = stability_scale_trigger.monitor_pipeline(gyro)
+    probe = Probe(clock, hours * 3600, monitor.stop)
+
+    show_warning = warnings.showwarning
+
+    def count_unclosed(message, category, *args, **kwargs):
+        if category is ResourceWarning and str(message).startswith("unclosed"):
+            probe.unclosed += 1
+        else:
+            show_warning(message, category, *args, **kwargs)
+
+    warnings.simplefilter("always", ResourceWarning)
+    warnings.showwarning = count_unclosed
+    started = time.perf_counter()
+    monitor.run_inline()
+    real_s = time.perf_counter() - started
+
+    outcomes = scale_persistent_tare.READINGS_COMPLETED._children
+    sent = outcomes[("sent",)].value if ("sent",) in outcomes else 0
+    phone.stop()
+    bt.REPLY_TIMEOUT_S = reply_timeout_s
+    clock.uninstall()
+    logging_setup.shutdown_logging()
+    log_file.close()
+
+    warnings.showwarning = show_warning
+    stats = phone.stats()
+    received = stats["accepted"] + stats["formatErrors"] + stats["parseErrors"]
+    with open(os.path.join(workdir, "soak.log")) as f:
+        warning_lines = sum(1 for line in f if " WARNING " in line or " ERROR " in line)
+    print(f"\n{probe.readings} readings in {real_s:.0f} s real time; "
+          f"outcomes {dict((k[0], c.value) for k, c in sorted(outcomes.items()))}")
+    print(f"Scenario: {scenario.sips} sips, {scenario.refills} refills; HX711: {region.conversions} conversions, "
+          f"{region.power_cycles} power cycles, {region.stalls} stalls; links: {transport.connects} connections, "
+          f"{transport.broken} broken, {transport.timeouts} unanswered; {warning_lines} warnings in soak.log")
+    print(f"Phone: {received} messages received, {stats['accepted']} stored, "
+          f"{stats['formatErrors']} not in the app's format")
+
+    failures = check(probe.samples, sent, stats, allow_format_mismatch)
+    for failure in failures:
+        print("FAIL: " + failure)
+    if not failures:
+        print("PASS")
+    return failures
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if a not in ("--no-faults", "--allow-format-mismatch", "--phone-acks")]
+    if len(args) > 1 or (args and not args[0].replace(".", "", 1).isdigit()):
+        print("Usage: python3 soak.py [hours] [--no-faults] [--allow-format-mismatch] [--phone-acks]")
+        sys.exit(2)
+    failed = run_soak(float(args[0]) if args else SOAK_HOURS, faults="--no-faults" not in sys.argv,
+                      allow_format_mismatch="--allow-format-mismatch" in sys.argv,
+                      phone_acks="--phone-acks" in sys.argv)
+    sys.exit(1 if failed else 0)
@@ -2,41 +2,31 @@
 
 import time
 import sys
-import math  # Required if using magnitude threshold
-
-# Import the gyroscope library
-try:
-    from mpu6050 import mpu6050
-except ImportError:
-    print("ERROR: Could not import mpu6050 library.")
-    print("Ensure it's installed (e.g., 'pip install mpu6050-raspberrypi')")
-    sys.exit(1)
-
-# Import functions from your scale script
-# Ensure scale_persistent_tare.py is in the same directory or PYTHONPATH
-try:
-    # We import 'hx' as well to check if it was initialized correctly
-    from scale_persistent_tare import take_reading, cleanAndExit, hx
-except ImportError:
-    print("ERROR: Could not import from scale_persistent_tare.py.")
-    print("Ensure the file exists and is in the correct path.")
-    sys.exit(1)
-except Exception as e:
-    # Catch errors happening *during* the import/initialization of the scale script
-    print(f"ERROR: An error occurred during import or initialization of the scale module: {e}")
-    # Attempt basic cleanup if possible, although scale's GPIO might not be setup
-    try:
-        import RPi.GPIO as GPIO
+import threading
+import logging
+import logging_setup
+import metrics
+import pipeline
+import tracing
 
-        GPIO.cleanup()
-        print("(Attempted basic GPIO cleanup)")
-    except Exception as cleanup_e:
-        print(f"(GPIO cleanup attempt failed: {cleanup_e})")
-    sys.exit(1)
+log = logging.getLogger("drinksync.stability")
 
 # --- Configuration ---
 GYROSCOPE_I2C_ADDRESS = 0x68  # Default I2C address for MPU6050
 
+# --- Metrics Export ---
+# Prometheus text on http://127.0.0.1:<port>/metrics (None to disable), and/or
+# a file rewritten periodically (e.g. for node_exporter's textfile collector).
+METRICS_HTTP_PORT = 9711
+METRICS_FILE = None  # e.g. "/var/lib/node_exporter/drinksync.prom"
+METRICS_FILE_INTERVAL = 15.0  # seconds
+
+# --- Tracing ---
+# When enabled, per-phase spans are buffered in memory and written as Chrome
+# trace-event JSON on SIGUSR1 and at exit (view in chrome://tracing or Perfetto).
+TRACE_ENABLED = False
+TRACE_FILE = "drinksync_trace.json"
+
 # --- Stability Thresholds (*** ADJUST THESE VALUES! ***) ---
 # Lower values mean it needs to be MORE still. Start higher and decrease.
 GYRO_THRESHOLD_X = 4  # Max degrees/second allowed on X-axis for stability
@@ -45,32 +35,153 @@ GYRO_THRESHOLD_Z = 4  # Max degrees/second allowed on Z-axis for stability
 # --- OR ---
 # Optional: Use magnitude threshold instead of individual axes
 # GYRO_MAGNITUDE_THRESHOLD = 3.0 # Example: sqrt(gx^2 + gy^2 + gz^2) < threshold
+# (pass magnitude=GYRO_MAGNITUDE_THRESHOLD to MotionGate in monitor_pipeline())
 
 # --- Stability Duration ---
 STABILITY_DURATION_REQUIRED = 3.0  # seconds
 SAMPLE_INTERVAL = 0.1  # seconds between stability checks (10 Hz)
 
+# --- Duty Cycling ---
+# In the hours the history shows as quiet, poll the gyroscope less often and
+# skip readings of an untouched bottle (see duty_cycle.py). Motion restores
+# full rate at once; with less than a few days of history nothing changes.
+DUTY_CYCLE_ENABLED = True
+
 # --- State Variables ---
-stability_start_time = None  # Tracks when the current stable period began
 gyro_sensor = None  # Gyro sensor object
+scheduler = None  # duty_cycle.DutyCycleScheduler when DUTY_CYCLE_ENABLED
+scale = None  # The scale_persistent_tare module, once load_scale() has imported it
+_scale_loader = None
+
+
+# --- Scale ---
+# Importing scale_persistent_tare initializes the HX711 and applies the saved
+# tare (or runs a new one), which takes seconds. load_scale() does that on a
+# thread, so the gyroscope starts and the stability timer runs meanwhile; the
+# first trigger waits for it in take_reading().
+def load_scale():
+    """Starts importing scale_persistent_tare in the background (once)."""
+    global _scale_loader
+    if _scale_loader is None:
+        _scale_loader = threading.Thread(target=_load_scale, name="scale-init", daemon=True)
+        _scale_loader.start()
+
+
+def _load_scale():
+    global scale
+    # Ensure scale_persistent_tare.py is in the same directory or PYTHONPATH
+    try:
+        import scale_persistent_tare
+    except ImportError:
+        print("ERROR: Could not import from scale_persistent_tare.py.")
+        print("Ensure the file exists and is in the correct path.")
+        return
+    except (Exception, SystemExit) as e:
+        # Catch errors happening *during* the import/initialization of the scale script
+        print(f"ERROR: An error occurred during import or initialization of the scale module: {e}")
+        # Attempt basic cleanup if possible, although scale's GPIO might not be setup
+        try:
+            import RPi.GPIO as GPIO
+
+            GPIO.cleanup()
+            print("(Attempted basic GPIO cleanup)")
+        except Exception as cleanup_e:
+            print(f"(GPIO cleanup attempt failed: {cleanup_e})")
+        return
+    # Check 'hx' as well: it is None if the HX711 was not initialized correctly
+    if scale_persistent_tare.hx is None:
+        print("ERROR: Scale HX711 object was not initialized correctly during import.")
+        print("The scale_persistent_tare.py script might have failed.")
+        return
+    scale = scale_persistent_tare
+    print("Scale module loaded and HX711 object appears initialized.")
 
 
-# --- Main Function ---
-def run_stability_monitor():
-    global stability_start_time, gyro_sensor
+def wait_for_scale():
+    """
+    Waits for load_scale() to finish, starting it if needed.
 
-    # --- Pre-checks ---
-    # 1. Verify Scale Initialized (hx object should exist from import)
-    if hx is None:
-        print("ERROR: Scale HX711 object was not initialized correctly during import.")
-        print("The scale_persistent_tare.py script might have failed.")
+    Returns:
+        module: scale_persistent_tare, or None if it failed to initialize.
+    """
+    load_scale()
+    _scale_loader.join()
+    return scale
+
+
+def take_reading():
+    """scale_persistent_tare.take_reading(), once the scale is ready; exits if it never will be."""
+    if wait_for_scale() is None:
         print("Cannot proceed without a working scale.")
-        # No GPIO cleanup needed here as scale init failed before likely setup
         sys.exit(1)
+    return scale.take_reading()
+
+
+def cleanAndExit():
+    """Releases the scale via scale_persistent_tare.cleanAndExit() if it was loaded, and exits."""
+    if scale is not None:
+        scale.cleanAndExit()
+    sys.exit()
+
+
+# --- Trigger ---
+def trigger_reading(event):
+    if scheduler is not None and not scheduler.reading_due():
+        log.debug("Quiet hour and no motion since the last reading; not reading.")
+        return
+    log.info("Stability maintained for required duration. Triggering scale reading.")
+
+    # === CALL SCALE READING FUNCTION ===
+    with tracing.span("stability.triggered_reading"):
+        weight = take_reading()  # scale_persistent_tare.take_reading()
+    # ===================================
+    if scheduler is not None:
+        scheduler.note_reading()
+
+    if weight is not None:
+        log.info("Scale reading complete: %.2f grams", weight)
     else:
-        print("Scale module loaded and HX711 object appears initialized.")
+        log.warning("Scale reading failed (check scale logs)")
+
+    log.info("Resuming stability monitoring...")
+    # Add a small pause after reading before resuming intense monitoring
+    time.sleep(0.5)
+
+
+def monitor_pipeline(sensor, scheduler=None):
+    """
+    Gyroscope samples -> stability timer (resets on motion or read errors,
+    waits for the *next* stable period after a trigger) -> scale reading.
+    Run it with run_inline(): the reading runs on the sampling thread, so no
+    samples pile up meanwhile.
+
+    With a duty_cycle.DutyCycleScheduler, the poll interval follows it and
+    motion is reported to it.
+    """
+    return pipeline.Pipeline(
+        pipeline.gyro_source(sensor, scheduler.gyro_interval if scheduler is not None else SAMPLE_INTERVAL),
+        [pipeline.MotionGate((GYRO_THRESHOLD_X, GYRO_THRESHOLD_Y, GYRO_THRESHOLD_Z),
+                             STABILITY_DURATION_REQUIRED, logger=log,
+                             on_motion=scheduler.note_motion if scheduler is not None else None),
+         pipeline.CallbackSink(trigger_reading)],
+        collect=False)
+
+
+# --- Main Function ---
+def run_stability_monitor():
+    global gyro_sensor, scheduler
+
+    # --- Pre-checks ---
+    # 1. Start Initializing the Scale (finishes in the background)
+    load_scale()
 
     # 2. Initialize Gyroscope
+    try:
+        from mpu6050 import mpu6050
+    except ImportError:
+        print("ERROR: Could not import mpu6050 library.")
+        print("Ensure it's installed (e.g., 'pip install mpu6050-raspberrypi')")
+        sys.exit(1)  # The final cleanup releases the scale's GPIO
     print(f"Initializing Gyroscope (MPU6050) at I2C address {hex(GYROSCOPE_I2C_ADDRESS)}...")
     try:
         gyro_sensor = mpu6050(GYROSCOPE_I2C_ADDRESS)
@@ -84,99 +195,46 @@ def run_stability_monitor():
         cleanAndExit()
         sys.exit(1)
 
+    # 3. Start Metrics Exporters
+    if METRICS_HTTP_PORT is not None:
+        try:
+            metrics.start_http_server(METRICS_HTTP_PORT)
+            print(f"Metrics available at http://{metrics.METRICS_HTTP_ADDRESS}:{METRICS_HTTP_PORT}/metrics")
+        except OSError as e:
+            print(f"Warning: Could not start metrics endpoint on port {METRICS_HTTP_PORT}: {e}")
+    if METRICS_FILE is not None:
+        metrics.start_file_writer(METRICS_FILE, METRICS_FILE_INTERVAL)
+
+    # 4. Enable Tracing
+    if TRACE_ENABLED:
+        tracing.enable()
+        tracing.dump_on_signal(TRACE_FILE)
+        print(f"Tracing enabled. Send SIGUSR1 to write {TRACE_FILE}.")
+
+    # 5. Duty Cycling (learns the quiet hours from the reading history)
+    if DUTY_CYCLE_ENABLED:
+        import duty_cycle
+        import history_store
+
+        scheduler = duty_cycle.DutyCycleScheduler(store=history_store.HistoryStore(history_store.HISTORY_DB),
+                                                  full_gyro_interval_s=SAMPLE_INTERVAL)
+        print("Duty cycling enabled: slower polling in historically quiet hours.")
+
     # --- Monitoring Loop ---
     print(f"\nMonitoring for {STABILITY_DURATION_REQUIRED:.1f} seconds of stability...")
     print(f"Thresholds: Gyro(|X|,|Y|,|Z|) < ({GYRO_THRESHOLD_X}, {GYRO_THRESHOLD_Y}, {GYRO_THRESHOLD_Z}) deg/s")
     print("Press Ctrl+C to exit gracefully.")
 
-    last_status_print_time = 0  # To avoid flooding the console
-
-    while True:
-        try:
-            # 1. Read Gyroscope Data
-            # It's good practice to handle potential errors during sensor reads
-            try:
-                gyro_data = gyro_sensor.get_gyro_data()
-                gx = gyro_data['x']
-                gy = gyro_data['y']
-                gz = gyro_data['z']
-            except Exception as read_err:
-                print(f"\nWarning: Error reading gyroscope data: {read_err}")
-                # Decide how to handle read errors - skip this cycle? Reset timer?
-                stability_start_time = None  # Reset stability on sensor read error
-                time.sleep(SAMPLE_INTERVAL * 2)  # Wait a bit longer after error
-                continue  # Skip the rest of this loop iteration
-
-            # 2. Check if Current Reading is Stable
-            # --- Using individual axes ---
-            is_stable_now = (abs(gx) < GYRO_THRESHOLD_X and
-                             abs(gy) < GYRO_THRESHOLD_Y and
-                             abs(gz) < GYRO_THRESHOLD_Z)
-            # --- OR Using magnitude (uncomment the next 2 lines and comment out the block above) ---
-            # gyro_magnitude = math.sqrt(gx**2 + gy**2 + gz**2)
-            # is_stable_now = gyro_magnitude < GYRO_MAGNITUDE_THRESHOLD
-
-            current_time = time.time()
-
-            # Print current status periodically for feedback
-            if current_time - last_status_print_time > 1.0:  # Print status once per second
-                stability_status = "STABLE" if is_stable_now else "UNSTABLE"
-                elapsed_stable_time = (current_time - stability_start_time) if stability_start_time else 0
-                # Format gyro readings for cleaner output
-                gyro_str = f"Gx={gx: >+6.1f}, Gy={gy: >+6.1f}, Gz={gz: >+6.1f}"
-                print(f"Status: {stability_status: <8} | Stable Time: {elapsed_stable_time:4.1f}s | {gyro_str}",
-                      end='\r')  # Use '\r' to update line
-                last_status_print_time = current_time
-
-            # 3. Update Stability Timer and Trigger Scale Reading
-            if is_stable_now:
-                if stability_start_time is None:
-                    # Just became stable
-                    stability_start_time = current_time
-                    print("\n--> Stable condition met. Starting timer...      ",
-                          end='\r')  # Extra spaces overwrite previous line
-                    last_status_print_time = 0  # Force immediate status print update
-                else:
-                    # Already stable, check if duration met
-                    elapsed_time = current_time - stability_start_time
-                    if elapsed_time >= STABILITY_DURATION_REQUIRED:
-                        print("\n*** Stability maintained for required duration! ***")  # Move to new line
-                        print("--- Triggering Scale Reading ---")
-
-                        # === CALL SCALE READING FUNCTION ===
-                        weight = take_reading()  # Function from scale_persistent_tare.py
-                        # ===================================
-
-                        if weight is not None:
-                            print(f"--- Scale Reading Complete: {weight:.2f} grams ---")
-                        else:
-                            print("--- Scale Reading Failed (check scale script logs) ---")
-
-                        print("\nResuming stability monitoring...")
-                        # Reset timer to wait for the *next* stable period
-                        stability_start_time = None
-                        last_status_print_time = 0  # Force immediate status print update
-                        # Add a small pause after reading before resuming intense monitoring
-                        time.sleep(0.5)
-
-            else:  # Not stable now
-                if stability_start_time is not None:
-                    # Just became unstable
-                    print("\n--> Unstable condition detected. Resetting timer...",
-                          end='\r')  # Extra spaces overwrite previous line
-                    stability_start_time = None  # Reset timer
-                    last_status_print_time = 0  # Force immediate status print update
-
-            # 4. Wait before next sample check
-            time.sleep(SAMPLE_INTERVAL)
-
-        except KeyboardInterrupt:
-            print("\nCtrl+C detected. Exiting loop.")
-            break  # Exit the while loop cleanly
+    monitor = monitor_pipeline(gyro_sensor, scheduler)
+    try:
+        monitor.run_inline()
+    except KeyboardInterrupt:
+        print("\nCtrl+C detected. Exiting loop.")
 
 
 # --- Script Execution ---
 if __name__ == "__main__":
+    logging_setup.ensure_logging()
     try:
         run_stability_monitor()
     except Exception as main_err:
@@ -186,6 +244,8 @@ if __name__ == "__main__":
         # This block executes whether the try block completed normally,
         # raised an exception, or exited via break (like Ctrl+C).
         print("\nExecuting final cleanup...")
-        # Call the cleanup function imported from the scale script
+        if tracing.is_enabled():
+            print(f"Trace: wrote {tracing.dump(TRACE_FILE)} events to {TRACE_FILE}")
+        # Releases the scale's GPIO if it was initialized
         cleanAndExit()
         print("Script finished.")
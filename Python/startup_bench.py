@@ -0,0 +1,237 @@
+# File: startup_bench.py
+#
+# Cold-start benchmark for the scale entry points: time from process start
+# to the first valid weight, and which imports it goes to.
+#
+# Each entry point is imported in a fresh interpreter against a simulated
+# HX711: a gpio_backend.FakeGpioRegion that converts every 1/BENCH_SPS
+# seconds of real time, like the chip. It powers down when PD_SCK stays high
+# for over 60 us, and for SETTLE_PERIODS conversions after power-up (and
+# after the interpreter starts, as if the chip had just been switched on) it
+# signals data ready as usual but returns off-scale counts. The bench fails if
+# the first weight is not BENCH_WEIGHT_G, i.e. if the driver took one of them.
+# The child runs in a temporary directory holding saved settings so start-up skips the
+# interactive tare, as on every boot after the first. The child reports
+# time.monotonic() stamps, which are comparable across processes, at:
+#   interpreter   its first statement, i.e. the interpreter's own start-up
+#   imported      entry point imported (for stability_scale_trigger: when
+#                 the gyroscope can start; the scale loads in the background)
+#   scale ready   HX711 initialized and configured
+#   first weight  first valid hx.get_weight(GET_WEIGHT_SAMPLES)
+# all relative to the parent's timestamp just before spawning it.
+#
+# A further run under `python3 -X importtime` sums the entry point's import
+# time by top-level package, so a heavy dependency stands out. A module's own
+# share includes its module-level code, e.g. scale_persistent_tare's HX711
+# set-up.
+#
+# Usage:
+#   python3 startup_bench.py [runs] [entry point ...]    # default: BENCH_RUNS runs of BENCH_ENTRY_POINTS
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# --- Configuration ---
+BENCH_ENTRY_POINTS = ("scale_persistent_tare", "stability_scale_trigger")  # scale.py tares on every start
+BENCH_RUNS = 5  # Timed runs per entry point (after one warm-up run that compiles the .pyc files)
+BENCH_SPS = 10  # Simulated HX711 rate (RATE pin low: 10 SPS, high: 80 SPS)
+GET_WEIGHT_SAMPLES = 5  # Conversions in the first weight
+SETTLE_PERIODS = 4  # Conversions after power-up that are not settled yet (HX711: 400 ms at 10 SPS)
+TOP_PACKAGES = 8  # Packages listed in the import-time breakdown
+
+# Saved settings for scale_persistent_tare.CONFIG_FILE, and the counts the
+# simulated load cell returns (BENCH_WEIGHT_G on the scale).
+BENCH_OFFSET = 8000
+BENCH_REFERENCE_UNIT = 425.37
+BENCH_WEIGHT_G = 500.0
+
+MARKS = ("interpreter", "imported", "scale_ready", "first_weight")
+_RESULT_PREFIX = "STARTUP-BENCH "
+
+# Runs in the child. Only gpio_backend (which hx711 imports anyway) is loaded
+# before the entry point, so the entry point's import cost is its own.
+_CHILD = r"""
+import time
+_marks = {"interpreter": time.monotonic()}
+import json
+import sys
+import gpio_backend
+
+
+class PacedRegion(gpio_backend.FakeGpioRegion):
+    # DOUT stays high until the next conversion edge of a real-time grid that
+    # restarts at power-up; the first SETTLE_PERIODS conversions are off-scale.
+    def __init__(self, clock_pin, data_pin, value, sps, settle_periods):
+        super().__init__(clock_pin, data_pin, value)
+        self.settled_value = value
+        self.settle_periods = settle_periods
+        self.period_ns = int(1e9 / sps)
+        self.high_ns = None
+        self.power_ups = 0
+        self.unsettled_reads = 0
+        self._power_up()
+
+    def _power_up(self):
+        self.epoch_ns = time.monotonic_ns()
+        self.ready_ns = self.epoch_ns + self.period_ns
+        self.pulses = 0
+        self.words[gpio_backend.GpioMemBackend.GPLEV0] &= ~self.data_mask  # DOUT now follows the grid
+        self.power_ups += 1
+
+    def __getitem__(self, index):
+        word = super().__getitem__(index)
+        if index == gpio_backend.GpioMemBackend.GPLEV0 and self.pulses == 0 and time.monotonic_ns() < self.ready_ns:
+            word |= self.data_mask
+        return word
+
+    def __setitem__(self, index, word):
+        if word & self.clock_mask:
+            if index == gpio_backend.GpioMemBackend.GPSET0 and not self._clock_high:
+                self.high_ns = time.monotonic_ns()
+            elif index == gpio_backend.GpioMemBackend.GPCLR0 and self.high_ns is not None:
+                if time.monotonic_ns() - self.high_ns > 60000:
+                    self._power_up()
+                self.high_ns = None
+        super().__setitem__(index, word)
+
+    def _rising_edge(self):
+        if self.pulses == 0:
+            edges = (time.monotonic_ns() - self.epoch_ns) // self.period_ns
+            self.ready_ns = self.epoch_ns + (edges + 1) * self.period_ns
+            # The data clocked out is that of the latest finished conversion.
+            if edges <= self.settle_periods:
+                self.value = -0x400000
+                self.unsettled_reads += 1
+            else:
+                self.value = self.settled_value
+        super()._rising_edge()
+
+
+region = PacedRegion(6, 5, %(counts)d, %(sps)d, %(settle)d)
+gpio_backend.BACKENDS["bench"] = lambda: gpio_backend.GpioMemBackend(region)
+gpio_backend.DEFAULT_BACKEND = "bench"
+
+print("%(prefix)simport", file=sys.stderr, flush=True)
+module = __import__(%(entry)r)  # importlib.import_module() bypasses -X importtime
+_marks["imported"] = time.monotonic()
+if hasattr(module, "wait_for_scale"):
+    module = module.wait_for_scale()
+_marks["scale_ready"] = time.monotonic()
+weight = module.hx.get_weight(%(samples)d)
+_marks["first_weight"] = time.monotonic()
+print("%(prefix)s" + json.dumps({"marks": _marks, "weight": weight, "numpy": "numpy" in sys.modules,
+                                 "power_ups": region.power_ups, "unsettled_reads": region.unsettled_reads}),
+      file=sys.stderr, flush=True)
+"""
+
+
+def _child_source(entry):
+    return _CHILD % {"entry": entry, "sps": BENCH_SPS, "samples": GET_WEIGHT_SAMPLES, "settle": SETTLE_PERIODS,
+                     "counts": round(BENCH_OFFSET + BENCH_WEIGHT_G * BENCH_REFERENCE_UNIT),
+                     "prefix": _RESULT_PREFIX}
+
+
+def run_once(entry, workdir, importtime=False):
+    """
+    Starts a fresh interpreter that imports 'entry' and takes the first weight.
+
+    Args:
+        entry (str): Module name of the entry point.
+        workdir (str): Working directory with the saved settings.
+        importtime (bool): Run under -X importtime and return its report too.
+
+    Returns:
+        tuple: (result dict with "marks" in seconds since spawn, "weight" and
+        "numpy", list of importtime lines for the entry point).
+    """
+    env = dict(os.environ)
+    here = os.path.dirname(os.path.abspath(__file__))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [here, env.get("PYTHONPATH")]))
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", _child_source(entry)]
+    start = time.monotonic()
+    done = subprocess.run(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True, timeout=120)
+    result, report, collecting = None, [], False
+    for line in done.stderr.splitlines():
+        if line.startswith(_RESULT_PREFIX + "import"):
+            collecting = True
+        elif line.startswith(_RESULT_PREFIX):
+            result = json.loads(line[len(_RESULT_PREFIX):])
+            collecting = False
+        elif collecting and line.startswith("import time:"):
+            report.append(line)
+    if result is None:
+        raise RuntimeError("%s did not start (exit status %d):\n%s" % (entry, done.returncode, done.stderr[-2000:]))
+    result["marks"] = {name: stamp - start for name, stamp in result["marks"].items()}
+    return result, report
+
+
+def import_breakdown(report):
+    """
+    Sums -X importtime self times by top-level package.
+
+    Returns:
+        tuple: (total import time in seconds, [(package, seconds), ...] largest first)
+    """
+    totals, total = {}, 0
+    for line in report:
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            self_us, cumulative_us = int(self_us), int(cumulative_us)
+        except ValueError:
+            continue  # The header line
+        if not name.startswith("  "):
+            total = max(total, cumulative_us)  # The entry point itself
+        package = name.strip().split(".")[0]
+        totals[package] = totals.get(package, 0) + self_us
+    ranked = sorted(totals.items(), key=lambda item: -item[1])
+    return total / 1e6, [(package, us / 1e6) for package, us in ranked]
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _bench(entries, runs):
+    """Returns the entry points whose first weight was wrong (read before the chip settled)."""
+    failed = []
+    workdir = tempfile.mkdtemp(prefix="drinksync-startup-")
+    try:
+        with open(os.path.join(workdir, "scale_config.json"), "w") as f:
+            json.dump({"offset": BENCH_OFFSET, "referenceUnit": BENCH_REFERENCE_UNIT,
+                       "initialMaxWeight": BENCH_WEIGHT_G + 100}, f)
+        print(f"Simulated HX711 at {BENCH_SPS} SPS, median of {runs} runs, "
+              f"times from spawning the interpreter:")
+        for entry in entries:
+            run_once(entry, workdir)  # Warm-up: writes the .pyc files
+            results = [run_once(entry, workdir)[0] for _ in range(runs)]
+            print(f"\n{entry}")
+            for name in MARKS:
+                print(f"  {name.replace('_', ' '): <13} {_median([r['marks'][name] for r in results]) * 1000:8.1f} ms")
+            weights = [r["weight"] for r in results]
+            print(f"  first weight {min(weights):.1f}-{max(weights):.1f} g, "
+                  f"NumPy {'imported' if any(r['numpy'] for r in results) else 'not imported'}, "
+                  f"{max(r['power_ups'] for r in results)} power-up(s), "
+                  f"{max(r['unsettled_reads'] for r in results)} unsettled conversion(s) read")
+            if any(abs(weight - BENCH_WEIGHT_G) > 1.0 for weight in weights):
+                failed.append(entry)
+            total, packages = import_breakdown(run_once(entry, workdir, importtime=True)[1])
+            print(f"  imports {total * 1000:.1f} ms (-X importtime), by package: " + ", ".join(
+                f"{package} {seconds * 1000:.1f}" for package, seconds in packages[:TOP_PACKAGES]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    for entry in failed:
+        print(f"FAIL: {entry}'s first weight is not {BENCH_WEIGHT_G:g} g: it read conversions before the HX711 settled")
+    return failed
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    runs = int(args.pop(0)) if args and args[0].isdigit() else BENCH_RUNS
+    sys.exit(1 if _bench(args or BENCH_ENTRY_POINTS, runs) else 0)
@@ -0,0 +1,306 @@
+# File: stream_server.py
+#
+# Server-Sent Events stream of filtered weight, stability state and detected
+# events for dashboards and the companion app.
+#
+# The server polls a snapshot source at STREAM_RATE_HZ (on an executor
+# thread, since a query blocks), encodes each frame once and fans it out to
+# every subscriber. Each subscriber has a small
+# bounded queue; when a client cannot keep up, its oldest queued frame is
+# dropped so it always receives the freshest data and memory stays bounded.
+#
+# Usage:
+#   python3 stream_server.py              # stream from the running scale daemon
+#   python3 stream_server.py loadtest     # fan-out throughput on loopback, no hardware
+#
+#   curl -N http://127.0.0.1:8711/stream
+
+import asyncio
+import json
+import logging
+import socket
+import sys
+import time
+
+import logging_setup
+
+log = logging.getLogger("drinksync.stream")
+
+# --- Configuration ---
+STREAM_HOST = "127.0.0.1"
+STREAM_PORT = 8711
+STREAM_RATE_HZ = 10.0  # Frames published per second
+CLIENT_QUEUE_DEPTH = 8  # Frames buffered per subscriber before the oldest is dropped
+# Kernel send buffer per client. Kept small so a stalled client backs up into
+# its bounded queue (where stale frames are dropped) instead of the socket.
+CLIENT_SEND_BUFFER = 16384  # bytes
+
+
+class Subscriber:
+    """One connected client and its bounded frame queue."""
+
+    def __init__(self, writer, depth=CLIENT_QUEUE_DEPTH):
+        self.writer = writer
+        self.queue = asyncio.Queue(maxsize=depth)
+        self.sent = 0
+        self.dropped = 0
+
+    def offer(self, frame):
+        # Never wait on a slow client: make room by discarding its stalest frame.
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(frame)
+
+
+class StreamServer:
+    """
+    Publishes snapshots from 'source' (a callable returning the scale daemon's
+    SNAPSHOT dictionary; it may block, it runs on an executor thread) to all
+    connected SSE subscribers.
+    """
+
+    def __init__(self, source, rate_hz=STREAM_RATE_HZ, depth=CLIENT_QUEUE_DEPTH):
+        self.source = source
+        self.interval = 1.0 / rate_hz
+        self.depth = depth
+        self.subscribers = set()
+        self.frames_published = 0
+        self.last_event_seq = 0
+        self.last_weight_seq = 0
+        self.source_failures = 0  # Consecutive failed snapshots
+        self._server = None
+        self._publisher = None
+
+    async def start(self, host=STREAM_HOST, port=STREAM_PORT):
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        self._publisher = asyncio.create_task(self._publish_loop())
+        return self._server
+
+    async def stop(self):
+        self._publisher.cancel()
+        self._server.close()
+        for subscriber in list(self.subscribers):
+            subscriber.writer.close()
+        await self._server.wait_closed()
+
+    # --- Publishing ---
+
+    def _frames_from_snapshot(self, snapshot):
+        frames = []
+        events = snapshot.get("events", ())
+        # A restarted daemon numbers weights and events from 1 again; without
+        # a reset its events would be skipped until they passed the old seq.
+        weight_seq = snapshot.get("weight", {}).get("seq") or 0
+        newest_event_seq = max((event["seq"] for event in events), default=self.last_event_seq)
+        if weight_seq < self.last_weight_seq or newest_event_seq < self.last_event_seq:
+            log.info("Scale daemon sequence numbers went back (restarted); resetting")
+            self.last_event_seq = 0
+        self.last_weight_seq = weight_seq
+        for event in events:
+            if event["seq"] > self.last_event_seq:
+                self.last_event_seq = event["seq"]
+                frames.append(_encode("scale_event", event))
+        state = snapshot.get("state", {})
+        frames.append(_encode("sample", {
+            "ts": time.time(),
+            "weight": snapshot.get("filtered", {}).get("weight"),
+            "raw_weight": snapshot.get("weight", {}).get("weight"),
+            "stable": state.get("stable"),
+            "stable_for": state.get("stable_for"),
+            "gyro": state.get("gyro"),
+        }))
+        return frames
+
+    async def _publish_loop(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            try:
+                frames = self._frames_from_snapshot(await loop.run_in_executor(None, self.source))
+            except Exception as e:
+                self.source_failures += 1
+                # Once per outage, not at STREAM_RATE_HZ
+                if self.source_failures == 1:
+                    log.warning("Snapshot source failed: %s", e)
+                frames = []
+            else:
+                if self.source_failures:
+                    log.info("Snapshot source back after %d failed polls", self.source_failures)
+                    self.source_failures = 0
+            for frame in frames:
+                for subscriber in self.subscribers:
+                    subscriber.offer(frame)
+                self.frames_published += 1
+            # Schedule against absolute ticks so publishing time doesn't add drift.
+            next_tick += self.interval
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+
+    # --- Per-client handling ---
+
+    async def _handle_client(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # Headers are not needed
+        except ConnectionError:
+            writer.close()
+            return
+
+        parts = request_line.decode(errors="replace").split()
+        if len(parts) < 2 or parts[0] != "GET" or parts[1].split("?")[0] != "/stream":
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            writer.close()
+            return
+
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\n"
+                     b"Connection: keep-alive\r\n"
+                     b"Access-Control-Allow-Origin: *\r\n\r\n")
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CLIENT_SEND_BUFFER)
+        writer.transport.set_write_buffer_limits(high=CLIENT_SEND_BUFFER)
+        subscriber = Subscriber(writer, self.depth)
+        self.subscribers.add(subscriber)
+        log.info("Stream client connected (%d total)", len(self.subscribers))
+        try:
+            while True:
+                frame = await subscriber.queue.get()
+                writer.write(frame)
+                await writer.drain()
+                subscriber.sent += 1
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            writer.close()
+            log.info("Stream client disconnected after %d frames (%d dropped)",
+                     subscriber.sent, subscriber.dropped)
+
+
+def _encode(event_type, data):
+    payload = json.dumps(data, separators=(",", ":"))
+    return f"event: {event_type}\ndata: {payload}\n\n".encode()
+
+
+class DaemonSource:
+    """
+    SNAPSHOT queries over one persistent ScaleClient. After a connection
+    error the client is dropped and the next call connects afresh, so the
+    stream picks up a restarted daemon.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.client = None
+
+    def __call__(self):
+        from scale_daemon import SOCKET_PATH, ScaleClient
+
+        if self.client is None:
+            self.client = ScaleClient(self.path or SOCKET_PATH)
+        try:
+            return self.client.query("SNAPSHOT")
+        except (OSError, ValueError):
+            # Timed out, closed or garbled: the connection is out of step.
+            self.close()
+            raise
+
+    def close(self):
+        client, self.client = self.client, None
+        if client is not None:
+            client.close()
+
+
+# --- Entry Points ---
+
+async def run_from_daemon(host=STREAM_HOST, port=STREAM_PORT, rate_hz=STREAM_RATE_HZ):
+    """Streams snapshots queried from the scale daemon's Unix socket."""
+    source = DaemonSource()
+    server = StreamServer(source, rate_hz)
+    await server.start(host, port)
+    log.info("Streaming at %.1f Hz on http://%s:%d/stream", rate_hz, host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        source.close()
+
+
+async def run_load_test(clients=200, slow_clients=10, seconds=5.0, rate_hz=100.0):
+    """
+    Connects 'clients' SSE subscribers over loopback, 'slow_clients' of which
+    read at a trickle, and reports fan-out throughput and drops.
+    """
+    from scale_daemon import ScaleState
+
+    state = ScaleState()
+    state.update_weight(250.0)
+    state.update_motion([0.1, 0.2, 0.3], True)
+    server = StreamServer(state.snapshot, rate_hz)
+    tcp_server = await server.start(STREAM_HOST, 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+
+    received = [0] * clients
+
+    async def consume(index, slow):
+        # Raw non-blocking sockets: asyncio streams would read ahead into their
+        # own buffer and hide a slow consumer from the server.
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if slow:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (STREAM_HOST, port))
+            await loop.sock_sendall(sock, b"GET /stream HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            while True:
+                if slow:
+                    await asyncio.sleep(0.5)
+                chunk = await loop.sock_recv(sock, 256 if slow else 65536)
+                if not chunk:
+                    break
+                received[index] += chunk.count(b"\n\n")
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            sock.close()
+
+    tasks = [asyncio.create_task(consume(i, i < slow_clients)) for i in range(clients)]
+    await asyncio.sleep(0.5)  # Let everyone connect
+    start_published = server.frames_published
+    start_received = sum(received)
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        state.update_weight(250.0 + (time.perf_counter() - start))
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    published = server.frames_published - start_published
+    delivered = sum(received) - start_received
+    dropped = sum(s.dropped for s in server.subscribers)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await server.stop()
+
+    fast = received[slow_clients:]
+    print(f"{clients} subscribers ({slow_clients} slow), {rate_hz:.0f} Hz for {elapsed:.1f} s")
+    print(f"  frames published:  {published} ({published / elapsed:.0f}/s)")
+    print(f"  frames delivered:  {delivered} ({delivered / elapsed:.0f}/s fan-out)")
+    print(f"  per fast client:   min={min(fast)} max={max(fast)}")
+    print(f"  dropped (stale):   {dropped}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "loadtest":
+        asyncio.run(run_load_test())
+    else:
+        logging_setup.ensure_logging()
+        try:
+            asyncio.run(run_from_daemon())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,136 @@
+# File: tracing.py
+#
+# Opt-in per-phase tracing spans for the reading and trigger pipeline.
+# Spans are kept in a fixed-size ring buffer and can be dumped as Chrome
+# trace-event JSON (open in chrome://tracing or https://ui.perfetto.dev).
+#
+# While tracing is disabled, span() returns one shared no-op context manager,
+# so a hook point costs a global lookup and an empty with-block.
+
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# --- Configuration ---
+DEFAULT_CAPACITY = 10000  # Spans kept in the ring buffer (oldest are overwritten)
+
+# --- State ---
+_enabled = False
+_buffer = deque(maxlen=DEFAULT_CAPACITY)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("name", "args", "start_ns")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start_ns = time.monotonic_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end_ns = time.monotonic_ns()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        _buffer.append(("X", self.name, self.start_ns, end_ns - self.start_ns,
+                        threading.get_ident(), self.args))
+        return False
+
+    def set(self, **args):
+        """Attaches extra arguments (e.g. sample counts) to the span."""
+        self.args.update(args)
+
+
+def enable(capacity=DEFAULT_CAPACITY):
+    """Starts recording spans into a fresh ring buffer of 'capacity' entries."""
+    global _enabled, _buffer
+    _buffer = deque(maxlen=capacity)
+    _enabled = True
+
+
+def disable():
+    """Stops recording spans. Already recorded spans are kept until the next enable()."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def span(name, **args):
+    """
+    Returns a context manager that records the enclosed block as a span.
+
+    Args:
+        name (str): Phase name shown in the flame chart.
+        **args: Extra values attached to the span.
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+    return _Span(name, args)
+
+
+def instant(name, **args):
+    """Records a zero-duration event, e.g. a state machine transition."""
+    if _enabled:
+        _buffer.append(("i", name, time.monotonic_ns(), 0, threading.get_ident(), args))
+
+
+def events():
+    """Returns the buffered spans as Chrome trace-event dictionaries."""
+    pid = os.getpid()
+    trace_events = []
+    for phase, name, start_ns, duration_ns, tid, args in list(_buffer):
+        event = {"name": name, "ph": phase, "ts": start_ns / 1000.0,
+                 "pid": pid, "tid": tid, "args": args}
+        if phase == "X":
+            event["dur"] = duration_ns / 1000.0
+        else:
+            event["s"] = "t"  # Instant event scoped to its thread
+        trace_events.append(event)
+    return trace_events
+
+
+def dump(path):
+    """
+    Writes the buffered spans to 'path' as Chrome trace-event JSON.
+
+    Returns:
+        int: Number of events written.
+    """
+    trace_events = events()
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+    return len(trace_events)
+
+
+def dump_on_signal(path, signum=None):
+    """Installs a signal handler (SIGUSR1 by default) that dumps the buffer to 'path'."""
+    import signal
+
+    def _handler(received_signum, frame):
+        count = dump(path)
+        print(f"\nTrace: wrote {count} events to {path}")
+
+    signal.signal(signum if signum is not None else signal.SIGUSR1, _handler)